@@ -1,7 +1,7 @@
 from basic_types import AxisTypeEnum, MutabilityEnum, VariabilityEnum, Span
 from coverage import AbstractCoverage, SimplexCoverage, ViewCoverage, ComplexCoverage, ComplexCoverageType, \
     SimpleDomainSet, GridDomain, GridShape, CRS
-from coverage_model.parameter_functions import PythonFunction, NumexprFunction
+from coverage_model.parameter_functions import PythonFunction, NumexprFunction, FunctionExecutor
 from parameter import ParameterContext, ParameterDictionary, ParameterFunctionValidator
 from parameter_types import ArrayType, BooleanType, CategoryRangeType, CategoryType, ConstantType, CountRangeType, \
     CountType, FunctionType, QuantityRangeType, QuantityType, RecordType, ReferenceType, TextType, TimeRangeType, \
@@ -48,6 +48,7 @@ _types = [
 _functions = [
     'NumexprFunction',
     'PythonFunction',
+    'FunctionExecutor',
     ]
 
 _utils = [
@@ -9,7 +9,7 @@
 
 from ooi.logging import log
 import numpy as np
-from coverage_model.utils import create_guid, is_valid_constraint, prod
+from coverage_model.utils import create_guid, is_valid_constraint, prod, get_class
 
 class Dictable(object):
     """
@@ -50,26 +50,13 @@ class Dictable(object):
         """
         exclude = exclude if exclude is not None else []
 
-        def walk(obj):
-            if isinstance(obj, np.dtype):
-                return {'__np__': obj.str}
-            if hasattr(obj, '_todict'):
-                return obj._todict()
-            if isinstance(obj, dict):
-                return {k: walk(v) for k, v in obj.iteritems()}
-            if isinstance(obj, (list, tuple)):
-                r = map(walk, obj)
-                return r if isinstance(obj, list) else tuple(r)
-
-            return obj
-
 #        ret = dict((k,v._todict() if hasattr(v, '_todict') else v) for k, v in self.__dict__.iteritems() if k not in exclude)
         ret = {}
         for k, v in self.__dict__.iteritems():
             if k not in exclude:
-                ret[k] = walk(v)
+                ret[k] = v if type(v) in _PRIMITIVE_TYPES else _todict_walk(v)
 
-        ret['cm_type'] = (self.__module__, self.__class__.__name__)
+        ret['cm_type'] = _get_spec(self.__class__).cm_type
         return ret
 
     @classmethod
@@ -93,54 +80,138 @@ class Dictable(object):
 #        log.trace('_fromdict: cls=%s',cls)
         if isinstance(cmdict, dict) and 'cm_type' in cmdict and cmdict['cm_type']:
             cmd = cmdict.copy()
-            import inspect
-            mod = inspect.getmodule(cls)
             ptmod_s, ptcls_s=cmd.pop('cm_type')
-            ptcls=getattr(mod, ptcls_s)
+            ptcls = get_class(cls.__module__, ptcls_s)
+            spec = _get_spec(ptcls)
 
-            # Get the argument specification for the initializer
-            spec = inspect.getargspec(ptcls.__init__)
-            args = spec.args[1:] # get rid of 'self'
-            # Remove any optional arguments
-            if spec.defaults: # if None, all are required
-                for i in spec.defaults:
-                    args.remove(args[-1])
-            kwa = {}
+            if spec.direct_attrs is not None and spec.direct_attrs.issubset(cmd):
+                # Every attribute the initializer sets is restored from cmd, so the initializer can be skipped
+                ret = ptcls.__new__(ptcls)
+                ret.__dict__.update((k, v if type(v) in _PRIMITIVE_TYPES else _fromdict_walk(v)) for k, v in cmd.iteritems())
+                return ret
 
-            def walk(obj):
-                if isinstance(obj, dict):
-                    if 'cm_type' in obj:
-                        ms, cs = obj['cm_type']
-                        module = __import__(ms, fromlist=[cs])
-                        classobj = getattr(module, cs)
-                        return classobj._fromdict(obj)
-                    if '__np__' in obj and len(obj) == 1:
-                        return np.dtype(obj['__np__'])
-                    return {k: walk(v) for k, v in obj.iteritems()}
-                if isinstance(obj, (list, tuple)):
-                    r = map(walk, obj)
-                    return r if isinstance(obj, list) else tuple(r)
-
-                return obj
-
-            for a in args:
+            kwa = {}
+            restored = []
+            for a in spec.required_args:
                 # Apply any argument masking
                 am = arg_masks[a] if a in arg_masks else a
                 if am in cmd:
                     val = cmd.pop(am)
-                    kwa[a] = walk(val)
+                    kwa[a] = _fromdict_walk(val)
+                    restored.append((am, kwa[a]))
                 else:
                     kwa[a] = None
 
             ret = ptcls(**kwa)
 
             for k,v in cmd.iteritems():
-                setattr(ret,k,walk(v))
+                v = _fromdict_walk(v)
+                setattr(ret,k,v)
+                restored.append((k, v))
+
+            if not spec.verified:
+                spec.verify(ret, restored)
 
             return ret
         else:
             raise TypeError('cmdict is not properly formed, must be of type dict and contain a \'cm_type\' key: {0}'.format(cmdict))
 
+
+_PRIMITIVE_TYPES = frozenset([type(None), bool, int, long, float, str, unicode])
+
+
+def _todict_walk(obj):
+    if type(obj) in _PRIMITIVE_TYPES:
+        return obj
+    if isinstance(obj, np.dtype):
+        return {'__np__': obj.str}
+    if hasattr(obj, '_todict'):
+        return obj._todict()
+    if isinstance(obj, dict):
+        return {k: _todict_walk(v) for k, v in obj.iteritems()}
+    if isinstance(obj, (list, tuple)):
+        r = map(_todict_walk, obj)
+        return r if isinstance(obj, list) else tuple(r)
+
+    return obj
+
+
+def _fromdict_walk(obj):
+    if type(obj) in _PRIMITIVE_TYPES:
+        return obj
+    if isinstance(obj, dict):
+        if 'cm_type' in obj:
+            ms, cs = obj['cm_type']
+            return get_class(ms, cs)._fromdict(obj)
+        if '__np__' in obj and len(obj) == 1:
+            return np.dtype(obj['__np__'])
+        return {k: _fromdict_walk(v) for k, v in obj.iteritems()}
+    if isinstance(obj, (list, tuple)):
+        r = map(_fromdict_walk, obj)
+        return r if isinstance(obj, list) else tuple(r)
+
+    return obj
+
+
+class _DictableSpec(object):
+    """
+    Per-class information used by Dictable._todict and Dictable._fromdict, computed once per class
+    """
+
+    def __init__(self, cls):
+        self.cm_type = (cls.__module__, cls.__name__)
+        self._cls = cls
+        self._required_args = None
+        # The attributes set when loading an instance; None unless the initializer is known to be skippable
+        self.direct_attrs = None
+        self.verified = False
+
+    @property
+    def required_args(self):
+        if self._required_args is None:
+            import inspect
+            # Get the argument specification for the initializer
+            spec = inspect.getargspec(self._cls.__init__)
+            args = spec.args[1:] # get rid of 'self'
+            # Remove any optional arguments
+            if spec.defaults: # if None, all are required
+                args = args[:len(args) - len(spec.defaults)]
+            self._required_args = args
+
+        return self._required_args
+
+    def verify(self, obj, restored):
+        """
+        Determine if the initializer can be skipped when loading instances of the class
+
+        That is the case when every attribute of obj (loaded via the initializer) is one of the restored attributes
+        and was stored unchanged - i.e. the initializer and __setattr__ contribute nothing that isn't overwritten
+
+        @param obj  An instance loaded via the initializer
+        @param restored A list of (attribute, value) tuples applied to obj from the dict
+        """
+        self.verified = True
+        d = getattr(obj, '__dict__', None)
+        if d is None or len(d) != len(restored):
+            return
+
+        for k, v in restored:
+            if k not in d or d[k] is not v:
+                return
+
+        self.direct_attrs = frozenset(d)
+
+
+_dictable_specs = {}
+
+
+def _get_spec(cls):
+    try:
+        return _dictable_specs[cls]
+    except KeyError:
+        spec = _dictable_specs[cls] = _DictableSpec(cls)
+        return spec
+
 class AbstractBase(Dictable):
     """
     Base class for all coverage model objects
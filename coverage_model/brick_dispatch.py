@@ -4,21 +4,27 @@
 @package coverage_model.brick_dispatch
 @file coverage_model/brick_dispatch.py
 @author Christopher Mueller
-@brief Module containing classes for delegating the writing of values to persistence bricks using a pool of writer processes
+@brief Module containing classes for delegating the writing of values to persistence bricks using a pool of writer processes or threads
 """
 
 import os
 
 from pyon.util.async import spawn
 from coverage_model.utils import create_guid
-from gevent.event import AsyncResult
+from gevent.event import AsyncResult, Event
+from coverage_model.metrics import LatencyHistogram, get_telemetry
 
 from ooi.logging import log
 from gevent_zeromq import zmq
 from zmq.core.error import ZMQError
 from gevent import queue
+import gevent
 import time
 import random
+import bisect
+import hashlib
+import struct
+from collections import deque
 from pyon.core.interceptor.encode import encode_ion, decode_ion
 from msgpack import packb, unpackb
 import numpy as np
@@ -30,8 +36,20 @@ from pidantic.state_machine import PIDanticState
 REQUEST_WORK = 'REQUEST_WORK'
 SUCCESS = 'SUCCESS'
 FAILURE = 'FAILURE'
+# Sent to a worker in place of work: the worker acknowledges with ACK and exits
+STOP = 'STOP'
+ACK = 'ACK'
 PORT_RANGE = [10000,20000]
 WORK_FAILURE_RETRIES = 4
+# Seconds work that failed waits before it is retried, multiplied by the number of consecutive failures
+WORK_FAILURE_BACKOFF = 0.1
+# Milliseconds a loop waits for a message before checking whether it has been asked to stop
+STOP_POLL_INTERVAL = 500
+# What put_work does with work that would exceed the high-water mark
+OVERFLOW_POLICIES = ('block', 'raise', 'spill')
+
+class BrickDispatcherFullError(Exception):
+    pass
 
 def pack(msg):
     return packb(msg, default=encode_ion)
@@ -39,23 +57,380 @@ def pack(msg):
 def unpack(msg):
     return unpackb(msg, object_hook=decode_ion)
 
-class BrickWriterDispatcher(object):
+def _deadline(timeout):
+    return time.time() + timeout if timeout is not None else None
+
+def _remaining(deadline):
+    return max(0, deadline - time.time()) if deadline is not None else None
+
+def work_size(work):
+    """
+    Returns a tuple of (number of items, approximate number of bytes) for a work tuple or list of them
+    """
+    if not isinstance(work, list):
+        work = [work]
+
+    nbytes = 0
+    for brick_slice, value in work:
+        if isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+        elif isinstance(value, basestring):
+            nbytes += len(value)
+        elif isinstance(value, (list, tuple)):
+            nbytes += sum(len(v) if isinstance(v, basestring) else 8 for v in value)
+        else:
+            nbytes += 8
+
+    return len(work), nbytes
+
+def pack_work(work_key, work_metrics, work):
+    """
+    Pack work into a list of message frames: a msgpack header followed by the raw buffer of each numeric array
+
+    Arrays are not copied or converted - send the frames with copy=False
+
+    @param work_key The work key
+    @param work_metrics The work metrics
+    @param work A list of (brick_slice, value) tuples
+    @return A list of frames
+    """
+    frames = [None]
+    items = []
+    for brick_slice, value in work:
+        if isinstance(value, np.ndarray) and value.dtype != np.object_:
+            # (frame index, dtype, shape) stands in for the value
+            items.append((brick_slice, None, (len(frames), value.dtype.str, value.shape)))
+            frames.append(np.ascontiguousarray(value))
+        else:
+            items.append((brick_slice, value, None))
+
+    frames[0] = pack((work_key, work_metrics, items))
+    return frames
+
+def unpack_work(frames):
+    """
+    Reconstruct work packed by pack_work; arrays are read-only views on the frame buffers
+
+    @param frames   The list of frames (bytes or zmq.Frame)
+    @return A tuple of (work_key, work_metrics, work)
+    """
+    header = frames[0].bytes if hasattr(frames[0], 'bytes') else frames[0]
+    work_key, work_metrics, items = unpack(header)
+    work = []
+    for brick_slice, value, buf in items:
+        if buf is not None:
+            i, dtype, shape = buf
+            value = np.frombuffer(frames[i], dtype=dtype).reshape(shape)
+        work.append((brick_slice, value))
+
+    return work_key, work_metrics, work
+
+def dispatch_key(work_key, work_metrics):
+    """
+    Returns the key work is tracked by within a dispatcher: the brick dataset name and the brick file it is in
+    """
+    return work_key, work_metrics[0]
+
+class ConsistentHashRing(object):
+    """
+    Maps keys onto a fixed set of nodes such that each key always maps to the same node, and adding or removing a node
+    only moves the keys of that node
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self._ring = []
+        for n in nodes:
+            for r in xrange(replicas):
+                self._ring.append((self._hash('{0}:{1}'.format(n, r)), n))
+        self._ring.sort()
+        self._hashes = [h for h, n in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(str(key)).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+class AbstractBrickWriterDispatcher(object):
+    """
+    Interface for the out-of-band writing of brick values
+
+    Work is submitted as (work_key, work_metrics, work): work_key is the brick dataset name, work_metrics is
+    (brick_path, bD, cD, data_type, fill_value) and work is a (brick_slice, value) tuple or a list of them.  Work for a
+    given brick is written in the order it was submitted.  Bricks of different parameters can share a dataset name, so
+    internally work is keyed by (work_key, brick_path) - see dispatch_key.
+
+    Work is in flight from the time it is put until it is written or discarded.  When the items or bytes in flight
+    would exceed max_pending_items or max_pending_bytes, put_work applies the overflow_policy:
+        'block' - wait until enough in-flight work has been written
+        'raise' - raise BrickDispatcherFullError
+        'spill' - append the work to a spill file in spill_dir; spilled work is put, in order, as room becomes available
+    """
+
+    def __init__(self, failure_callback, num_workers=1, max_pending_items=None, max_pending_bytes=None, overflow_policy='block', spill_dir=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow_policy \'{0}\'; must be one of {1}'.format(overflow_policy, OVERFLOW_POLICIES))
+
+        self._failure_callback = failure_callback
+        self.num_workers = num_workers if num_workers > 0 else 1
+        self.is_single_worker = self.num_workers == 1
+        self._shutdown = False
+        self._draining = False
+        self._clean_results = []
+
+        self.max_pending_items = max_pending_items
+        self.max_pending_bytes = max_pending_bytes
+        self.overflow_policy = overflow_policy
+        self.spill_dir = spill_dir or tempfile.gettempdir()
+        self.items_in_flight = 0
+        self.bytes_in_flight = 0
+        self._has_room = Event()
+        self._has_room.set()
+        self._spill_file = None
+        self._spill_read_pos = 0
+        self._spilled = deque() # (record length, items, nbytes) of each spilled record, in order
+        self.write_latency = LatencyHistogram()
+        self._key_namespaces = {} # {dispatch_key: BrickWriterNamespace}
+        self.telemetry = get_telemetry()
+        self._queued_at = {} # {work_key: time its pending work was first queued} - only while telemetry is enabled
+
+    def has_pending_work(self):
+        raise NotImplementedError('Not implemented by base class')
+
+    def has_active_work(self):
+        raise NotImplementedError('Not implemented by base class')
+
+    def has_stashed_work(self):
+        return False
+
+    def has_spilled_work(self):
+        return len(self._spilled) > 0
 
-    def __init__(self, failure_callback, num_workers=1, pidantic_dir=None, working_dir=None):
+    def is_dirty(self):
+        return self.has_active_work() or self.has_stashed_work() or self.has_pending_work() or self.has_spilled_work()
+
+    def get_dirty_values_async_result(self):
+        """
+        Returns an AsyncResult that is set as soon as there is no outstanding work
+        """
+        ret = AsyncResult()
+        if self.is_dirty():
+            self._clean_results.append(ret)
+        else:
+            ret.set(True)
+
+        return ret
+
+    def _notify_if_clean(self):
+        # Called whenever work completes or is discarded
+        if not self.is_dirty():
+            while len(self._clean_results) > 0:
+                self._clean_results.pop().set(True)
+
+    def get_queue_depths(self):
+        """
+        Returns a list with a dict of {'keys': work_keys waiting, 'items': work items waiting, 'active': work_keys
+        being written} for each work queue
+        """
+        raise NotImplementedError('Not implemented by base class')
+
+    def get_metrics(self):
+        """
+        Returns a dict of the current queue depths, work in flight, spilled work and write latencies
+        """
+        return {'queue_depths': self.get_queue_depths(),
+                'items_in_flight': self.items_in_flight,
+                'bytes_in_flight': self.bytes_in_flight,
+                'spilled_items': sum(x[1] for x in self._spilled),
+                'write_latency': self.write_latency.as_dict()}
+
+    def is_full(self, items=0, nbytes=0):
+        """
+        Returns True if admitting work of the given size would exceed the high-water mark
+
+        Work is always admitted when nothing is in flight, however large it is
+        """
+        if self.items_in_flight == 0:
+            return False
+
+        return (self.max_pending_items is not None and self.items_in_flight + items > self.max_pending_items) or \
+               (self.max_pending_bytes is not None and self.bytes_in_flight + nbytes > self.max_pending_bytes)
+
+    def run(self):
+        raise NotImplementedError('Not implemented by base class')
+
+    def put_work(self, work_key, work_metrics, work, namespace=None):
+        """
+        Submit work to be written
+
+        @param work_key The brick dataset name
+        @param work_metrics A tuple of (brick_path, bD, cD, data_type, fill_value)
+        @param work A (brick_slice, value) tuple or a list of them
+        @param namespace    The BrickWriterNamespace the work belongs to, if any
+        """
+        if self._shutdown or self._draining:
+            raise SystemError('This BrickDispatcher has been shutdown and cannot process more work!')
+
+        items, nbytes = work_size(work)
+        if items == 0:
+            return
+
+        work_key = dispatch_key(work_key, work_metrics)
+        if self.has_spilled_work():
+            # Keep order - nothing jumps ahead of spilled work
+            self._track(work_key, items, namespace)
+            self._spill(work_key, work_metrics, work, items, nbytes)
+            return
+
+        while self.is_full(items, nbytes):
+            if self.overflow_policy == 'raise':
+                raise BrickDispatcherFullError('Brick dispatcher is full: {0} items, {1} bytes in flight'.format(self.items_in_flight, self.bytes_in_flight))
+            elif self.overflow_policy == 'spill':
+                self._track(work_key, items, namespace)
+                self._spill(work_key, work_metrics, work, items, nbytes)
+                return
+
+            log.debug('Brick dispatcher is full; waiting for room')
+            self._has_room.clear()
+            with self.telemetry.timer('dispatcher.put_blocked'):
+                self._has_room.wait()
+
+        self._track(work_key, items, namespace)
+        self._admit(work_key, work_metrics, work, items, nbytes)
+
+    def _track(self, work_key, items, namespace):
+        if namespace is not None:
+            self._key_namespaces[work_key] = namespace
+            namespace.items_in_flight += items
+
+    def _discard(self, message, wp):
+        # Work that will not be written goes to the failure callback of the namespace it belongs to, as it was put
+        self.telemetry.incr('dispatcher.discards')
+        ns = self._key_namespaces.get(wp[0])
+        put_wp = (wp[0][0],) + tuple(wp[1:])
+        if ns is not None:
+            ns._work_discarded(wp[0])
+            ns._failure_callback(message, put_wp)
+        else:
+            self._failure_callback(message, put_wp)
+
+    def _work_queued(self, work_key):
+        # Called when a work_key gets pending work
+        if self.telemetry.enabled:
+            self._queued_at.setdefault(work_key, time.time())
+
+    def _work_started(self, work_key):
+        # Called when the pending work for a work_key is handed to a worker
+        t = self._queued_at.pop(work_key, None)
+        if t is not None:
+            self.telemetry.record('dispatcher.queue_wait', time.time() - t)
+
+    def _admit(self, work_key, work_metrics, work, items, nbytes):
+        self.items_in_flight += items
+        self.bytes_in_flight += nbytes
+        self._put_work(work_key, work_metrics, work)
+
+    def _put_work(self, work_key, work_metrics, work):
+        raise NotImplementedError('Not implemented by base class')
+
+    def _work_written(self, work_key, work, start_time=None):
+        """
+        Called with work that has been written (or discarded) - frees its room and admits spilled work that now fits
+        """
+        items, nbytes = work_size(work)
+        self.items_in_flight -= items
+        self.bytes_in_flight -= nbytes
+        if start_time is not None:
+            self.write_latency.record(time.time() - start_time)
+        self.telemetry.incr('dispatcher.items_completed', items)
+        self.telemetry.incr('dispatcher.bytes_completed', nbytes)
+
+        ns = self._key_namespaces.get(work_key)
+        if ns is not None:
+            ns._work_written(work_key, items)
+
+        while self.has_spilled_work() and not self.is_full(*self._spilled[0][1:]):
+            self._unspill()
+
+        if not self.is_full():
+            self._has_room.set()
+
+    def _spill(self, work_key, work_metrics, work, items, nbytes):
+        if self._spill_file is None:
+            fd, path = tempfile.mkstemp(prefix='brick_spill_', dir=self.spill_dir)
+            self._spill_file = os.fdopen(fd, 'w+b')
+            os.remove(path)
+            self._spill_read_pos = 0
+            log.warn('Brick dispatcher is full; spilling work to %s', path)
+
+        if not isinstance(work, list):
+            work = [work]
+        rec = pack((work_key, work_metrics, work))
+        self._spill_file.seek(0, os.SEEK_END)
+        self._spill_file.write(struct.pack('>I', len(rec)))
+        self._spill_file.write(rec)
+        self._spilled.append((len(rec), items, nbytes))
+
+    def _unspill(self):
+        length, items, nbytes = self._spilled.popleft()
+        self._spill_file.seek(self._spill_read_pos + 4)
+        work_key, work_metrics, work = unpack(self._spill_file.read(length))
+        self._spill_read_pos += 4 + length
+        if not self.has_spilled_work():
+            self._spill_file.close()
+            self._spill_file = None
+
+        # Lists decode as lists - restore the tuples
+        self._admit(tuple(work_key), tuple(work_metrics), [tuple(w) for w in work], items, nbytes)
+
+    def shutdown(self, force=False, timeout=None):
+        """
+        Stop accepting work, wait for the outstanding work to be written (unless force is True), then stop the workers
+
+        @param force    If True, outstanding work is abandoned
+        @param timeout  The maximum number of seconds to wait, overall
+        """
+        raise NotImplementedError('Not implemented by base class')
+
+    def _drain(self, deadline):
+        # Stop accepting work and wait until everything accepted has been written or discarded
+        self._draining = True
+        log.debug('Draining brick dispatcher')
+        self.get_dirty_values_async_result().wait(timeout=_remaining(deadline))
+
+class BrickWriterDispatcher(AbstractBrickWriterDispatcher):
+    """
+    Dispatches work over ZeroMQ to BrickWriterWorkers running in a greenlet (num_workers == 1) or in separate processes
+
+    Work keys are sharded across the workers with a ConsistentHashRing: each worker has its own queue and only
+    receives the work keys of its shard, so work for a given key is always written by the same worker, in order.
+    """
+
+    def __init__(self, failure_callback, num_workers=1, pidantic_dir=None, working_dir=None, **kwargs):
+        AbstractBrickWriterDispatcher.__init__(self, failure_callback, num_workers, **kwargs)
         self.guid = create_guid()
         self.prep_queue = queue.Queue()
-        self.work_queue = queue.Queue()
+        # One work queue per shard; a work_key is queued when it has pending work and is not active
+        self.work_queues = [queue.Queue() for x in xrange(self.num_workers)]
+        # Workers waiting for work, by shard
+        self._idle_workers = [queue.Queue() for x in xrange(self.num_workers)]
+        self._worker_shards = {}
+        self._worker_seen = {}
+        self._shard_ring = ConsistentHashRing(xrange(self.num_workers))
+        self._shard_gs = []
+        self._stopped_workers = set()
+        self._workers_stopped = AsyncResult()
         self._pending_work = {}
-        self._stashed_work = {}
         self._active_work = {}
         self._failures = {}
         self._do_stop = False
         self._count = -1
-        self._shutdown = False
-        self._failure_callback = failure_callback
 
         self.context = zmq.Context(1)
-        self.prov_sock = self.context.socket(zmq.REP)
+        # A ROUTER (rather than a REP) socket lets work be sent to a particular worker, in any order
+        self.prov_sock = self.context.socket(zmq.ROUTER)
         self.prov_port = self._get_port(self.prov_sock)
         log.info('Provisioning url: tcp://*:{0}'.format(self.prov_port))
 
@@ -64,8 +439,6 @@ class BrickWriterDispatcher(object):
         self.resp_sock.setsockopt(zmq.SUBSCRIBE, '')
         log.info('Response url: tcp://*:{0}'.format(self.resp_port))
 
-        self.num_workers = num_workers if num_workers > 0 else 1
-        self.is_single_worker = self.num_workers == 1
         self.working_dir = working_dir or '.'
         self.pidantic_dir = pidantic_dir or './pid_dir'
         self.workers = []
@@ -131,35 +504,25 @@ class BrickWriterDispatcher(object):
                 ready = True
 
     def has_pending_work(self):
-        return len(self._pending_work) > 0
+        # Work still waiting for the organizer is pending too
+        return len(self._pending_work) > 0 or not self.prep_queue.empty()
 
     def has_active_work(self):
         return len(self._active_work) > 0
 
-    def has_stashed_work(self):
-        return len(self._stashed_work) > 0
+    def get_shard(self, work_key):
+        return self._shard_ring.get_node(work_key)
 
-    def is_dirty(self):
-        if not self.has_active_work():
-            if not self.has_stashed_work():
-                if not self.has_pending_work():
-                    return False
+    def get_queue_depths(self):
+        ret = [{'keys': 0, 'items': 0, 'active': 0} for x in xrange(self.num_workers)]
+        for k, (wm, w) in self._pending_work.iteritems():
+            d = ret[self.get_shard(k)]
+            d['keys'] += 1
+            d['items'] += len(w)
+        for k in self._active_work:
+            ret[self.get_shard(k)]['active'] += 1
 
-        return True
-
-    def get_dirty_values_async_result(self):
-        dirty_async_res = AsyncResult()
-        def dirty_check(self, res):
-            while True:
-                if self.is_dirty():
-                    time.sleep(0.1)
-                else:
-                    res.set(True)
-                    break
-
-        spawn(dirty_check, self, dirty_async_res)
-
-        return dirty_async_res
+        return ret
 
     def run(self):
         self._do_stop = False
@@ -171,49 +534,47 @@ class BrickWriterDispatcher(object):
     def shutdown(self, force=False, timeout=None):
         if self._shutdown:
             return
-        # CBM TODO: Revisit to ensure this won't strand work or terminate workers before they complete their work...!!
-        self._do_stop = True
+
+        deadline = _deadline(timeout)
         try:
             log.debug('Force == %s', force)
             if not force:
-                log.debug('Waiting for organizer; timeout == %s',timeout)
-                # Wait for the organizer to finish - ensures the prep_queue is empty
-                self._org_g.join(timeout=timeout)
+                self._drain(deadline)
 
-                log.debug('Waiting for provisioner; timeout == %s',timeout)
-                # Wait for the provisioner to finish - ensures work_queue is empty
-                self._prov_g.join(timeout=timeout)
+                # Each shard sends STOP to its workers as they ask for work; they ACK and exit
+                log.debug('Stopping workers; timeout == %s', _remaining(deadline))
+                self._do_stop = True
+                for q in self.work_queues:
+                    q.put(None)
+                self._workers_stopped.wait(timeout=_remaining(deadline))
 
-                log.debug('Waiting for receiver; timeout == %s',timeout)
-                # Wait for the receiver to finish - allows workers to finish their work
-                self._rec_g.join(timeout=timeout)
+            self._do_stop = True
+            self._draining = True
 
             log.debug('Killing organizer, provisioner, and receiver greenlets')
-            # Terminate the greenlets
             self._org_g.kill()
             self._prov_g.kill()
+            for g in self._shard_gs:
+                g.kill()
             self._rec_g.kill()
             log.debug('Greenlets killed')
 
             log.debug('Shutdown workers')
-            # Shutdown workers - work should be completed by now...
             if self.is_single_worker:
-                # Current work will be finished
+                # Already exited if it acknowledged the STOP
                 self.workers[0].stop()
             else:
+                # Workers that acknowledged the STOP have exited - this reaps them (and terminates any that did not)
                 self.workers = self.factory.reload_instances()
-                # CBM TODO:  THIS DOES NOT ALLOW CURRENT WORK TO FINISH!!!
                 for x in self.workers:
                     self.workers[x].cleanup()
                 self.factory.terminate()
             log.debug('Workers shutdown')
-        except:
-            raise
         finally:
             log.debug('Closing provisioner and receiver sockets')
-            # Close sockets
-            self.prov_sock.close()
-            self.resp_sock.close()
+            # Nothing more needs to be delivered
+            self.prov_sock.close(linger=0)
+            self.resp_sock.close(linger=0)
             log.debug('Sockets closed')
             log.debug('Terminating the context')
             self.context.term()
@@ -223,204 +584,465 @@ class BrickWriterDispatcher(object):
 
     def organize_work(self):
         while True:
-            if self._do_stop and self.prep_queue.empty():
-                break
-            try:
-                # Timeout after 1 second to allow stopage and _stashed_work cleanup
-                wd = self.prep_queue.get(timeout=1)
-            except queue.Empty:
-                # No new work added - see if there's anything on the stash to cleanup...
-                for k in self._stashed_work:
-                    log.debug('Cleanup _stashed_work...')
-                    # Just want to trigger cleanup of the _stashed_work, pass an empty list of 'work', gets discarded
-                    self.put_work(k, self._stashed_work[k][0], [])
+            # Blocks until there is work; shutdown kills the organizer
+            wd = self.prep_queue.get()
+
+            k, wm, w = wd
+            if not isinstance(w, list):
+                w = [w]
+            if len(w) == 0:
+                log.debug('Discarding empty work')
+                self._notify_if_clean()
                 continue
 
-            try:
-                k, wm, w = wd
-                is_list = isinstance(w, list)
-                if k not in self._stashed_work and len(w) == 0:
-                    log.debug('Discarding empty work')
-                    continue
-
-                log.debug('Work: %s',w)
-
-                if k in self._active_work:
-                    log.debug('Do Stash')
-                    # The work_key is being worked on
-                    if k not in self._stashed_work:
-                        # Create the stash for this work_key
-                        self._stashed_work[k] = (wm, [])
-
-                    # Add the work to the stash
-                    if is_list:
-                        self._stashed_work[k][1].extend(w[:])
-                    else:
-                        self._stashed_work[k][1].append(w)
-                else:
-                    # If there is a stash for this work_key, prepend it to work
-                    if k in self._stashed_work:
-                        log.debug('Was a stash, prepend: %s, %s', self._stashed_work[k], w)
-                        _, sv=self._stashed_work.pop(k)
-                        if is_list:
-                            sv.extend(w[:])
-                        else:
-                            sv.append(w)
-                        w = sv
-                        is_list = True # Work is a list going forward!!
-
-                    log.debug('Work: %s',w)
-
-                    # The work_key is not yet pending
-                    not_in_pend = k not in self._pending_work
-
-                    if not_in_pend:
-                        # Create the pending for this work_key
-                        log.debug('-> new pointer \'%s\'', k)
-                        self._pending_work[k] = (wm, [])
-
-                    # Add the work to the pending
-                    log.debug('-> adding work to \'%s\': %s', k, w)
-                    if is_list:
-                        self._pending_work[k][1].extend(w[:])
-                    else:
-                        self._pending_work[k][1].append(w)
+            log.debug('Work for \'%s\': %s', k, w)
+            if k in self._pending_work:
+                # Already queued, or waiting for the active work for this work_key to complete
+                self._pending_work[k][1].extend(w)
+            else:
+                self._pending_work[k] = (wm, list(w))
+                self._work_queued(k)
+                if k not in self._active_work:
+                    self._queue_key(k)
 
-                    if not_in_pend:
-                        # Add the not-yet-pending work to the work_queue
-                        self.work_queue.put(k)
-            except:
-                raise
+    def _put_work(self, work_key, work_metrics, work):
+        self.prep_queue.put((work_key, work_metrics, work))
 
+    def _queue_key(self, work_key):
+        self.work_queues[self.get_shard(work_key)].put(work_key)
 
-    def put_work(self, work_key, work_metrics, work):
-        if self._shutdown:
-            raise SystemError('This BrickDispatcher has been shutdown and cannot process more work!')
-        self.prep_queue.put((work_key, work_metrics, work))
+    def _requeue(self, work_key, work_metrics, work):
+        # Retried work goes ahead of anything submitted since
+        if work_key in self._pending_work:
+            work = work + self._pending_work[work_key][1]
+        self._pending_work[work_key] = (work_metrics, work)
+        self._work_queued(work_key)
 
-    def _add_failure(self, wp):
-        pwp = pack(wp)
-        log.warn('Adding to _failures: %s', pwp)
-        if pwp in self._failures:
-            self._failures[pwp] += 1
-        else:
-            self._failures[pwp] = 1
+    def _add_failure(self, work_key):
+        log.warn('Adding to _failures: %s', work_key)
+        self._failures[work_key] = self._failures.get(work_key, 0) + 1
 
-        if self._failures[pwp] > WORK_FAILURE_RETRIES:
+        if self._failures[work_key] > WORK_FAILURE_RETRIES:
+            self._failures.pop(work_key)
             raise ValueError('Maximum failure retries exceeded')
 
+    def _handle_response(self, resp_type, worker_guid, work_key, info):
+        # info is the seconds spent writing for SUCCESS and the number of items not written for FAILURE
+        self._worker_seen[worker_guid] = time.time()
+        if resp_type == ACK:
+            log.debug('Worker %s stopped', worker_guid)
+            self._stopped_workers.add(worker_guid)
+            self._remove_worker(worker_guid)
+            if len(self._stopped_workers) >= self.num_workers:
+                self._workers_stopped.set(True)
+        elif resp_type == SUCCESS:
+            log.debug('Worker %s was successful', worker_guid)
+            wguid, wp, t = self._active_work.pop(work_key)
+            self._failures.pop(work_key, None)
+            if info is not None:
+                self.telemetry.record('worker.write', info)
+            self._work_written(work_key, wp[2], t)
+        elif resp_type == FAILURE:
+            log.debug('Failure reported for work on %s by worker %s', work_key, worker_guid)
+            if work_key is None:
+                # Worker failed before it did anything, put all work back on the prep queue to be reorganized by the organizer
+                # Because it failed so miserably, need to find the work_key based on guid
+                for k, v in self._active_work.iteritems():
+                    if v[0] == worker_guid:
+                        work_key = k
+                        break
+
+                if work_key is not None:
+                    wguid, wp, t = self._active_work.pop(work_key)
+                    try:
+                        self._add_failure(work_key)
+                    except ValueError,e:
+                        self._discard(e.message, wp)
+                        self._work_written(work_key, wp[2])
+                        return work_key
+
+                    self._requeue(*wp)
+            else:
+                # Normal failure
+                # Pop the work from active work, and queue what the worker reports as not yet written (always the tail)
+                wguid, wp, t = self._active_work.pop(work_key)
+                try:
+                    self._add_failure(work_key)
+                except ValueError,e:
+                    self._discard(e.message, wp)
+                    self._work_written(work_key, wp[2])
+                    return work_key
+                _, wm, work = wp
+                self._work_written(work_key, work[:len(work) - info])
+                self._requeue(work_key, wm, work[len(work) - info:])
+
+        return work_key
+
     def receiver(self):
         while True:
-            try:
-                if self.resp_sock.closed:
-                    break
-                if self._do_stop and len(self._active_work) == 0:
-                    break
-
-                log.debug('Receive response message (loop)')
-                msg = None
-                while msg is None:
-                    try:
-                        msg = self.resp_sock.recv(zmq.NOBLOCK)
-                    except zmq.ZMQError, e:
-                        if e.errno == zmq.EAGAIN:
-                            if self._do_stop:
-                                break
-                            else:
-                                time.sleep(0.1)
-                        else:
-                            raise
-
-                if msg is not None:
-                    resp_type, worker_guid, work_key, work = unpack(msg)
-                    work = list(work) if work is not None else work
-                    if resp_type == SUCCESS:
-                        log.debug('Worker %s was successful', worker_guid)
-                        wguid, pw = self._active_work.pop(work_key)
-                        if pw in self._failures:
-                            self._failures.pop(pw)
-                    elif resp_type == FAILURE:
-                        log.debug('Failure reported for work on %s by worker %s', work_key, worker_guid)
-                        if work_key is None:
-                            # Worker failed before it did anything, put all work back on the prep queue to be reorganized by the organizer
-                            # Because it failed so miserably, need to find the work_key based on guid
-                            for k, v in self._active_work.iteritems():
-                                if v[0] == worker_guid:
-                                    work_key = k
-                                    break
-
-                            if work_key is not None:
-                                wguid, pw = self._active_work.pop(work_key)
-                                try:
-                                    self._add_failure(pw)
-                                except ValueError,e:
-                                    self._failure_callback(e.message, unpack(pw))
-                                    continue
-
-                                self.put_work(*unpack(pw))
-                        else:
-                            # Normal failure
-                            # Pop the work from active work, and queue the work returned by the worker
-                            wguid, pw = self._active_work.pop(work_key)
-                            try:
-                                self._add_failure(pw)
-                            except ValueError,e:
-                                self._failure_callback(e.message, unpack(pw))
-                                continue
-                            _, wm, wk = unpack(pw)
-                            self.put_work(work_key, wm, work)
-            finally:
-#                time.sleep(0.1)
-                pass
+            # Blocks until a response arrives; shutdown kills the receiver
+            resp_type, worker_guid, work_key, info = unpack(self.resp_sock.recv())
+            if work_key is not None:
+                work_key = tuple(work_key)
+            work_key = self._handle_response(resp_type, worker_guid, work_key, info)
+
+            # The work_key is free again - queue anything submitted for it meanwhile, or signal completion if this was the last
+            if work_key is not None and work_key in self._pending_work:
+                self._queue_key(work_key)
+            self._notify_if_clean()
 
     def provisioner(self):
+        self._shard_gs = [spawn(self._provision_shard, x) for x in xrange(self.num_workers)]
+
         while True:
-            try:
-                if self.prov_sock.closed:
-                    break
-                if self._do_stop and self.work_queue.empty():
-                    break
-
-                log.debug('Receive work request (loop)')
-                msg = None
-                while msg is None:
-                    try:
-                        msg = self.prov_sock.recv(zmq.NOBLOCK)
-                    except zmq.ZMQError, e:
-                        if e.errno == zmq.EAGAIN:
-                            if self._do_stop:
-                                break
-                            else:
-                                time.sleep(0.1)
-                        else:
-                            raise
-
-                if msg is not None:
-                    _, worker_guid = unpack(msg)
-                    log.debug('Get work from work_queue (loop)')
-                    work_key = None
-                    while work_key is None:
-                        try:
-                            work_key = self.work_queue.get(block=False)
-                        except queue.Empty:
-                            if self._do_stop:
-                                break
-                            else:
-                                time.sleep(0.1)
-
-                    if work_key is not None:
-                        log.debug('Assign work for %s', work_key)
-                        work_metrics, work = self._pending_work.pop(work_key)
-
-                        wp = (work_key, work_metrics, work)
-                        log.debug('Assigning to %s: %s', work_key, wp)
-                        pw = pack(wp)
-
-                        self._active_work[work_key] = (worker_guid, pw)
-                        self.prov_sock.send(pw)
-            finally:
-#       e         time.sleep(0.1)
-                pass
+            # Blocks until a worker asks for work; shutdown kills the provisioner
+            ident, _, msg = self.prov_sock.recv_multipart()
+            _, worker_guid = unpack(msg)
+            self._idle_workers[self._register_worker(worker_guid)].put((ident, worker_guid))
+
+    def _register_worker(self, worker_guid):
+        """
+        Returns the shard of the worker, assigning a new worker to the shard with the fewest live workers
+
+        The pool has num_workers workers, so a new worker arriving when all are accounted for replaces one that has
+        died (i.e. was restarted with a new guid): the workers seen least recently that have no active work are
+        presumed dead and forgotten, so the shard they leave without workers is the one staffed next.
+
+        @param worker_guid  The guid of the worker asking for work
+        @return The shard of the worker
+        """
+        self._worker_seen[worker_guid] = time.time()
+        if worker_guid not in self._worker_shards:
+            busy = set(v[0] for v in self._active_work.itervalues())
+            stale = sorted((self._worker_seen.get(g, 0), g) for g in self._worker_shards if g not in busy)
+            while len(self._worker_shards) >= self.num_workers and len(stale) > 0:
+                log.info('Worker %s presumed dead; replaced by worker %s', stale[0][1], worker_guid)
+                self._remove_worker(stale.pop(0)[1])
+
+            counts = [0] * self.num_workers
+            for s in self._worker_shards.itervalues():
+                counts[s] += 1
+            self._worker_shards[worker_guid] = min(xrange(self.num_workers), key=lambda x: counts[x])
+            log.debug('Worker %s assigned to shard %s', worker_guid, self._worker_shards[worker_guid])
+
+        return self._worker_shards[worker_guid]
+
+    def _remove_worker(self, worker_guid):
+        self._worker_shards.pop(worker_guid, None)
+        self._worker_seen.pop(worker_guid, None)
+
+    def _provision_shard(self, shard):
+        work_queue = self.work_queues[shard]
+        idle_workers = self._idle_workers[shard]
+        while True:
+            work_key = work_queue.get()
+            if work_key is None:
+                # Shutdown - everything has been written; stop the workers of this shard as they ask for work
+                while True:
+                    ident, worker_guid = idle_workers.get()
+                    log.debug('Sending STOP to worker %s', worker_guid)
+                    self.prov_sock.send_multipart([ident, '', pack(STOP)])
+
+            log.debug('Get a worker for shard %s (loop)', shard)
+            ident, worker_guid = idle_workers.get()
+            log.debug('Assign work for %s', work_key)
+            work_metrics, work = self._pending_work.pop(work_key)
+            self._work_started(work_key)
+
+            wp = (work_key, work_metrics, work)
+            log.debug('Assigning to %s: %s', work_key, wp)
+
+            # Keep the unpacked work - it is what gets retried or reported if the worker fails
+            self._active_work[work_key] = (worker_guid, wp, time.time())
+            # Sends on a ROUTER socket never block, so the shards' messages cannot interleave
+            self.prov_sock.send_multipart([ident, ''] + pack_work(*wp), copy=False)
+
+def _timed_write_brick_work(work_key, work_metrics, work):
+    # Runs in a writer thread - returns the seconds spent writing, to be recorded back in the hub
+    from coverage_model.brick_worker import write_brick_work
+    t = time.time()
+    write_brick_work(work_key, work_metrics, work)
+    return time.time() - t
+
+class ThreadedBrickWriterDispatcher(AbstractBrickWriterDispatcher):
+    """
+    Writes work in-process on a pool of OS threads
+
+    Values are handed to the writer threads as-is - nothing is serialized - so they must not be modified after being
+    submitted.  At most one thread works on a given work_key at a time; work submitted in the meantime is written
+    by the next round for that key.
+    """
+
+    def __init__(self, failure_callback, num_workers=1, **kwargs):
+        AbstractBrickWriterDispatcher.__init__(self, failure_callback, num_workers, **kwargs)
+        self._pending_work = {} # {work_key: (work_metrics, [work])} - waiting for the work_key to become free
+        self._active_work = {} # {work_key: (work_metrics, [work])} - being written
+        self._failures = {} # {work_key: consecutive failure count}
+        self.pool = None
+
+    def has_pending_work(self):
+        return len(self._pending_work) > 0
+
+    def has_active_work(self):
+        return len(self._active_work) > 0
+
+    def get_queue_depths(self):
+        # The threads share a single queue
+        return [{'keys': len(self._pending_work),
+                 'items': sum(len(w) for wm, w in self._pending_work.itervalues()),
+                 'active': len(self._active_work)}]
+
+    def run(self):
+        from gevent.threadpool import ThreadPool
+        self.pool = ThreadPool(self.num_workers)
+
+    def _put_work(self, work_key, work_metrics, work):
+        if not isinstance(work, list):
+            work = [work]
+
+        if work_key not in self._pending_work:
+            self._pending_work[work_key] = (work_metrics, [])
+            self._work_queued(work_key)
+        self._pending_work[work_key][1].extend(work)
+
+        # Work that failed is retried by _retry_work, after backing off
+        if work_key not in self._active_work and work_key not in self._failures:
+            self._start_work(work_key)
+
+    def _start_work(self, work_key):
+        work_metrics, work = self._pending_work.pop(work_key)
+        self._work_started(work_key)
+        # write_brick_work trims 'work' as it goes - keep what was submitted to account for what was written
+        self._active_work[work_key] = (work_metrics, work, list(work), time.time())
+
+        # The result is delivered in this (the submitting) thread, so the bookkeeping needs no locking.  Completion is
+        # handled in a greenlet because submitting more work can block (when all threads are busy)
+        res = self.pool.spawn(_timed_write_brick_work, work_key[0], work_metrics, work)
+        res.rawlink(lambda r: spawn(self._work_done, work_key, r))
+
+    def _work_done(self, work_key, result):
+        work_metrics, work, submitted, t = self._active_work.pop(work_key)
+        if result.successful():
+            self._failures.pop(work_key, None)
+            self.telemetry.record('worker.write', result.value)
+            written = submitted
+        else:
+            log.warn('Failure writing work for %s: %s', work_key, result.exception)
+            written = submitted[:len(submitted) - len(work)]
+            self._failures[work_key] = self._failures.get(work_key, 0) + 1
+            if self._failures[work_key] > WORK_FAILURE_RETRIES:
+                self._failures.pop(work_key)
+                self._discard('Maximum failure retries exceeded', (work_key, work_metrics, work))
+                written = submitted
+            else:
+                # Retry what remains ahead of anything submitted since, once the failure had a chance to clear
+                if work_key in self._pending_work:
+                    work.extend(self._pending_work.pop(work_key)[1])
+                self._pending_work[work_key] = (work_metrics, work)
+                self._work_queued(work_key)
+                spawn(self._retry_work, work_key, WORK_FAILURE_BACKOFF * self._failures[work_key])
+            t = None
+
+        if work_key in self._pending_work and work_key not in self._failures:
+            self._start_work(work_key)
+
+        # Only once the bookkeeping for work_key is done - this can admit more work
+        self._work_written(work_key, written, t)
+        self._notify_if_clean()
+
+    def _retry_work(self, work_key, delay):
+        gevent.sleep(delay)
+        # Work submitted in the meantime may have started it already
+        if work_key in self._pending_work and work_key not in self._active_work and not self._shutdown:
+            self._start_work(work_key)
+
+    def shutdown(self, force=False, timeout=None):
+        if self._shutdown:
+            return
+
+        try:
+            if not force:
+                self._drain(_deadline(timeout))
+
+            if self.pool is not None:
+                self.pool.kill()
+        finally:
+            self._shutdown = True
+
+BRICK_WRITER_BACKENDS = {
+    'zmq': BrickWriterDispatcher,
+    'thread': ThreadedBrickWriterDispatcher,
+}
+
+def get_brick_writer_dispatcher(backend, failure_callback, **kwargs):
+    """
+    Construct the dispatcher for the named writer backend
+
+    @param backend  The name of the backend; one of BRICK_WRITER_BACKENDS
+    @param failure_callback Called with (message, work) when work is discarded
+    @param kwargs   Additional keyword arguments for the dispatcher
+    @return An AbstractBrickWriterDispatcher
+    """
+    if backend not in BRICK_WRITER_BACKENDS:
+        raise ValueError('Unknown brick writer backend \'{0}\'; must be one of {1}'.format(backend, sorted(BRICK_WRITER_BACKENDS)))
+
+    return BRICK_WRITER_BACKENDS[backend](failure_callback, **kwargs)
+
+class BrickWriterNamespace(object):
+    """
+    A coverage's handle on a shared dispatcher
+
+    Has the part of the dispatcher interface coverages use, but completion and failures only concern the work put
+    through this namespace.  Shutting the namespace down releases it from the dispatcher.
+    """
+
+    def __init__(self, dispatcher, name, failure_callback):
+        self.dispatcher = dispatcher
+        self.name = name
+        self._failure_callback = failure_callback
+        self.items_in_flight = 0
+        self._clean_results = []
+        self._released = False
+        # Items put and items written (or discarded) per dispatch_key; work for a brick is written in order
+        self._submitted = {}
+        self._written = {}
+        self._batches = [] # [({work_key: items submitted through the batch}, AsyncResult, [ok])]
+
+    def put_work(self, work_key, work_metrics, work):
+        if self._released:
+            raise SystemError('This BrickWriterNamespace has been released and cannot process more work!')
+
+        key = dispatch_key(work_key, work_metrics)
+        items = work_size(work)[0]
+        self._submitted[key] = self._submitted.get(key, 0) + items
+        try:
+            self.dispatcher.put_work(work_key, work_metrics, work, namespace=self)
+        except:
+            self._submitted[key] -= items
+            raise
+
+    def put_batch(self, batch):
+        """
+        Submit a group of work to be written together
+
+        @param batch    A list of (work_key, work_metrics, work) tuples; ideally one per work_key
+        @return An AsyncResult that is set once all the work in the batch has been written: True if it all was, False
+        if any of it was discarded
+        """
+        for work_key, work_metrics, work in batch:
+            self.put_work(work_key, work_metrics, work)
+
+        ret = AsyncResult()
+        keys = set(dispatch_key(k, wm) for k, wm, _ in batch)
+        targets = dict((k, self._submitted[k]) for k in keys if self._written.get(k, 0) < self._submitted[k])
+        if targets:
+            self._batches.append((targets, ret, [True]))
+        else:
+            ret.set(True)
+
+        return ret
+
+    def is_dirty(self):
+        return self.items_in_flight > 0
+
+    def get_dirty_values_async_result(self):
+        """
+        Returns an AsyncResult that is set as soon as there is no outstanding work for this namespace
+        """
+        ret = AsyncResult()
+        if self.is_dirty():
+            self._clean_results.append(ret)
+        else:
+            ret.set(True)
+
+        return ret
+
+    def _work_written(self, work_key, items):
+        self.items_in_flight -= items
+        self._written[work_key] = self._written.get(work_key, 0) + items
+
+        if self._batches:
+            pending = []
+            for b in self._batches:
+                targets, ret, ok = b
+                if work_key in targets and self._written[work_key] >= targets[work_key]:
+                    del targets[work_key]
+                if targets:
+                    pending.append(b)
+                else:
+                    ret.set(ok[0])
+            self._batches = pending
+
+        if not self.is_dirty():
+            while len(self._clean_results) > 0:
+                self._clean_results.pop().set(True)
+
+    def _work_discarded(self, work_key):
+        # The discarded work is the next to be written for work_key, so every batch still waiting on it loses some
+        for targets, ret, ok in self._batches:
+            if work_key in targets:
+                ok[0] = False
+
+    def shutdown(self, force=False, timeout=None):
+        if self._released:
+            return
+
+        if not force and self.is_dirty():
+            log.debug('Waiting for work in namespace %s to complete; timeout == %s', self.name, timeout)
+            self.get_dirty_values_async_result().wait(timeout=timeout)
+
+        self._released = True
+        release_brick_writer_dispatcher(self, force=force, timeout=timeout)
+
+# {(backend, options): (dispatcher, [BrickWriterNamespace])}
+_shared_dispatchers = {}
+
+def _shared_dispatcher_failure_callback(message, work):
+    log.error('WORK DISCARDED!!!; %s: %s', message, work)
+
+def acquire_brick_writer_dispatcher(backend, failure_callback, name=None, **kwargs):
+    """
+    Attach to the process-wide dispatcher for the backend and options, starting it if needed
+
+    Dispatchers are reference counted - the dispatcher is shut down when its last namespace is released
+
+    @param backend  The name of the backend; one of BRICK_WRITER_BACKENDS
+    @param failure_callback Called with (message, work) when work put through the namespace is discarded
+    @param name The name of the namespace (i.e. the coverage guid)
+    @param kwargs   Additional keyword arguments for the dispatcher
+    @return A BrickWriterNamespace
+    """
+    key = (backend, tuple(sorted(kwargs.iteritems())))
+    if key not in _shared_dispatchers:
+        disp = get_brick_writer_dispatcher(backend, _shared_dispatcher_failure_callback, **kwargs)
+        disp.run()
+        _shared_dispatchers[key] = (disp, [])
+
+    disp, namespaces = _shared_dispatchers[key]
+    ns = BrickWriterNamespace(disp, name or create_guid(), failure_callback)
+    namespaces.append(ns)
+    log.debug('Namespace %s attached to the \'%s\' dispatcher; %s attached', ns.name, backend, len(namespaces))
+    return ns
+
+def release_brick_writer_dispatcher(namespace, force=False, timeout=None):
+    """
+    Detach a namespace from its dispatcher, shutting the dispatcher down if it was the last
+
+    @param namespace    The BrickWriterNamespace
+    @param force    Passed to the dispatcher shutdown
+    @param timeout  Passed to the dispatcher shutdown
+    """
+    for key, (disp, namespaces) in _shared_dispatchers.items():
+        if namespace in namespaces:
+            namespaces.remove(namespace)
+            for k in [k for k, v in disp._key_namespaces.iteritems() if v is namespace]:
+                disp._key_namespaces.pop(k)
+
+            if len(namespaces) == 0:
+                log.debug('Last namespace released; shutting down the \'%s\' dispatcher', key[0])
+                _shared_dispatchers.pop(key)
+                disp.shutdown(force=force, timeout=timeout)
+            break
 
 def run_test_dispatcher(work_count, num_workers=1):
     # Set up temporary directories to save data
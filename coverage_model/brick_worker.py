@@ -10,13 +10,17 @@
 from pyon.util.async import spawn
 from ooi.logging import log, config
 import logging
-from coverage_model.brick_dispatch import pack, unpack, FAILURE, REQUEST_WORK, SUCCESS
+from coverage_model.brick_dispatch import pack, unpack_work, ACK, FAILURE, REQUEST_WORK, STOP, SUCCESS, STOP_POLL_INTERVAL
 from coverage_model.utils import create_guid
+from coverage_model.persistence_helpers import get_storage_dtype, write_binary_values, brick_lock, BINARY_OBJECT_DTYPE
 from gevent_zeromq import zmq
+import numpy as np
 import h5py
 import time
 import sys
 
+STOP_MSG = pack(STOP)
+
 class BrickWriterWorker(object):
 
     def __init__(self, req_port, resp_port, name=None):
@@ -51,53 +55,41 @@ class BrickWriterWorker(object):
         return self._g
 
     def _run(self, guid):
+        poller = zmq.Poller()
+        poller.register(self.req_sock, zmq.POLLIN)
         while not self._do_stop:
             try:
                 log.debug('%s making work request', guid)
                 self.req_sock.send(pack((REQUEST_WORK, guid)))
                 msg = None
                 while msg is None:
-                    try:
-                        msg = self.req_sock.recv(zmq.NOBLOCK)
-                    except zmq.ZMQError, e:
-                        if e.errno == zmq.EAGAIN:
-                            if self._do_stop:
-                                break
-                            else:
-                                time.sleep(0.1)
-                        else:
-                            raise
-
-                if msg is not None:
-                    brick_key, brick_metrics, work = unpack(msg)
-                    work=list(work) # lists decode as a tuples
+                    # Wakes as soon as work arrives; the timeout only bounds how long a stop request goes unnoticed
+                    if self.req_sock in dict(poller.poll(STOP_POLL_INTERVAL)):
+                        msg = self.req_sock.recv_multipart(copy=False)
+                    elif self._do_stop:
+                        break
+
+                if msg is not None and len(msg) == 1 and msg[0].bytes == STOP_MSG:
+                    # The dispatcher has no more work - acknowledge and exit
+                    log.debug('%s received STOP', guid)
+                    self._do_stop = True
+                    self.resp_sock.send(pack((ACK, guid, None, None)))
+                elif msg is not None:
+                    # The key is the dispatcher's (brick dataset name, brick path) - it goes back with the response
+                    brick_key, brick_metrics, work = unpack_work(msg)
                     try:
                         log.debug('*%s*%s* got work for %s, metrics %s: %s', time.time(), guid, brick_key, brick_metrics, work)
-                        brick_path, bD, cD, data_type, fill_value = brick_metrics
-                        if data_type == '|O8':
-                            data_type = h5py.special_dtype(vlen=str)
-                        # TODO: Uncomment this to properly turn 0 & 1 chunking into True
-#                        if 0 in cD or 1 in cD:
-#                            cD = True
-                        with h5py.File(brick_path, 'a') as f:
-                            # TODO: Due to usage concerns, currently locking chunking to "auto"
-                            f.require_dataset(brick_key, shape=bD, dtype=data_type, chunks=None, fillvalue=fill_value)
-                            for w in list(work): # Iterate a copy - WARN, this is NOT deep, if the list contains objects, they're NOT copied
-                                brick_slice, value = w
-                                if isinstance(brick_slice, tuple):
-                                    brick_slice = list(brick_slice)
-
-                                log.debug('slice_=%s, value=%s', brick_slice, value)
-                                f[brick_key].__setitem__(*brick_slice, val=value)
-                                # Remove the work AFTER it's completed (i.e. written)
-                                work.remove(w)
+                        t = time.time()
+                        write_brick_work(brick_key[0], brick_metrics, work)
+                        t = time.time() - t
                         log.debug('*%s*%s* done working on %s', time.time(), guid, brick_key)
-                        self.resp_sock.send(pack((SUCCESS, guid, brick_key, None)))
+                        # Report the time spent writing
+                        self.resp_sock.send(pack((SUCCESS, guid, brick_key, t)))
                     except Exception as ex:
                         log.error('Exception: %s', ex.message)
-                        log.warn('%s send failure response with work %s', guid, work)
-                        # TODO: Send the remaining work back
-                        self.resp_sock.send(pack((FAILURE, guid, brick_key, work)))
+                        log.warn('%s send failure response with %s items remaining', guid, len(work))
+                        # The dispatcher holds the work - report how much of it is left rather than sending it back
+                        self.resp_sock.send(pack((FAILURE, guid, brick_key, len(work))))
             except Exception as ex:
                 log.error('Exception: %s', ex.message)
                 log.error('%s send failure response with work %s', guid, None)
@@ -108,6 +100,147 @@ class BrickWriterWorker(object):
                 pass
 
 
+def _brick_bounds(brick_slice, shape):
+    """
+    Resolve a brick slice to per-dimension [start, stop) bounds
+
+    @param brick_slice  A list of slices and/or integer indices, one per dimension
+    @param shape    The shape of the brick
+    @return A tuple of (start, stop) tuples, or None if the slice cannot be merged (steps, index arrays, etc)
+    """
+    if len(brick_slice) != len(shape):
+        return None
+
+    bounds = []
+    for s, n in zip(brick_slice, shape):
+        if isinstance(s, slice):
+            start, stop, step = s.indices(n)
+            if step != 1 or stop <= start:
+                return None
+        elif isinstance(s, (int, long, np.integer)):
+            start = s + n if s < 0 else s
+            stop = start + 1
+        else:
+            return None
+        bounds.append((start, stop))
+
+    return tuple(bounds)
+
+def _unmerged(work):
+    return [(w[0], w[1], [i]) for i, w in enumerate(work)]
+
+def merge_brick_work(work, shape, dtype):
+    """
+    Coalesce work whose slices are contiguous or overlapping along the first dimension (and identical along the
+    others) into single writes
+
+    Within a merged write, items are applied in their original order, so later writes win.  If the writes that
+    result would overlap one another, the work is not merged and each item is written on its own, in order.
+
+    @param work A list of (brick_slice, value) tuples
+    @param shape    The shape of the brick
+    @param dtype    The dtype of the brick; merged values are buffered as this type
+    @return A list of (brick_slice, value, indices) tuples, where indices are the positions in 'work' the write covers
+    """
+    bounds = [_brick_bounds(list(w[0]), shape) for w in work]
+    if len(work) < 2 or None in bounds:
+        return _unmerged(work)
+
+    # Sort by the trailing dimensions, then by start - runs that can be merged end up adjacent
+    order = sorted(xrange(len(work)), key=lambda i: (bounds[i][1:], bounds[i][0][0], i))
+    groups = []
+    for i in order:
+        b = bounds[i]
+        if groups:
+            g = groups[-1]
+            if g['bounds'][1:] == b[1:] and b[0][0] <= g['bounds'][0][1]:
+                g['bounds'] = ((g['bounds'][0][0], max(g['bounds'][0][1], b[0][1])),) + b[1:]
+                g['indices'].append(i)
+                continue
+        groups.append({'bounds': b, 'indices': [i]})
+
+    # Groups are written in sorted order - that is only equivalent if no two of them touch the same elements
+    boxes = sorted(g['bounds'] for g in groups)
+    for n, a in enumerate(boxes):
+        for b in boxes[n + 1:]:
+            if b[0][0] >= a[0][1]:
+                break
+            if all(bs < ae and as_ < be for (as_, ae), (bs, be) in zip(a, b)):
+                return _unmerged(work)
+
+    ret = []
+    for g in groups:
+        indices = sorted(g['indices'])
+        if len(indices) == 1:
+            i = indices[0]
+            ret.append((work[i][0], work[i][1], indices))
+            continue
+
+        origin = [b[0] for b in g['bounds']]
+        buf = np.empty([b[1] - b[0] for b in g['bounds']], dtype=dtype)
+        for i in indices:
+            brick_slice, value = work[i]
+            local = []
+            for s, o, n in zip(brick_slice, origin, shape):
+                if isinstance(s, slice):
+                    start, stop, _ = s.indices(n)
+                    local.append(slice(start - o, stop - o))
+                else:
+                    local.append((s + n if s < 0 else s) - o)
+            try:
+                buf[tuple(local)] = value
+            except ValueError:
+                # Leave malformed values for the write itself to report
+                return _unmerged(work)
+
+        ret.append(([slice(*b) for b in g['bounds']], buf, indices))
+
+    return ret
+
+def write_brick_work(brick_key, brick_metrics, work):
+    """
+    Write a list of work to a brick
+
+    Contiguous and overlapping work is merged and written at once (see merge_brick_work).  If an exception is raised,
+    'work' is trimmed to what remains to be done - always a tail of the original list
+
+    @param brick_key    The name of the brick dataset
+    @param brick_metrics    A tuple of (brick_path, bD, cD, data_type, fill_value)
+    @param work A list of (brick_slice, value) tuples
+    """
+    brick_path, bD, cD, data_type, fill_value = brick_metrics
+    binary = data_type == BINARY_OBJECT_DTYPE
+    data_type = get_storage_dtype(data_type)
+    # TODO: Uncomment this to properly turn 0 & 1 chunking into True
+#    if 0 in cD or 1 in cD:
+#        cD = True
+    written = [False] * len(work)
+    done = 0 # Everything before this index has been written
+    try:
+        with brick_lock(brick_path), h5py.File(brick_path, 'a') as f:
+            # TODO: Due to usage concerns, currently locking chunking to "auto"
+            ds = f.require_dataset(brick_key, shape=tuple(bD), dtype=data_type, chunks=None, fillvalue=fill_value)
+            if binary:
+                writes = _unmerged(work)
+            else:
+                writes = merge_brick_work(work, ds.shape, ds.dtype)
+
+            log.debug('Writing %s work items to %s in %s writes', len(work), brick_key, len(writes))
+            for brick_slice, value, indices in writes:
+                log.trace('slice_=%s, value=%s', brick_slice, value)
+                if binary:
+                    write_binary_values(ds, list(brick_slice)[0], value)
+                else:
+                    ds[tuple(brick_slice)] = value
+
+                for i in indices:
+                    written[i] = True
+                while done < len(work) and written[done]:
+                    done += 1
+    finally:
+        # Anything after the first unwritten item is redone - rewriting in order is harmless
+        del work[:done]
+
 def run_worker(req_port, resp_port):
     worker = BrickWriterWorker(req_port, resp_port)
     worker.start()
@@ -149,6 +282,8 @@ def main(args=None):
 
     # Waits until the glet is finshed
     g.join()
+    # Closing flushes the last response (i.e. the ACK)
+    worker.stop()
     return 0
 
 
@@ -38,12 +38,15 @@ from pyon.util.async import spawn
 
 from coverage_model.basic_types import AbstractIdentifiable, AxisTypeEnum, MutabilityEnum, VariabilityEnum, get_valid_DomainOfApplication, Dictable, InMemoryStorage, Span
 from coverage_model.parameter import Parameter, ParameterDictionary, ParameterContext
-from coverage_model.parameter_values import get_value_class, AbstractParameterValue
+from coverage_model.parameter_values import get_value_class, AbstractParameterValue, ParameterFunctionValue
+from coverage_model.parameter_functions import EvaluationPlan
 from coverage_model.persistence import PersistenceLayer, InMemoryPersistenceLayer, SimplePersistenceLayer
+from coverage_model.metrics import timed
+from coverage_model.value_cache import ValueCache, CoverageValueCache, DEFAULT_MAX_BYTES
 from coverage_model import utils
 from copy import deepcopy
 import numpy as np
-import os, collections, pickle
+import os, collections, functools, pickle
 
 #=========================
 # Coverage Objects
@@ -56,7 +59,9 @@ class AbstractCoverage(AbstractIdentifiable):
     SpatialTopology
     """
 
-    VALUE_CACHE_LIMIT = 30
+    VALUE_CACHE_MAX_BYTES = DEFAULT_MAX_BYTES
+    # Default number of temporal indices parameter functions are evaluated over at a time; None evaluates in one shot
+    FUNCTION_CHUNK_SIZE = None
 
     def __init__(self, mode=None):
         AbstractIdentifiable.__init__(self)
@@ -64,8 +69,13 @@ class AbstractCoverage(AbstractIdentifiable):
         self._range_dictionary = ParameterDictionary()
         self._range_value = RangeValues()
         self.value_caching = True
-        self._value_cache = collections.OrderedDict()
+        self._value_cache = ValueCache(self.VALUE_CACHE_MAX_BYTES)
+        self._value_cache_signatures = {} # {param_name: brick signatures as of the last refresh}
+        self._function_inputs = {} # {param_name: (parameters read, elementwise)} for parameter functions
+        self._materialized_params = None # Names of the materialized parameter functions, once determined
         self._bricking_scheme = {'brick_size': 100000, 'chunk_size': 100000}
+        self._function_chunk_size = self.FUNCTION_CHUNK_SIZE
+        self._function_executor = None
 
         self.temporal_domain = GridDomain(GridShape('temporal',[0]), CRS.standard_temporal(), MutabilityEnum.EXTENSIBLE)
         self.spatial_domain = None
@@ -177,6 +187,7 @@ class AbstractCoverage(AbstractIdentifiable):
 
         return tuple(s)
 
+    @timed('coverage.insert_timesteps')
     def insert_timesteps(self, count, origin=None, oob=True):
         """
         Insert count # of timesteps beginning at the origin
@@ -302,6 +313,15 @@ class AbstractCoverage(AbstractIdentifiable):
         self._range_dictionary.add_context(pcontext)
         s = self._persistence_layer.init_parameter(pcontext, self._bricking_scheme)
         self._range_value[pname] = get_value_class(param_type=pcontext.param_type, domain_set=pcontext.dom, storage=s)
+        self._setup_function_value(pname, self._range_value[pname])
+        # The new parameter may be one that existing parameter functions read
+        for pn in self._range_dictionary:
+            if self._range_dictionary.is_loaded(pn):
+                ptype = self._range_dictionary.get_context(pn).param_type
+                if hasattr(ptype, 'clear_dependency_cache'):
+                    ptype.clear_dependency_cache()
+        self._function_inputs = {}
+        self._materialized_params = None
 
     def get_parameter(self, param_name):
         """
@@ -361,43 +381,148 @@ class AbstractCoverage(AbstractIdentifiable):
         if return_value is not None:
             log.warn('Provided \'return_value\' will be OVERWRITTEN')
 
+        slice_, total_shape = self._get_value_slice(tdoa, sdoa)
+
+        # If this coverage is empty - return an empty array
+        if slice_ is None:
+            return np.empty(0, dtype=self._range_value[param_name].value_encoding)
+
+        if self.mode == 'r' and param_name not in self._value_cache_signatures:
+            self._set_value_cache_baseline(param_name)
+
+        if self._caches_values(param_name):
+            # Make slice_ fully expressed such that there are no "None" entries - this lets us ignore domain growth
+            slk = utils.express_slice(slice_, total_shape)
+            return_value = self._value_cache.get(param_name, slk)
+            if return_value is None:
+                # Values written while these are read must not be masked by caching them
+                generation = self._value_cache.generation(param_name)
+                return_value = self._range_value[param_name][slice_]
+                self._value_cache.put(param_name, slk, return_value, generation)
+        else:
+            return_value = self._range_value[param_name][slice_]
+
+        return return_value
+
+    def iter_parameter_values(self, param_name, tdoa=None, sdoa=None, chunk_size=None):
+        """
+        Retrieve the value for a parameter a temporal chunk at a time
+
+        Chunks are aligned to brick boundaries, so only the bricks of one chunk are read at once
+
+        @param param_name   The name of the parameter
+        @param tdoa The temporal DomainOfApplication; may select a single temporal slice
+        @param sdoa The spatial DomainOfApplication
+        @param chunk_size   The number of temporal indices per chunk; defaults to function_chunk_size, or the brick size
+        @return A generator of (temporal slice, values) tuples
+        @throws KeyError    The coverage does not contain a parameter with name 'param_name'
+        """
+        if not param_name in self._range_value:
+            raise KeyError('Parameter \'{0}\' not found in coverage'.format(param_name))
+
+        slice_, total_shape = self._get_value_slice(tdoa, sdoa)
+        if slice_ is None:
+            return
+
+        if not isinstance(slice_[0], slice):
+            raise ValueError('\'tdoa\' must select a single temporal slice')
+
+        brick_size = self._bricking_scheme['brick_size']
+        chunk_size = chunk_size or self.function_chunk_size or brick_size
+        for c in utils.chunk_slice(slice_[0], total_shape[0], chunk_size, brick_size):
+            yield c, self.get_parameter_values(param_name, tdoa=c, sdoa=sdoa)
+
+    def _get_value_slice(self, tdoa, sdoa):
+        # Returns (the slice selected by the DomainOfApplications, the total shape) - the slice is None if the coverage
+        # is empty
         slice_ = []
 
-        total_shape = self.temporal_domain.shape.extents
+        total_shape = tuple(self.temporal_domain.shape.extents)
         tdoa = get_valid_DomainOfApplication(tdoa, total_shape)
         log.debug('Temporal doa: %s', tdoa.slices)
         slice_.extend(tdoa.slices)
 
         if self.spatial_domain is not None:
-            total_shape += self.spatial_domain.shape.extents
+            total_shape += tuple(self.spatial_domain.shape.extents)
             sdoa = get_valid_DomainOfApplication(sdoa, total_shape[1:])
             log.debug('Spatial doa: %s', sdoa.slices)
             slice_.extend(sdoa.slices)
 
-        # If this coverage is empty - return an empty array
         if np.atleast_1d(np.atleast_1d(total_shape) == 0).all():
-            return np.empty(0, dtype=self._range_value[param_name].value_encoding)
+            return None, total_shape
 
         slice_ = utils.fix_slice(slice_, total_shape)
         log.debug('Getting slice: %s', slice_)
 
+        return slice_, total_shape
+
+    def get_multi_parameter_values(self, param_names, tdoa=None, sdoa=None):
+        """
+        Retrieve the values of several parameters over the same domain
+
+        The parameter functions among them are evaluated together (see EvaluationPlan), so the inputs and functions they
+        share are fetched or evaluated only once, and those independent of one another concurrently when there is a
+        function_executor
+
+        @param param_names  An iterable of parameter names
+        @param tdoa The temporal DomainOfApplication
+        @param sdoa The spatial DomainOfApplication
+        @return A dict of {param_name: value}
+        @throws KeyError    The coverage does not contain a parameter in param_names
+        """
+        if self.closed:
+            raise IOError('I/O operation on closed file')
+
+        for param_name in param_names:
+            if not param_name in self._range_value:
+                raise KeyError('Parameter \'{0}\' not found in coverage'.format(param_name))
+
+        slice_, total_shape = self._get_value_slice(tdoa, sdoa)
+
+        ret = {}
+        functions = []
+        for param_name in param_names:
+            if slice_ is not None and self._get_function_value(param_name) is not None:
+                ret[param_name] = None
+                if self._caches_values(param_name):
+                    if self.mode == 'r' and param_name not in self._value_cache_signatures:
+                        self._set_value_cache_baseline(param_name)
+                    ret[param_name] = self._value_cache.get(param_name, utils.express_slice(slice_, total_shape))
+                if ret[param_name] is None:
+                    functions.append(param_name)
+            else:
+                ret[param_name] = self.get_parameter_values(param_name, tdoa, sdoa)
+
+        if functions:
+            generations = dict((p, self._value_cache.generation(p)) for p in functions)
+            plan = EvaluationPlan(functions, self._get_function_value)
+            values = plan.evaluate(self.get_parameter_values, slice_, self.function_executor)
+            for param_name in functions:
+                ret[param_name] = values[param_name]
+                if self._caches_values(param_name):
+                    self._value_cache.put(param_name, utils.express_slice(slice_, total_shape), values[param_name], generations[param_name])
+
+        return ret
+
+    def _caches_values(self, param_name):
+        # Values of parameter functions are cached (i.e. memoized) even when value_caching is off: writes through this
+        # coverage invalidate them along with the parameters they read.  A read-only coverage only sees the writes of
+        # others on refresh() while it always reads its inputs afresh, so it honors value_caching for them too
         if self.value_caching:
-            # Make slice_ fully expressed such that there are no "None" entries - this lets us ignore domain growth
-            slk = utils.express_slice(slice_, total_shape)
-            key = (param_name, utils.hash_any(slk))
-            try:
-                return_value = self._value_cache.pop(key)
-            except KeyError:
-                return_value = self._range_value[param_name][slice_]
-                if len(self._value_cache) >= self.VALUE_CACHE_LIMIT:
-                    k, v = self._value_cache.popitem(0)
-                    v = None
-                    del k, v
-            self._value_cache[key] = return_value
-        else:
-            return_value = self._range_value[param_name][slice_]
+            return True
 
-        return return_value
+        return self.mode != 'r' and self._get_function_value(param_name) is not None
+
+    def _get_function_value(self, param_name):
+        # The ParameterFunctionValue of param_name, or None if it is not an evaluable parameter function - materialized
+        # ones are read like any other parameter
+        if param_name in self._range_value:
+            pv = self._range_value[param_name]
+            if isinstance(pv, ParameterFunctionValue) and pv._memoized_values is None and pv._pval_callback is not None \
+                    and pv._ranges_callback is None:
+                return pv
+
+        return None
 
     def set_time_values(self, value, tdoa=None):
         """
@@ -426,10 +551,111 @@ class AbstractCoverage(AbstractIdentifiable):
         return self.temporal_domain.shape.extents[0]
 
     def _clear_value_cache_for_parameter(self, param_name):
-        for k in self._value_cache.keys():
-            if k[0] == param_name:
-                self._value_cache.pop(k)
+        self._value_cache.invalidate(param_name)
 
+    def _get_function_inputs(self, param_name):
+        """
+        Returns the parameters a parameter function reads, including through the parameter functions it reads
+
+        @param param_name   The name of a ParameterFunctionType parameter
+        @return A tuple of (set of parameter names or None if any parameter may be read, True if each value depends
+        only on the values of its inputs at the same index)
+        """
+        if param_name not in self._function_inputs:
+            params, elementwise = set(), True
+            stack, seen = [param_name], set([param_name])
+            while stack:
+                p, e = self._range_value[stack.pop()].content.get_parameter_inputs()
+                elementwise = elementwise and e
+                if p is None:
+                    params = None
+                    break
+                for a in p:
+                    params.add(a)
+                    if a not in seen and a in self._range_value and isinstance(self._range_value[a], ParameterFunctionValue):
+                        seen.add(a)
+                        stack.append(a)
+
+            self._function_inputs[param_name] = (params, elementwise and params is not None)
+
+        return self._function_inputs[param_name]
+
+    def _is_function_elementwise(self, param_name):
+        return self._get_function_inputs(param_name)[1]
+
+    def _setup_function_value(self, param_name, pv):
+        if isinstance(pv, ParameterFunctionValue):
+            pv._elementwise_callback = functools.partial(self._is_function_elementwise, param_name)
+            pv._chunk_alignment = self._bricking_scheme['brick_size']
+            pv.chunk_size = self.function_chunk_size
+            pv.executor = self.function_executor
+            if pv.materialized and not isinstance(self._persistence_layer, SimplePersistenceLayer):
+                pv._ranges_callback = functools.partial(self._persistence_layer.get_materialized_ranges, param_name)
+                if self.mode != 'r':
+                    pv._set_ranges_callback = functools.partial(self._persistence_layer.set_materialized_ranges, param_name)
+
+    def _set_function_values_attr(self, attr, value):
+        # Values not yet loaded pick it up when they are
+        for p in self._range_value:
+            if self._range_value.is_loaded(p) and isinstance(self._range_value[p], ParameterFunctionValue):
+                setattr(self._range_value[p], attr, value)
+
+    @property
+    def function_chunk_size(self):
+        """
+        The number of temporal indices element-wise parameter functions are evaluated over at a time
+
+        Chunks are aligned to brick boundaries, so a value of at least the brick size is best; None evaluates each
+        request in one shot
+        """
+        return getattr(self, '_function_chunk_size', self.FUNCTION_CHUNK_SIZE)
+
+    @function_chunk_size.setter
+    def function_chunk_size(self, value):
+        self._function_chunk_size = value
+        self._set_function_values_attr('chunk_size', value)
+
+    @property
+    def function_executor(self):
+        """
+        A FunctionExecutor parameter functions are evaluated on, or None to evaluate them serially in the caller
+
+        Chunks of one function (see function_chunk_size), and functions requested together that do not depend on one
+        another (see get_multi_parameter_values), are evaluated concurrently.  The executor is not shut down with the
+        coverage.
+        """
+        return getattr(self, '_function_executor', None)
+
+    @function_executor.setter
+    def function_executor(self, value):
+        self._function_executor = value
+        self._set_function_values_attr('executor', value)
+
+    def _invalidate_value_cache(self, param_name, slice_):
+        # Drop the cached values of param_name that overlap slice_, and those of the parameter functions that read it
+        if len(self._value_cache) == 0:
+            # Nothing to drop - just advance the write generation
+            self._value_cache.invalidate(param_name)
+            return
+
+        total_shape = tuple(self.temporal_domain.shape.extents)
+        if self.spatial_domain is not None:
+            total_shape += tuple(self.spatial_domain.shape.extents)
+        try:
+            slk = utils.express_slice(slice_, total_shape)
+        except (IndexError, SystemError):
+            # Not a slice of the current domain - drop everything
+            slk = None
+
+        self._value_cache.invalidate(param_name, slk)
+        for p in self._value_cache.parameters():
+            if p != param_name and isinstance(self._range_value[p], ParameterFunctionValue):
+                params, elementwise = self._get_function_inputs(p)
+                if params is None or param_name in params:
+                    # Values of element-wise functions only change where their inputs did
+                    self._value_cache.invalidate(p, slk if elementwise else None)
+
+    @timed('coverage.set_parameter_values')
     def set_parameter_values(self, param_name, value, tdoa=None, sdoa=None):
         """
         Assign value to the specified parameter
@@ -469,13 +695,93 @@ class AbstractCoverage(AbstractIdentifiable):
         # Update parameter bounds in the persistence layer
         self._persistence_layer.update_parameter_bounds(param_name, self._range_value[param_name].bounds)
 
-        # Clear any cached values for this parameter
-        self._clear_value_cache_for_parameter(param_name)
+        # Clear the cached values affected by the write
+        self._invalidate_value_cache(param_name, slice_)
+        self._invalidate_materialized(param_name, slice_)
+
+    def materialize(self, param_names=None):
+        """
+        Evaluate and store the values of materialized parameter functions that are missing or stale
+
+        Values are otherwise materialized when first read
+
+        @param param_names  An iterable of parameter names; defaults to all the materialized parameter functions
+        @return A dict of {param_name: list of the temporal [start, stop] ranges evaluated}
+        @throws TypeError   A parameter is not a materialized parameter function
+        """
+        if self.closed:
+            raise IOError('I/O operation on closed file')
+
+        if self.mode == 'r':
+            raise IOError('Coverage not open for writing: mode == \'{0}\''.format(self.mode))
+
+        if param_names is None:
+            param_names = self._get_materialized_parameters()
+
+        ret = {}
+        for param_name in param_names:
+            pv = self._range_value[param_name]
+            if not isinstance(pv, ParameterFunctionValue) or pv._set_ranges_callback is None:
+                raise TypeError('\'{0}\' is not a materialized parameter function'.format(param_name))
+            ret[param_name] = pv.materialize()
+
+        return ret
+
+    def _get_materialized_parameters(self):
+        if self._materialized_params is None:
+            self._materialized_params = [p for p in self.list_parameters()
+                                         if isinstance(self._range_value[p], ParameterFunctionValue) and self._range_value[p].materialized]
+
+        return self._materialized_params
+
+    def _invalidate_materialized(self, param_name, slice_):
+        # The stored values of the materialized parameter functions that read param_name are stale where it was written
+        bounds = None
+        for p in self._get_materialized_parameters():
+            ranges = self._persistence_layer.get_materialized_ranges(p)
+            if p == param_name or not ranges:
+                continue
+
+            params, elementwise = self._get_function_inputs(p)
+            if params is not None and param_name not in params:
+                continue
+
+            if bounds is None:
+                total_shape = tuple(self.temporal_domain.shape.extents)
+                if self.spatial_domain is not None:
+                    total_shape += tuple(self.spatial_domain.shape.extents)
+                bounds = utils.index_bounds(utils.express_slice(slice_, total_shape)[0]) or (0, total_shape[0])
+
+            # Values of functions that are not element-wise may depend on any index
+            start, stop = bounds if elementwise else (0, self.num_timesteps)
+            self._persistence_layer.set_materialized_ranges(p, utils.remove_range(ranges, start, stop))
 
     def clear_value_cache(self):
-        if self.value_caching:
+        # Values of parameter functions are cached even when value_caching is off, unless the coverage is read-only
+        if self.value_caching or self.mode != 'r':
             self._value_cache.clear()
 
+    @property
+    def value_cache_max_bytes(self):
+        """
+        The number of bytes of values the value cache holds before evicting the least recently used
+        """
+        return self._value_cache.max_bytes
+
+    @value_cache_max_bytes.setter
+    def value_cache_max_bytes(self, value):
+        self._value_cache.resize(value)
+
+    def get_value_cache_stats(self):
+        """
+        Returns a dict of value cache statistics - see ValueCache.get_stats
+        """
+        return self._value_cache.get_stats()
+
+    def _set_value_cache_baseline(self, param_name):
+        # Record the state of the data behind cached values of param_name, for use by refresh - not tracked by default
+        pass
+
     def get_parameter_context(self, param_name):
         """
         Retrieve a deepcopy of the ParameterContext object for the specified parameter
@@ -794,6 +1100,9 @@ class AbstractCoverage(AbstractIdentifiable):
             if hasattr(self, '_persistence_layer'):
                 self._persistence_layer.close(force=force, timeout=timeout) # Calls flush() on the persistence layer
 
+            if isinstance(self._value_cache, CoverageValueCache):
+                self._value_cache.release()
+
             # Not much else to do here at this point....but can add other things down the road
 
         self._closed = True
@@ -975,7 +1284,8 @@ class ViewCoverage(AbstractCoverage):
         self._range_value = RangeValues()
         self._persistence_layer.rcov_loc = path
 
-        self.clear_value_cache()
+        # Share the cached values of the new reference_coverage
+        self._value_cache = self.reference_coverage._value_cache
 
         if use_current_param_dict:
             parameter_dictionary = self._persistence_layer.param_dict
@@ -1498,7 +1808,7 @@ class SimplexCoverage(AbstractCoverage):
 
     """
 
-    def __init__(self, root_dir, persistence_guid, name=None, parameter_dictionary=None, temporal_domain=None, spatial_domain=None, mode=None, in_memory_storage=False, bricking_scheme=None, inline_data_writes=True, auto_flush_values=True, value_caching=True):
+    def __init__(self, root_dir, persistence_guid, name=None, parameter_dictionary=None, temporal_domain=None, spatial_domain=None, mode=None, in_memory_storage=False, bricking_scheme=None, inline_data_writes=True, auto_flush_values=True, value_caching=True, metadata_snapshot=False, writer_backend='zmq', writer_options=None):
         """
         Constructor for SimplexCoverage
 
@@ -1513,7 +1823,10 @@ class SimplexCoverage(AbstractCoverage):
         @param bricking_scheme  the bricking scheme for the coverage; a dict of the form {'brick_size': #, 'chunk_size': #}
         @param inline_data_writes   if True (default), brick data is written as it is set; otherwise it is written out-of-band by worker processes or threads
         @param auto_flush_values    if True (default), brick data is flushed immediately; otherwise it is buffered until SimplexCoverage.flush_values() is called
-        @param value_caching  if True (default), up to 30 value requests are cached for rapid duplicate retrieval
+        @param value_caching  if True (default), value requests are cached (up to VALUE_CACHE_MAX_BYTES, and within the budget of the process-wide SharedValueCache shared by every instance of the coverage) for rapid retrieval of the same or contained slices; values of parameter functions are cached regardless, unless the coverage is opened read-only
+        @param metadata_snapshot    if True, a consolidated metadata snapshot is written on close so the coverage opens faster; defaults to False
+        @param writer_backend   the backend for out-of-band writes; 'zmq' (default) for worker processes or 'thread' for in-process threads
+        @param writer_options   keyword arguments for the out-of-band writer, i.e. max_pending_items, max_pending_bytes and overflow_policy ('block', 'raise' or 'spill')
         """
         AbstractCoverage.__init__(self, mode=mode)
         try:
@@ -1531,7 +1844,7 @@ class SimplexCoverage(AbstractCoverage):
                     raise SystemError('Cannot find specified coverage: {0}'.format(pth))
 
                 # All appears well - load it up!
-                self._persistence_layer = PersistenceLayer(root_dir, persistence_guid, mode=self.mode)
+                self._persistence_layer = PersistenceLayer(root_dir, persistence_guid, mode=self.mode, writer_options=writer_options)
 
                 self.name = self._persistence_layer.name
                 self.spatial_domain = self._persistence_layer.sdom
@@ -1541,33 +1854,23 @@ class SimplexCoverage(AbstractCoverage):
 
                 self._in_memory_storage = False
 
-                auto_flush_values = self._persistence_layer.auto_flush_values
-                inline_data_writes = self._persistence_layer.inline_data_writes
                 self.value_caching = self._persistence_layer.value_caching
 
-                from coverage_model.persistence import PersistedStorage, SparsePersistedStorage
+                self._auto_flush_values = self._persistence_layer.auto_flush_values
+                self._inline_data_writes = self._persistence_layer.inline_data_writes
+
+                # Parameters are registered by name only - their contexts and values are built on first access
+                tpn = self.temporal_domain.crs.axes.get(AxisTypeEnum.TIME) if self.temporal_domain is not None else None
                 for parameter_name in self._persistence_layer.parameter_metadata:
-                    md = self._persistence_layer.parameter_metadata[parameter_name]
-                    mm = self._persistence_layer.master_manager
-                    pc = md.parameter_context
-
-                    # Assign the coverage's domain object(s)
-                    self._assign_domain(pc)
-
-                    # Get the callbacks for ParameterFunctionType parameters
-                    if hasattr(pc, '_pval_callback'):
-                        pc._pval_callback = self.get_parameter_values
-                        pc._pctxt_callback = self.get_parameter_context
-                    self._range_dictionary.add_context(pc)
-                    if pc.param_type._value_class == 'SparseConstantValue':
-                        s = SparsePersistedStorage(md, mm, self._persistence_layer.brick_dispatcher, dtype=pc.param_type.storage_encoding, fill_value=pc.param_type.fill_value, mode=self.mode, inline_data_writes=inline_data_writes, auto_flush=auto_flush_values)
-                    else:
-                        s = PersistedStorage(md, mm, self._persistence_layer.brick_dispatcher, dtype=pc.param_type.storage_encoding, fill_value=pc.param_type.fill_value, mode=self.mode, inline_data_writes=inline_data_writes, auto_flush=auto_flush_values)
-                    self._range_value[parameter_name] = get_value_class(param_type=pc.param_type, domain_set=pc.dom, storage=s)
-                    if parameter_name in self._persistence_layer.parameter_bounds:
-                        bmin, bmax = self._persistence_layer.parameter_bounds[parameter_name]
-                        self._range_value[parameter_name]._min = bmin
-                        self._range_value[parameter_name]._max = bmax
+                    self._range_dictionary.add_deferred_context(parameter_name, self._load_parameter_context, is_temporal=parameter_name == tpn)
+                    self._range_value.add_deferred_value(parameter_name, self._load_parameter_value)
+
+                if tpn not in self._persistence_layer.parameter_metadata:
+                    # The temporal parameter cannot be identified from the domain - fall back to loading everything
+                    self._range_dictionary.temporal_parameter_name = None
+                    for o, pc in self._range_dictionary.itervalues():
+                        if pc.axis == AxisTypeEnum.TIME:
+                            self._range_dictionary.temporal_parameter_name = pc.name
 
             # TODO: Why do this, just see if the directory is there no?
             # if name is None or parameter_dictionary is None:
@@ -1623,9 +1926,6 @@ class SimplexCoverage(AbstractCoverage):
 
                 self.value_caching = value_caching
 
-                # LOCK inline_data_writes to True
-                inline_data_writes = True
-
                 self._in_memory_storage = in_memory_storage
                 if self._in_memory_storage:
                     self._persistence_layer = InMemoryPersistenceLayer()
@@ -1640,6 +1940,9 @@ class SimplexCoverage(AbstractCoverage):
                                                                inline_data_writes=inline_data_writes,
                                                                auto_flush_values=auto_flush_values,
                                                                value_caching=value_caching,
+                                                               metadata_snapshot=metadata_snapshot,
+                                                               writer_backend=writer_backend,
+                                                               writer_options=writer_options,
                                                                coverage_type='simplex')
 
                 for o, pc in parameter_dictionary.itervalues():
@@ -1648,11 +1951,115 @@ class SimplexCoverage(AbstractCoverage):
                 if insert_ts != 0:
                     self.insert_timesteps(insert_ts)
 
+            if not self._in_memory_storage:
+                self._setup_shared_value_cache()
+
             self._head_coverage_path = self.persistence_dir
         except:
             self._closed = True
             raise
 
+    def _setup_shared_value_cache(self):
+        # Share cached values with every other instance of this coverage in the process
+        dirty_check = None if self.mode == 'r' else self._persistence_layer.has_dirty_values
+        self._value_cache = CoverageValueCache(self.persistence_dir, self._value_cache.max_bytes, dirty_check)
+        self._value_cache_signatures = self._value_cache.signatures
+        if self.mode == 'r' and len(self._value_cache) > 0:
+            # Values cached by other instances may predate changes made out of this process
+            self._refresh_value_cache()
+
+    def _load_parameter_context(self, parameter_name):
+        pc = self._persistence_layer.parameter_metadata[parameter_name].parameter_context
+
+        # Assign the coverage's domain object(s)
+        self._assign_domain(pc)
+
+        # Get the callbacks for ParameterFunctionType parameters
+        if hasattr(pc, '_pval_callback'):
+            pc._pval_callback = self.get_parameter_values
+            pc._pctxt_callback = self.get_parameter_context
+
+        return pc
+
+    def _load_parameter_value(self, parameter_name):
+        from coverage_model.persistence import PersistedStorage, SparsePersistedStorage
+        pc = self._range_dictionary.get_context(parameter_name)
+        md = self._persistence_layer.parameter_metadata[parameter_name]
+        mm = self._persistence_layer.master_manager
+        if pc.param_type._value_class == 'SparseConstantValue':
+            s = SparsePersistedStorage(md, mm, self._persistence_layer.brick_dispatcher, dtype=pc.param_type.storage_encoding, fill_value=pc.param_type.fill_value, mode=self.mode, inline_data_writes=self._inline_data_writes, auto_flush=self._auto_flush_values)
+        else:
+            s = PersistedStorage(md, mm, self._persistence_layer.brick_dispatcher, dtype=pc.param_type.storage_encoding, fill_value=pc.param_type.fill_value, mode=self.mode, inline_data_writes=self._inline_data_writes, auto_flush=self._auto_flush_values)
+        pv = get_value_class(param_type=pc.param_type, domain_set=pc.dom, storage=s)
+        if parameter_name in self._persistence_layer.parameter_bounds:
+            pv._min, pv._max = self._persistence_layer.parameter_bounds[parameter_name]
+        self._setup_function_value(parameter_name, pv)
+
+        return pv
+
+    def refresh(self):
+        """
+        Brings the coverage up to date with changes written to it since it was opened
+
+        Coverages opened read-only are refreshed incrementally: nothing is reloaded unless the master file has
+        changed, new bricks, new parameters and the domains are merged into the existing objects and cached values
+        are kept unless the bricks of their parameter have changed.  Other coverages are reloaded entirely.
+        """
+        if self.mode != 'r' or self._in_memory_storage:
+            return AbstractCoverage.refresh(self)
+
+        if self.closed:
+            raise IOError('I/O operation on closed file')
+
+        changed, new_params = self._persistence_layer.refresh()
+        if changed:
+            log.debug('Refreshed coverage metadata: %s', changed)
+
+        tpn = self.temporal_parameter_name
+        for parameter_name in new_params:
+            self._range_dictionary.add_deferred_context(parameter_name, self._load_parameter_context, is_temporal=parameter_name == tpn)
+            self._range_value.add_deferred_value(parameter_name, self._load_parameter_value)
+
+        if 'parameter_bounds' in changed:
+            for parameter_name, bounds in self._persistence_layer.parameter_bounds.iteritems():
+                if self._range_value.is_loaded(parameter_name):
+                    self._range_value[parameter_name]._min, self._range_value[parameter_name]._max = bounds
+
+        self._refresh_value_cache()
+
+    def _set_value_cache_baseline(self, param_name):
+        if self._in_memory_storage:
+            return
+
+        # Parameter functions depend on other parameters - any of them changing could alter their values
+        if isinstance(self._range_value[param_name], ParameterFunctionValue):
+            names = self.list_parameters()
+        else:
+            names = [param_name]
+
+        for p in names:
+            if p not in self._value_cache_signatures:
+                self._value_cache_signatures[p] = self._persistence_layer.get_brick_signatures(p)
+
+    def _refresh_value_cache(self):
+        # Cached slices are fully expressed, so entries stay valid as the domain grows - only changes to the bricks of a
+        # parameter (as of its first cached value) invalidate them.  Values cached by a writable instance in this process
+        # have no baseline - the writer invalidates them itself
+        cached = set(self._value_cache.parameters())
+        functions = set(p for p in cached if isinstance(self._range_value[p], ParameterFunctionValue))
+        check = self.list_parameters() if functions else cached
+
+        sigs = dict((p, self._persistence_layer.get_brick_signatures(p)) for p in check)
+        modified = set(p for p in sigs if p in self._value_cache_signatures and self._value_cache_signatures[p] != sigs[p])
+
+        for p in cached | modified:
+            if p in modified or (p in functions and modified):
+                self._clear_value_cache_for_parameter(p)
+
+        # Updated in place - the signatures are shared by every instance of the coverage
+        self._value_cache_signatures.clear()
+        self._value_cache_signatures.update(sigs)
+
     @classmethod
     def _fromdict(cls, cmdict, arg_masks=None):
         return super(SimplexCoverage, cls)._fromdict(cmdict, {'parameter_dictionary': '_range_dictionary'})
@@ -1671,27 +2078,59 @@ class RangeValues(Dictable):
 
     def __init__(self):
         Dictable.__init__(self)
+        self._deferred = {}
+
+    def add_deferred_value(self, key, loader):
+        """
+        Register a value object that is not constructed until it is first requested
+
+        @param key  The name of the parameter
+        @param loader   A callable accepting 'key' and returning an AbstractParameterValue
+        """
+        self._deferred[key] = loader
+
+    def __getattr__(self, item):
+        # Only called when normal attribute lookup fails - build a deferred value on first access
+        if item in self.__dict__.get('_deferred', {}):
+            return self[item]
+
+        raise AttributeError('\'{0}\' object has no attribute \'{1}\''.format(self.__class__.__name__, item))
 
     def __getitem__(self, item):
+        if item in self._deferred:
+            self[item] = self._deferred[item](item)
+
         return getattr(self, item)
 
     def __setitem__(self, key, value):
         if not isinstance(value, AbstractParameterValue):
             raise TypeError('Can only assign objects inheriting from AbstractParameterValue')
 
+        self._deferred.pop(key, None)
         setattr(self, key, value)
 
+    def is_loaded(self, key):
+        """
+        Indicates if the value object for a parameter has been constructed
+
+        @param key  The name of the parameter
+        """
+        return key not in self._deferred and key in self
+
     def __delitem__(self, key):
-        delattr(self, key)
+        if key in self._deferred:
+            del self._deferred[key]
+        else:
+            delattr(self, key)
 
     def __contains__(self, item):
-        return hasattr(self, item)
+        return item in self._deferred or hasattr(self, item)
 
     def __iter__(self):
-        return self.__dict__.__iter__()
+        return self.__dir__().__iter__()
 
     def __dir__(self):
-        return self.__dict__.keys()
+        return [k for k in self.__dict__ if k != '_deferred'] + self._deferred.keys()
 
 class RangeDictionary(AbstractIdentifiable):
     """
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+@package coverage_model.metrics
+@file coverage_model/metrics.py
+@brief Lightweight runtime metrics for the coverage model
+"""
+
+from ooi.logging import log
+import functools
+import bisect
+import socket
+import time
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies (in seconds) with logarithmically spaced buckets
+
+    Bucket i counts latencies up to min_latency * 2**i; the last bucket counts everything larger
+    """
+
+    def __init__(self, min_latency=0.0001, num_buckets=20):
+        self.bounds = [min_latency * 2 ** i for i in xrange(num_buckets - 1)]
+        self.counts = [0] * num_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        self.counts[bisect.bisect_left(self.bounds, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        """
+        Returns the upper bound of the bucket containing the given percentile (or the max, for the last bucket)
+
+        @param pct  The percentile; 0 - 100
+        """
+        if self.count == 0:
+            return 0.0
+
+        target = self.count * pct / 100.0
+        cum = 0
+        for i, c in enumerate(self.counts):
+            cum += c
+            if cum >= target and c > 0:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.mean,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': zip(self.bounds + [float('inf')], self.counts)}
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    __slots__ = ('telemetry', 'name', 'start')
+
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.telemetry.record(self.name, time.time() - self.start)
+        return False
+
+
+class Telemetry(object):
+    """
+    Named counters and latency histograms
+
+    Everything is a no-op until enable() is called, so instrumented code pays next to nothing when it is disabled
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.latencies = {}
+        self._emitter = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def incr(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, latency):
+        if self.enabled:
+            if name not in self.latencies:
+                self.latencies[name] = LatencyHistogram()
+            self.latencies[name].record(latency)
+
+    def timer(self, name):
+        """
+        Returns a context manager that records the time spent in its block as a latency for name
+        """
+        return _Timer(self, name) if self.enabled else _NULL_TIMER
+
+    def snapshot(self):
+        """
+        Returns a dict of {'counters': {name: value}, 'latencies': {name: LatencyHistogram.as_dict()}}
+        """
+        return {'counters': dict(self.counters),
+                'latencies': dict((k, v.as_dict()) for k, v in self.latencies.iteritems())}
+
+    def reset(self):
+        self.counters = {}
+        self.latencies = {}
+
+    def start_emitter(self, interval=60, sink=None):
+        """
+        Periodically pass a snapshot to sink
+
+        @param interval The number of seconds between snapshots
+        @param sink A callable taking a snapshot; defaults to log_sink
+        """
+        from pyon.util.async import spawn
+        import gevent
+        self.stop_emitter()
+        sink = sink or log_sink
+
+        def emit():
+            while True:
+                gevent.sleep(interval)
+                try:
+                    sink(self.snapshot())
+                except Exception:
+                    log.exception('Telemetry sink failed')
+
+        self._emitter = spawn(emit)
+
+    def stop_emitter(self):
+        if self._emitter is not None:
+            self._emitter.kill()
+            self._emitter = None
+
+
+def log_sink(snapshot):
+    log.info('Telemetry: %s', snapshot)
+
+def statsd_sink(host='localhost', port=8125, prefix='coverage_model'):
+    """
+    Returns a sink that sends snapshots to a statsd server over UDP
+
+    Counters are sent as the change since the previous snapshot; latencies as p50/p99/max gauges in milliseconds
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    last = {}
+
+    def sink(snapshot):
+        lines = []
+        for k, v in snapshot['counters'].iteritems():
+            lines.append('{0}.{1}:{2}|c'.format(prefix, k, v - last.get(k, 0)))
+            last[k] = v
+        for k, v in snapshot['latencies'].iteritems():
+            for stat in ('p50', 'p99', 'max'):
+                lines.append('{0}.{1}.{2}:{3:.3f}|g'.format(prefix, k, stat, v[stat] * 1000))
+        if lines:
+            sock.sendto('\n'.join(lines), (host, port))
+
+    return sink
+
+
+_telemetry = Telemetry()
+
+def get_telemetry():
+    """
+    Returns the process-wide Telemetry
+    """
+    return _telemetry
+
+def timed(name):
+    """
+    Decorator recording the time spent in each call as a latency for name in the process-wide Telemetry
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _telemetry.enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _telemetry.record(name, time.time() - start)
+        return wrapper
+    return decorator
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+@package coverage_model.migration
+@file coverage_model/migration.py
+@brief Functions for converting coverages written with the legacy escaped-string encoding to binary storage
+"""
+
+from ooi.logging import log
+from coverage_model.persistence_helpers import unescape, unpack_raw, is_binary_vlen, MAX_BINARY_ATTR_SIZE, BINARY_VLEN_DTYPE
+import numpy as np
+import h5py
+import os
+
+
+def _convert_attrs(f):
+    count = 0
+    for key, val in f.attrs.items():
+        if not isinstance(val, basestring):
+            continue
+
+        if val.startswith('DICTABLE'):
+            i = val.index('|', 9) + 1
+            prefix, raw = val[:i], unescape(val[i:])
+        else:
+            prefix, raw = '', unescape(val)
+
+        try:
+            unpack_raw(raw)
+        except Exception:
+            log.debug('Attribute \'%s\' of %s is not a packed value - leaving as is', key, f.filename)
+            continue
+
+        # Values too large for a binary attribute stay in the (readable) legacy format
+        if len(prefix) + len(raw) <= MAX_BINARY_ATTR_SIZE:
+            f.attrs[key] = np.void(prefix + raw)
+            count += 1
+
+    return count
+
+
+def _convert_dataset(f, name):
+    ds = f[name]
+    vals = ds[...]
+    shape, maxshape, chunks = ds.shape, ds.maxshape, ds.chunks
+    del f[name]
+
+    nds = f.create_dataset(name, shape=shape, dtype=BINARY_VLEN_DTYPE, maxshape=maxshape, chunks=chunks)
+    for idx in np.ndindex(shape):
+        v = vals[idx]
+        if v:
+            nds[idx] = np.frombuffer(unescape(v), dtype=np.uint8)
+
+
+def _legacy_datasets(f):
+    names = []
+
+    def visitor(name, obj):
+        # Skip objects reached through external links (i.e. bricks linked from the master file)
+        if isinstance(obj, h5py.Dataset) and obj.file.filename == f.filename and obj.dtype.kind == 'O' and not is_binary_vlen(obj.dtype):
+            names.append(name)
+
+    f.visititems(visitor)
+    return names
+
+
+def migrate_file(file_path):
+    """
+    Convert the attributes and object datasets of an HDF5 file within a coverage to binary storage
+
+    @param file_path    Path to the HDF5 file
+    @return A tuple of (number of attributes converted, number of datasets converted)
+    """
+    with h5py.File(file_path, 'a') as f:
+        acount = _convert_attrs(f)
+        dsets = _legacy_datasets(f)
+        for name in dsets:
+            _convert_dataset(f, name)
+
+    return acount, len(dsets)
+
+
+def migrate_coverage(cov_dir):
+    """
+    Convert a coverage written with the legacy escaped-string encoding to binary storage, in place
+
+    Coverages must not be open while they are migrated.  Migrated coverages cannot be read by versions of the
+    coverage model that predate binary storage.
+
+    @param cov_dir  The coverage directory (/<root>/<guid>)
+    @return A dict of {file_path: (attributes converted, datasets converted)} for the files that changed
+    """
+    if not os.path.isdir(cov_dir):
+        raise IOError('Coverage directory does not exist: \'{0}\''.format(cov_dir))
+
+    ret = {}
+    for root, dirs, files in os.walk(cov_dir):
+        for fname in files:
+            if fname.endswith('.hdf5'):
+                fpath = os.path.join(root, fname)
+                counts = migrate_file(fpath)
+                if any(counts):
+                    log.debug('Migrated %s: %s attributes, %s datasets', fpath, *counts)
+                    ret[fpath] = counts
+
+    return ret
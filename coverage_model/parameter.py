@@ -9,6 +9,7 @@
 
 from ooi.logging import log
 from coverage_model.basic_types import AbstractIdentifiable, VariabilityEnum, AxisTypeEnum
+from coverage_model.utils import get_class
 from coverage_model.parameter_types import AbstractParameterType, QuantityType
 from coverage_model.parameter_functions import ParameterFunctionException
 from collections import OrderedDict
@@ -249,6 +250,7 @@ class ParameterDictionary(AbstractIdentifiable):
         """
         AbstractIdentifiable.__init__(self)
         self._map = OrderedDict()
+        self._deferred = {}
         self.__count=0
         self.temporal_parameter_name = None
 
@@ -286,6 +288,47 @@ class ParameterDictionary(AbstractIdentifiable):
         self.__count += 1
         self._map[param_ctxt.name] = (self.__count, param_ctxt)
 
+    def add_deferred_context(self, param_name, loader, is_temporal=False):
+        """
+        Add a placeholder for a ParameterContext that is not constructed until it is first requested
+
+        @param param_name   The name of the parameter
+        @param loader   A callable accepting 'param_name' and returning the ParameterContext
+        @param is_temporal  If this parameter should be used as the temporal parameter
+        """
+        if param_name in self._map:
+            raise ValueError('The dictionary already contains a parameter named \'%s\'', param_name)
+
+        if is_temporal:
+            if self.temporal_parameter_name is None:
+                self.temporal_parameter_name = param_name
+            else:
+                raise NameError('This dictionary already has a parameter designated as \'temporal\': %s', self.temporal_parameter_name)
+
+        self.__count += 1
+        self._map[param_name] = (self.__count, None)
+        self._deferred[param_name] = loader
+
+    def _resolve(self, param_name):
+        if param_name in self._deferred:
+            pc = self._deferred[param_name](param_name)
+            self._map[param_name] = (self._map[param_name][0], pc)
+            del self._deferred[param_name]
+
+        return self._map[param_name]
+
+    def is_loaded(self, param_name):
+        """
+        Indicates if the ParameterContext for a parameter has been constructed
+
+        @param param_name   The name of the parameter
+        """
+        return param_name in self._map and param_name not in self._deferred
+
+    def _resolve_all(self):
+        for k in self._deferred.keys():
+            self._resolve(k)
+
     def __setitem__(self, key, value):
         raise TypeError('\'ParameterDictionary\' object does not support item assignment: use ParameterDictionary.add_context()')
 
@@ -303,11 +346,11 @@ class ParameterDictionary(AbstractIdentifiable):
         if not param_name in self._map:
             raise KeyError('The ParameterDictionary does not contain the specified key \'{0}\''.format(param_name))
 
-        return self._map[param_name][1]
+        return self._resolve(param_name)[1]
 
     def get_temporal_context(self):
         if self.temporal_parameter_name is not None:
-            return self._map[self.temporal_parameter_name][1]
+            return self._resolve(self.temporal_parameter_name)[1]
         else:
             raise KeyError('This dictionary does not have a parameter designated as \'temporal\'')
 
@@ -353,8 +396,9 @@ class ParameterDictionary(AbstractIdentifiable):
         Overrides Dictable._todict() to properly handle ordinals
         """
         #CBM TODO: try/except this to inform more pleasantly if it bombs
+        self._resolve_all()
         res = dict((k,(v[0],v[1]._todict())) for k, v in self._map.iteritems())
-        res.update((k,v._todict() if hasattr(v, '_todict') else v) for k, v in self.__dict__.iteritems() if k != '_map')
+        res.update((k,v._todict() if hasattr(v, '_todict') else v) for k, v in self.__dict__.iteritems() if k not in ('_map', '_deferred'))
         res['cm_type'] = (self.__module__, self.__class__.__name__)
         return res
 
@@ -374,9 +418,7 @@ class ParameterDictionary(AbstractIdentifiable):
                     ret._map[pc.name] = (v[0], pc)
                 elif isinstance(v, dict) and 'cm_type' in v: # CBM TODO: Don't think we ever get here?!
                     ms, cs = v['cm_type']
-                    module = __import__(ms, fromlist=[cs])
-                    classobj = getattr(module, cs)
-                    setattr(ret,k,classobj._fromdict(v))
+                    setattr(ret,k,get_class(ms, cs)._fromdict(v))
                 else:
                     setattr(ret, k, v)
 
@@ -393,9 +435,11 @@ class ParameterDictionary(AbstractIdentifiable):
         return self._map.__iter__()
 
     def iteritems(self):
+        self._resolve_all()
         return self._map.iteritems()
 
     def itervalues(self):
+        self._resolve_all()
         return self._map.itervalues()
 
     def keys(self):
@@ -448,6 +492,11 @@ class ParameterDictionary(AbstractIdentifiable):
         return ret
 
 
+    def __getstate__(self):
+        # Deferred loaders are bound to their owner - realize them before copying or pickling
+        self._resolve_all()
+        return self.__dict__
+
     def __eq__(self, other):
         try:
             res = self.compare(other)
@@ -547,6 +596,62 @@ class ParameterFunctionValidator(object):
             import sys
             raise ParameterFunctionException(ex.message, type(ex)), None, sys.exc_traceback
 
+    def validate_all(self, context_names=None):
+        """
+        Validate that each of the ParameterContexts indicated by <i>context_names</i> can be fulfilled by the set of
+        ParameterContexts available to this ParameterFunctionValidator
+
+        The dependency graphs of the contexts are combined into one, so dependencies shared by several contexts are
+        only resolved once
+
+        @param context_names iterable of the names of the parameters to validate, must be members of self._ctxts;
+        defaults to all of them
+        @return the combined dependency graph
+        @throws ParameterFunctionException if any of the parameters cannot be calculated
+        """
+        try:
+            import networkx as nx
+            if context_names is None:
+                context_names = self._ctxts.keys()
+
+            g = nx.DiGraph()
+            for n in context_names:
+                cg = self._ctxts[n].param_type.get_dependency_graph()
+                g.add_nodes_from(cg.nodes(data=True))
+                g.add_edges_from(cg.edges(data=True))
+
+            for n in [n for n in self._cwvn if n in g.node]:
+                g.node[n]['color'] = g.node[n]['fontcolor'] = 'forestgreen'
+
+            # The leaves each node depends on that do not have values, not looking past nodes that do
+            missing = {}
+            for root in context_names:
+                stack = [root]
+                while stack:
+                    n = stack[-1]
+                    if n in missing:
+                        stack.pop()
+                    elif g.node[n]['color'] == 'forestgreen':
+                        missing[n] = frozenset()
+                        stack.pop()
+                    else:
+                        succ = g.successors(n)
+                        pending = [s for s in succ if s not in missing]
+                        if pending:
+                            stack.extend(pending)
+                        else:
+                            missing[n] = frozenset([n]) if len(succ) == 0 else frozenset().union(*[missing[s] for s in succ])
+                            stack.pop()
+
+            failed = [n for n in context_names if len(missing[n]) > 0]
+            if len(failed) > 0:
+                raise ValueError('; '.join(['Unable to calculate \'{0}\', missing values or functions: {1}'.format(n, sorted(missing[n])) for n in failed]))
+
+            return g
+        except Exception as ex:
+            import sys
+            raise ParameterFunctionException(ex.message, type(ex)), None, sys.exc_traceback
+
 
 
 """
@@ -11,10 +11,18 @@ from ooi.logging import log
 
 import numpy as np
 import numexpr as ne
+from numexpr import necompiler
+import threading
 from numbers import Number
 from collections import OrderedDict
 from coverage_model.basic_types import AbstractBase
 
+# Compiled NumExpr programs share numexpr's global state - serialize them as numexpr.evaluate does
+_numexpr_lock = getattr(necompiler, 'evaluate_lock', None) or threading.Lock()
+
+# NumExpr functions that reduce their argument - each value they compute depends on every index
+_numexpr_reductions = ('sum', 'prod')
+
 
 class ParameterFunctionException(Exception):
     def __init__(self, message, original_type=None):
@@ -67,6 +75,110 @@ class AbstractFunction(AbstractBase):
     def evaluate(self, *args):
         raise NotImplementedError('Not implemented in abstract class')
 
+    def _is_elementwise(self):
+        # True if each value computed depends only on the argument values at the same index
+        return False
+
+    def _get_definition(self):
+        # What, besides its arguments, determines the values computed - implemented by concrete classes
+        return None
+
+    def get_node_key(self):
+        """
+        Returns a hashable key identifying the computation of this function, including the functions nested within it
+
+        Functions with equal keys compute the same values, whatever their names
+        """
+        return self._get_key(named=False)
+
+    def get_definition_key(self):
+        """
+        Returns a hashable key identifying the definition of this function, including the names of the functions nested
+        within it
+
+        The key changes whenever the function, its param_map or any of its nested functions is changed
+        """
+        return self._get_key(named=True)
+
+    def _get_key(self, named):
+        arg_map = self._apply_mapping()
+        args = []
+        for k in self.arg_list:
+            a = arg_map[k]
+            if isinstance(a, AbstractFunction):
+                args.append((k, a._get_key(named)))
+            elif isinstance(a, Number) or hasattr(a, '__iter__') and np.array([isinstance(ai, Number) for ai in a]).all():
+                args.append((k, ('value', repr(a))))
+            else:
+                args.append((k, ('parameter', a)))
+
+        if named:
+            return self.name, self.__class__.__name__, self._get_definition(), tuple(args)
+
+        return self.__class__.__name__, self._get_definition(), tuple(args)
+
+    def get_parameter_inputs(self):
+        """
+        Returns the parameters read by this function and the functions nested within it
+
+        Parameters are not resolved - an argument naming a parameter function is returned as is
+
+        @return A tuple of (set of parameter names or None if any parameter may be read, True if each value computed
+        depends only on the parameter values at the same index)
+        """
+        params = set()
+        elementwise = self._is_elementwise()
+        arg_map = self._apply_mapping()
+        for k in self.arg_list:
+            a = arg_map[k]
+            if isinstance(a, AbstractFunction):
+                p, e = a.get_parameter_inputs()
+                elementwise = elementwise and e
+                if p is None:
+                    params = None
+                elif params is not None:
+                    params.update(p)
+            elif isinstance(a, Number) or hasattr(a, '__iter__') and np.array([isinstance(ai, Number) for ai in a]).all():
+                continue
+            elif k == 'pv_callback':
+                # The function can read any parameter
+                params = None
+            else:
+                if k.endswith('*'):
+                    # The whole array is read
+                    elementwise = False
+                if params is not None:
+                    params.add(a)
+
+        return params, elementwise
+
+    def get_parameter_reads(self, slice_):
+        """
+        Returns the parameter reads evaluating this function over slice_ makes, including through the functions nested
+        within it
+
+        @param slice_   The slice the function is evaluated over
+        @return A list of (parameter name, slice) tuples, or None if the reads are not known in advance
+        """
+        reads = []
+        arg_map = self._apply_mapping()
+        for k in self.arg_list:
+            a = arg_map[k]
+            if isinstance(a, AbstractFunction):
+                r = a.get_parameter_reads(slice_)
+                if r is None:
+                    return None
+                reads.extend(r)
+            elif isinstance(a, Number) or hasattr(a, '__iter__') and np.array([isinstance(ai, Number) for ai in a]).all():
+                continue
+            elif k == 'pv_callback':
+                # The function reads whatever it likes
+                return None
+            else:
+                reads.append((a, -1 if k.endswith('*') else slice_))
+
+        return reads
+
     def get_module_dependencies(self):
         deps = set()
 
@@ -143,17 +255,25 @@ class AbstractFunction(AbstractBase):
 
 
 class PythonFunction(AbstractFunction):
-    def __init__(self, name, owner, func_name, arg_list, kwarg_map=None, param_map=None):
+    def __init__(self, name, owner, func_name, arg_list, kwarg_map=None, param_map=None, elementwise=False):
+        """
+        @param elementwise  True if each value returned depends only on the argument values at the same index; such
+        functions may be evaluated in chunks (see ParameterFunctionValue.chunk_size)
+        """
         AbstractFunction.__init__(self, name, arg_list, param_map)
         self.owner = owner
         self.func_name = func_name
         self.kwarg_map = kwarg_map
+        self.elementwise = elementwise
 
     def _import_func(self):
-        import importlib
+        # The callable is resolved once - again only if owner or func_name change
+        if getattr(self, '_callable_source', None) != (self.owner, self.func_name):
+            import importlib
 
-        module = importlib.import_module(self.owner)
-        self._callable = getattr(module, self.func_name)
+            module = importlib.import_module(self.owner)
+            self._callable = getattr(module, self.func_name)
+            self._callable_source = (self.owner, self.func_name)
 
     def evaluate(self, pval_callback, slice_, fill_value=-9999):
         self._import_func()
@@ -164,7 +284,7 @@ class PythonFunction(AbstractFunction):
         for k in self.arg_list:
             a = arg_map[k]
             if isinstance(a, AbstractFunction):
-                args.append(a.evaluate(pval_callback, slice_, fill_value))
+                args.append(_evaluate_function(a, pval_callback, slice_, fill_value))
             elif isinstance(a, Number) or hasattr(a, '__iter__') and np.array(
                     [isinstance(ai, Number) for ai in a]).all():
                 args.append(a)
@@ -183,8 +303,15 @@ class PythonFunction(AbstractFunction):
             # TODO: Add handling for kwargs
             # return self._callable(*args, **kwargs)
 
+    def _is_elementwise(self):
+        return getattr(self, 'elementwise', False)
+
+    def _get_definition(self):
+        return self.owner, self.func_name, self.kwarg_map
+
     def _todict(self, exclude=None):
-        return super(PythonFunction, self)._todict(exclude=['_callable'])
+        exclude = list(exclude or []) + ['_callable', '_callable_source']
+        return super(PythonFunction, self)._todict(exclude=exclude)
 
     @classmethod
     def _fromdict(cls, cmdict, arg_masks=None):
@@ -204,6 +331,29 @@ class NumexprFunction(AbstractFunction):
         AbstractFunction.__init__(self, name, arg_list, param_map)
         self.expression = expression
 
+    def _is_elementwise(self):
+        # Arguments read in full ('name*') or reduced (e.g. 'sum(t)') depend on every index
+        return not any(k.endswith('*') for k in self.arg_list) and not self._has_reduction()
+
+    def _has_reduction(self):
+        if getattr(self, '_reduction', None) is None or self._reduction[0] != self.expression:
+            def walk(node):
+                if node.astType == 'op' and node.value in _numexpr_reductions:
+                    return True
+                return any(walk(c) for c in node.children)
+
+            try:
+                reduces = walk(necompiler.stringToExpression(self.expression, {}, {}))
+            except Exception:
+                # Can't tell - don't assume the function is element-wise
+                reduces = True
+            self._reduction = (self.expression, reduces)
+
+        return self._reduction[1]
+
+    def _get_definition(self):
+        return self.expression
+
     def evaluate(self, pval_callback, slice_, fill_value=-9999):
         arg_map = self._apply_mapping()
 
@@ -211,7 +361,7 @@ class NumexprFunction(AbstractFunction):
         for k in self.arg_list:
             a = arg_map[k]
             if isinstance(a, AbstractFunction):
-                ld[k] = a.evaluate(pval_callback, slice_, fill_value)
+                ld[k] = _evaluate_function(a, pval_callback, slice_, fill_value)
             elif isinstance(a, Number) or hasattr(a, '__iter__') and np.array(
                     [isinstance(ai, Number) for ai in a]).all():
                 ld[k] = a
@@ -221,7 +371,32 @@ class NumexprFunction(AbstractFunction):
                 else:
                     ld[k] = pval_callback(a, slice_)
 
-        return ne.evaluate(self.expression, local_dict=ld)
+        names, uses_vml, programs = self._get_compiled()
+        try:
+            args = [np.asarray(ld[n]) for n in names]
+        except KeyError:
+            # Names that are not arguments are left for numexpr to resolve
+            return ne.evaluate(self.expression, local_dict=ld)
+
+        # Compile the expression once for each combination of argument types
+        signature = tuple((n, necompiler.getType(a)) for n, a in zip(names, args))
+        if signature not in programs:
+            programs[signature] = ne.NumExpr(self.expression, signature)
+
+        with _numexpr_lock:
+            return programs[signature](*args, ex_uses_vml=uses_vml)
+
+    def _get_compiled(self):
+        # Returns (names in the expression, True if it uses VML functions, {signature: compiled NumExpr program})
+        if getattr(self, '_compiled', None) is None or self._compiled[0] != self.expression:
+            names, uses_vml = necompiler.getExprNames(self.expression, {})
+            self._compiled = (self.expression, names, uses_vml, {})
+
+        return self._compiled[1:]
+
+    def _todict(self, exclude=None):
+        exclude = list(exclude or []) + ['_compiled', '_reduction']
+        return super(NumexprFunction, self)._todict(exclude=exclude)
 
     def __eq__(self, other):
         ret = False
@@ -229,3 +404,243 @@ class NumexprFunction(AbstractFunction):
             ret = self.expression == other.expression
 
         return ret
+
+
+def _evaluate_function(func, pval_callback, slice_, fill_value):
+    # Nested functions are evaluated through a SharedEvaluation when there is one, so they are evaluated only once
+    if isinstance(pval_callback, SharedEvaluation):
+        return pval_callback.evaluate(func, slice_, fill_value)
+
+    return func.evaluate(pval_callback, slice_, fill_value)
+
+
+def _evaluate_with_values(func, values, slice_, fill_value):
+    # Runs on a FunctionExecutor worker - evaluates func reading its inputs from values, a dict of
+    # {(param_name, slice repr): value}
+    try:
+        return func.evaluate(lambda a, sl: values[(a, repr(sl))], slice_, fill_value)
+    except ParameterFunctionException:
+        raise
+    except Exception as ex:
+        import sys
+        raise ParameterFunctionException(ex.message, type(ex)), None, sys.exc_traceback
+
+
+class FunctionExecutor(object):
+    """
+    Evaluates parameter functions concurrently on a pool of threads
+
+    Only the computation runs on the pool - inputs are read beforehand by the caller and handed to the workers, so
+    nothing of the coverage is touched from another thread.  This suits NumPy-based functions, which release the GIL;
+    pure Python ones gain little.  Compiled numexpr programs serialize on numexpr's lock, but numexpr spreads each
+    evaluation over its own threads.
+
+    There is no process pool: processes forked from a gevent process inherit its hub and pending greenlets.
+    """
+
+    def __init__(self, num_workers=4):
+        """
+        @param num_workers  The size of the pool
+        """
+        self.num_workers = num_workers
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            from gevent.threadpool import ThreadPool
+            self._pool = ThreadPool(self.num_workers)
+
+        return self._pool
+
+    def evaluate(self, work):
+        """
+        Evaluate functions concurrently
+
+        @param work A list of (AbstractFunction, {(param_name, slice repr): value}, slice_, fill_value) tuples
+        @return A list of the values computed, in the order of work
+        @throws ParameterFunctionException  A function failed
+        """
+        pool = self._get_pool()
+        results = [pool.spawn(_evaluate_with_values, f, v, sl, fv) for f, v, sl, fv in work]
+
+        return [r.get() for r in results]
+
+    def __deepcopy__(self, memo):
+        # Copies of whatever refers to the executor (i.e. a copied parameter context) share its pool
+        return self
+
+    def __getstate__(self):
+        # The pool is not pickled - it is recreated on first use
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.kill()
+            self._pool = None
+
+
+class SharedEvaluation(object):
+    """
+    A pval_callback that fetches each parameter once per slice and evaluates each distinct function once per slice
+
+    Parameters resolved by function_callback are evaluated through this object too, rather than fetched, so the
+    inputs and functions they share with others are not fetched or evaluated again
+    """
+
+    def __init__(self, pval_callback, function_callback=None):
+        """
+        @param pval_callback    Returns the values of a parameter for a slice
+        @param function_callback    Returns the ParameterFunctionValue of a parameter, or None if it is not a parameter
+        function
+        """
+        self._pval_callback = pval_callback
+        self._function_callback = function_callback
+        self._values = {} # {(param_name, slice key): value}
+        self._results = {} # {(node key, slice key, fill_value): value}
+        self.fetches = 0
+        self.evaluations = 0
+
+    def __call__(self, param_name, slice_):
+        key = (param_name, repr(slice_))
+        if key not in self._values:
+            pfv = self._function_callback(param_name) if self._function_callback is not None else None
+            if pfv is not None and slice_ != -1:
+                self._values[key] = pfv.evaluate_with(self, slice_)
+            else:
+                self.fetches += 1
+                self._values[key] = self._pval_callback(param_name, slice_)
+
+        return self._values[key]
+
+    def set_value(self, param_name, slice_, value):
+        # Record the value of a parameter evaluated elsewhere (i.e. on a FunctionExecutor)
+        self._values[(param_name, repr(slice_))] = value
+
+    def evaluate(self, func, slice_, fill_value=-9999):
+        key = (func.get_node_key(), repr(slice_), fill_value)
+        if key not in self._results:
+            self.evaluations += 1
+            self._results[key] = func.evaluate(self, slice_, fill_value)
+
+        return self._results[key]
+
+
+class EvaluationPlan(object):
+    """
+    Evaluates several parameters, some of them parameter functions, over the same slice
+
+    The functions of the requested parameters, the functions nested within them and the parameter functions they read
+    are merged into one DAG of nodes keyed by AbstractFunction.get_node_key.  Each independent input is fetched once
+    and each node shared between outputs is evaluated once.
+    """
+
+    def __init__(self, param_names, function_callback):
+        """
+        @param param_names  The names of the parameters to evaluate
+        @param function_callback    Returns the ParameterFunctionValue of a parameter, or None if it is not a parameter
+        function
+        """
+        self.param_names = list(param_names)
+        self._function_callback = function_callback
+        self.nodes = {} # {node key: AbstractFunction or parameter name}
+        self.edges = {} # {node key: set of the node keys it reads}
+
+        for p in self.param_names:
+            self._add_parameter(p)
+
+    def _add_parameter(self, param_name):
+        pfv = self._function_callback(param_name)
+        if pfv is None:
+            key = ('parameter', param_name)
+            self.nodes.setdefault(key, param_name)
+            self.edges.setdefault(key, set())
+        else:
+            key = ('function', param_name)
+            if key not in self.nodes:
+                self.nodes[key] = param_name
+                self.edges[key] = set([self._add_function(pfv.content)])
+
+        return key
+
+    def _add_function(self, func):
+        key = func.get_node_key()
+        if key not in self.nodes:
+            self.nodes[key] = func
+            self.edges[key] = set()
+            arg_map = func._apply_mapping()
+            for k in func.arg_list:
+                a = arg_map[k]
+                if isinstance(a, AbstractFunction):
+                    self.edges[key].add(self._add_function(a))
+                elif isinstance(a, basestring) and k != 'pv_callback':
+                    self.edges[key].add(self._add_parameter(a))
+
+        return key
+
+    def get_independent_parameters(self):
+        """
+        Returns the names of the parameters that are inputs rather than parameter functions
+        """
+        return set(n for k, n in self.nodes.iteritems() if k[0] == 'parameter')
+
+    def get_shared_nodes(self):
+        """
+        Returns the keys of the nodes read by more than one other node
+        """
+        readers = {}
+        for k, deps in self.edges.iteritems():
+            for d in deps:
+                readers[d] = readers.get(d, 0) + 1
+
+        return set(k for k, n in readers.iteritems() if n > 1)
+
+    def evaluate(self, pval_callback, slice_, executor=None):
+        """
+        Returns a dict of {param_name: value} for the requested parameters
+
+        @param pval_callback    Returns the values of a parameter for a slice
+        @param slice_   The slice to evaluate
+        @param executor If supplied, a FunctionExecutor the parameter functions that do not depend on one another are
+        evaluated on concurrently
+        """
+        shared = SharedEvaluation(pval_callback, self._function_callback)
+        if executor is not None:
+            self._evaluate_concurrently(shared, slice_, executor)
+
+        return dict((p, shared(p, slice_)) for p in self.param_names)
+
+    def _evaluate_concurrently(self, shared, slice_, executor):
+        # Evaluate the parameter functions in waves - each wave, those whose parameter function inputs are all
+        # evaluated.  Their inputs are read through shared, so reads stay in this thread and are not repeated.
+        pending = dict((n, self._function_callback(n)) for k, n in self.nodes.iteritems() if k[0] == 'function')
+        while pending:
+            wave = []
+            for n, pfv in pending.iteritems():
+                params = pfv.content.get_parameter_inputs()[0] or ()
+                if not any(p in pending and p != n for p in params):
+                    wave.append(n)
+
+            if not wave:
+                # Circular - left to the serial evaluation
+                break
+
+            work, finishers = [], []
+            for n in wave:
+                w = pending.pop(n).get_evaluation_work(slice_, shared)
+                if w is None:
+                    # The reads are not known in advance
+                    shared(n, slice_)
+                else:
+                    finishers.append((n, len(w[0]), w[1], w[2]))
+                    work.extend(w[0])
+
+            results = executor.evaluate(work)
+            i = 0
+            for n, count, finish, fixed_slice in finishers:
+                v = finish(results[i:i + count])
+                # Other functions read it by the slice fixed to their shape
+                shared.set_value(n, slice_, v)
+                shared.set_value(n, fixed_slice, v)
+                i += count
@@ -559,11 +559,26 @@ class TimeRangeType(AbstractSimplexParameterType):
         kwc=kwargs.copy()
         AbstractSimplexParameterType.__init__(self, **kwc)
 
+def _get_argument_names(func):
+    # The names of the parameters passed to func and the functions nested within it
+    names = set()
+    arg_map = func._apply_mapping()
+    for k in func.arg_list:
+        a = arg_map[k]
+        if isinstance(a, AbstractFunction):
+            names.update(_get_argument_names(a))
+        elif isinstance(a, basestring):
+            names.add(a)
+
+    return names
+
 class ParameterFunctionType(AbstractSimplexParameterType):
 
-    def __init__(self, function, value_encoding=None, **kwargs):
+    def __init__(self, function, value_encoding=None, materialized=False, **kwargs):
         """
 
+        @param materialized If True, evaluated values are stored in the parameter's bricks and only reevaluated where
+        the inputs of the function are written; see ParameterFunctionValue
         @param **kwargs Additional keyword arguments are copied and the copy is passed up to AbstractSimplexParameterType; see documentation for that class for details
         """
         kwc=kwargs.copy()
@@ -587,6 +602,7 @@ class ParameterFunctionType(AbstractSimplexParameterType):
                 raise
 
         self._template_attrs['function'] = function
+        self._template_attrs['materialized'] = materialized
 
         self._template_attrs['_pval_callback'] = None
         self._template_attrs['_pctxt_callback'] = None
@@ -599,14 +615,87 @@ class ParameterFunctionType(AbstractSimplexParameterType):
     def get_module_dependencies(self):
         return self.function.get_module_dependencies()
 
+    def __setattr__(self, key, value):
+        # The cached function map depends on the contexts resolved through the callback
+        if key in ('function', '_pctxt_callback'):
+            self.__dict__['_dep_cache'] = None
+        super(ParameterFunctionType, self).__setattr__(key, value)
+
+    def _get_dependency_key(self, seen=()):
+        """
+        Returns a hashable key identifying the definition of the function and of every parameter function it reads
+        through the context callback, however deeply nested
+
+        @param seen The names of the parameter functions already being keyed - guards against cycles
+        """
+        key = self.function.get_definition_key()
+        if self._pctxt_callback is None:
+            return key
+
+        nested = []
+        for name in sorted(_get_argument_names(self.function)):
+            if name in seen:
+                continue
+            try:
+                ptype = self._pctxt_callback(name).param_type
+            except KeyError:
+                nested.append((name, None))
+                continue
+            if isinstance(ptype, ParameterFunctionType):
+                nested.append((name, ptype._get_dependency_key(seen + (name,))))
+
+        return key, tuple(nested)
+
+    def _get_dependency_cache(self):
+        """
+        Returns the dict caching the function map, parameter sets and dependency graph of the function
+
+        The cache is discarded whenever the definition of the function (including its param_map), or of any parameter
+        function it reads, changes
+        """
+        key = self._get_dependency_key()
+        cache = getattr(self, '_dep_cache', None)
+        if cache is None or cache[0] != key:
+            cache = self.__dict__['_dep_cache'] = (key, {})
+
+        return cache[1]
+
+    def clear_dependency_cache(self):
+        """
+        Discard the cached function map, parameter sets and dependency graph
+
+        Required when the set of contexts available through the context callback changes
+        """
+        self.__dict__['_dep_cache'] = None
+
     def get_function_map(self, parent_arg_name=None):
-        self._fmap = self.function.get_function_map(self._pctxt_callback, parent_arg_name=parent_arg_name)
+        cache = self._get_dependency_cache()
+        key = ('fmap', parent_arg_name)
+        if key not in cache:
+            cache[key] = self.function.get_function_map(self._pctxt_callback, parent_arg_name=parent_arg_name)
+        self._fmap = cache[key]
 
         return self._fmap
 
+    def _calc_param_sets(self):
+        cache = self._get_dependency_cache()
+        if 'param_sets' not in cache:
+            cache['param_sets'] = super(ParameterFunctionType, self)._calc_param_sets()
+        self._iparams, self._dparams = cache['param_sets']
+
+        return cache['param_sets']
+
+    def get_dependency_graph(self, name=None):
+        cache = self._get_dependency_cache()
+        if 'graph' not in cache:
+            cache['graph'] = super(ParameterFunctionType, self).get_dependency_graph(name)
+
+        # Callers are free to modify the graph they are given
+        return cache['graph'].copy()
+
     def _todict(self, exclude=None):
         # Must exclude _cov_range_value from persistence
-        return super(ParameterFunctionType, self)._todict(exclude=['_pval_callback', '_pctxt_callback', '_fmap', '_iparams', '_dparams'])
+        return super(ParameterFunctionType, self)._todict(exclude=['_pval_callback', '_pctxt_callback', '_fmap', '_iparams', '_dparams', '_dep_cache'])
 
     @classmethod
     def _fromdict(cls, cmdict, arg_masks=None):
@@ -11,13 +11,13 @@ from coverage_model.basic_types import AbstractBase, InMemoryStorage, Variabilit
 from coverage_model.numexpr_utils import is_well_formed_where, nest_wheres
 from coverage_model.parameter_functions import ParameterFunctionException
 from coverage_model import utils
+import itertools
 import numpy as np
 import numexpr as ne
 
 
 def get_value_class(param_type, domain_set, **kwargs):
-    module = __import__(param_type._value_module, fromlist=[param_type._value_class])
-    classobj = getattr(module, param_type._value_class)
+    classobj = utils.get_class(param_type._value_module, param_type._value_class)
     return classobj(parameter_type=param_type, domain_set=domain_set, **kwargs)
 
 
@@ -219,13 +219,18 @@ class FunctionValue(AbstractComplexParameterValue):
         AbstractComplexParameterValue.__init__(self, parameter_type, domain_set, storage, **kwc)
         self._storage.expand((1,), 0, 1)
         self._storage[0] = []
+        self._nested = None # (where clauses, nested expression)
 
     @property
     def content(self):
-        if len(self._storage[0]) > 1:
-            return nest_wheres(*[x for x in self._storage[0]])
+        clauses = tuple(self._storage[0])
+        if len(clauses) > 1:
+            # Nest the where clauses again only when they change
+            if self._nested is None or self._nested[0] != clauses:
+                self._nested = (clauses, nest_wheres(*clauses))
+            return self._nested[1]
         else:
-            return self._storage[0][0]
+            return clauses[0]
 
     def expand_content(self, domain, origin, expansion):
         # No op storage is always 1 - appropriate domain applied during retrieval of data
@@ -257,19 +262,41 @@ class ParameterFunctionValue(AbstractSimplexParameterValue):
         """
         kwc=kwargs.copy()
         AbstractSimplexParameterValue.__init__(self, parameter_type, domain_set, storage, **kwc)
-        # Do NOT expand storage - no need to store anything here!!
+        # Do NOT expand storage - no need to store anything here!! (unless the values are materialized)
+        if self.materialized:
+            self._storage.expand(self.shape, 0, self.shape[0])
 
         # Grab a local pointer to the coverage's _cov_range_value object
         self._pval_callback = self.parameter_type._pval_callback
         self._memoized_values = None
 
+        # If set, element-wise functions are evaluated over at most chunk_size temporal indices at a time, so only the
+        # inputs of one chunk are held in memory at once
+        self.chunk_size = None
+        # Assigned by the coverage: chunks are cut at multiples of this (the brick size) so each reads whole bricks
+        self._chunk_alignment = None
+        # Assigned by the coverage: returns True if the function, including the functions it reads, is element-wise
+        self._elementwise_callback = None
+        # If set, a FunctionExecutor the chunks of the function are evaluated on concurrently
+        self.executor = None
+
+        # Assigned by the coverage when materialized: returns the temporal ranges over which the stored values are valid
+        self._ranges_callback = None
+        # Assigned by the coverage when materialized and writable: records the ranges over which they are valid
+        self._set_ranges_callback = None
+
     @property
     def content(self):
         return self.parameter_type.function
 
+    @property
+    def materialized(self):
+        return getattr(self.parameter_type, 'materialized', False)
+
     def expand_content(self, domain, origin, expansion):
-        # No op, storage is not used
-        pass
+        # Storage is only used when materialized
+        if self.materialized:
+            AbstractSimplexParameterValue.expand_content(self, domain, origin, expansion)
 
     def _update_min_max(self, value):
         # TODO: Can possibly do something here?  Only if memoized?
@@ -285,19 +312,201 @@ class ParameterFunctionValue(AbstractSimplexParameterValue):
 
             slice_ = utils.fix_slice(slice_, self.shape)
 
-            try:
-                r = self.content.evaluate(self._pval_callback, slice_, self.parameter_type.fill_value)
-                ve = self.parameter_type.value_encoding
-                if hasattr(self.parameter_type, 'inner_encoding'):
-                    ve = self.parameter_type.inner_encoding
-
-                if ve is not None:
-                    r = np.asanyarray(r, dtype=ve)
-            except Exception as ex:
-                import sys
-                raise ParameterFunctionException(ex.message, type(ex)), None, sys.exc_traceback
-
-            return _cleanse_value(r, slice_)
+            if self.materialized and self._ranges_callback is not None:
+                return self._get_materialized(slice_)
+
+            return self._evaluate(slice_)
+
+    def materialize(self, slice_=None):
+        """
+        Evaluate and store the values missing over slice_
+
+        @param slice_   The slice to materialize; defaults to the whole domain
+        @return A list of the temporal [start, stop] ranges evaluated
+        @throws ValueError  The values are not materialized, or cannot be stored
+        """
+        if not self.materialized or self._set_ranges_callback is None:
+            raise ValueError('Values of \'{0}\' cannot be materialized'.format(self.content.name))
+
+        if self.shape[0] == 0:
+            return []
+
+        slice_ = utils.fix_slice(slice(None) if slice_ is None else slice_, self.shape)
+        bounds = utils.index_bounds(utils.express_slice(slice_, self.shape)[0])
+        missing = utils.missing_ranges(self._ranges_callback(), *bounds)
+        for start, stop in missing:
+            if self.chunk_size:
+                # Stored a chunk at a time, so only one chunk of values is held at once
+                for c in utils.chunk_slice(slice(start, stop), self.shape[0], self.chunk_size, self._chunk_alignment):
+                    self._store(c.start, c.stop)
+            else:
+                self._store(start, stop)
+
+        return missing
+
+    def _get_materialized(self, slice_):
+        # The stored values are read for the ranges they are valid over - the rest are evaluated, and stored if possible
+        t = slice_[0]
+        if isinstance(t, slice):
+            idx = np.arange(*t.indices(self.shape[0]))
+            rslice = slice_
+        elif isinstance(t, (int, long, list)):
+            idx = np.atleast_1d(t)
+            rslice = (list(idx),) + tuple(slice_[1:])
+        else:
+            return self._evaluate(slice_)
+
+        missing = utils.missing_ranges(self._ranges_callback(), int(idx.min()), int(idx.max()) + 1)
+        if missing and self._set_ranges_callback is None:
+            # Read-only - evaluate
+            return self._evaluate(slice_)
+
+        computed = [(start, stop, self._store(start, stop)) for start, stop in missing]
+
+        ret = self._storage[rslice]
+        # Values just stored may not have been written to the bricks yet
+        for start, stop, v in computed:
+            sel = (idx >= start) & (idx < stop)
+            if sel.any():
+                ret[sel] = np.reshape(v[(idx[sel] - start,) + tuple(slice_[1:])], ret[sel].shape)
+
+        return _cleanse_value(ret, slice_)
+
+    def _store(self, start, stop):
+        # Evaluate the function over the temporal range [start, stop), store the values and record them as valid
+        sl = utils.fix_slice(slice(start, stop), self.shape)
+        v = np.asanyarray(self._evaluate(sl))
+        AbstractSimplexParameterValue.__setitem__(self, sl, v)
+        self._set_ranges_callback(utils.add_range(self._ranges_callback(), start, stop))
+        log.debug('Materialized \'%s\' over [%s, %s)', self.content.name, start, stop)
+
+        return v
+
+    def evaluate_with(self, pval_callback, slice_):
+        """
+        Evaluate the function over slice_, reading parameters through pval_callback (e.g. a SharedEvaluation)
+        """
+        return self._evaluate(utils.fix_slice(slice_, self.shape), pval_callback)
+
+    def iter_chunks(self, slice_=None):
+        """
+        Evaluate the function over slice_ one temporal chunk at a time (see chunk_size)
+
+        @param slice_   The slice to evaluate over; defaults to the whole domain
+        @return A generator of (chunk slice, values) tuples; there is a single chunk if the function cannot be chunked
+        """
+        if self._pval_callback is None:
+            raise ParameterFunctionException('\'_pval_callback\' is None; cannot evaluate!!')
+
+        slice_ = utils.fix_slice(slice(None) if slice_ is None else slice_, self.shape)
+        chunks = self._get_chunks(slice_) or [slice_]
+        for c in chunks:
+            yield c, _cleanse_value(self._compute(c), c)
+
+    def _is_elementwise(self):
+        if self._elementwise_callback is not None:
+            return self._elementwise_callback()
+
+        params, elementwise = self.content.get_parameter_inputs()
+        return elementwise and params is not None
+
+    def _get_chunks(self, slice_):
+        # Returns the chunks slice_ is evaluated in, or None if it is evaluated in one shot
+        if not self.chunk_size or not isinstance(slice_[0], slice) or not self._is_elementwise():
+            return None
+
+        chunks = utils.chunk_slice(slice_[0], self.shape[0], self.chunk_size, self._chunk_alignment)
+        if len(chunks) < 2:
+            return None
+
+        return [(c,) + tuple(slice_[1:]) for c in chunks]
+
+    def get_evaluation_work(self, slice_, pval_callback):
+        """
+        Prepare the evaluation of the function over slice_ on a FunctionExecutor; the inputs are read immediately
+
+        @param slice_   The slice to evaluate over
+        @param pval_callback    Returns the values of a parameter for a slice
+        @return A tuple of (list of work for FunctionExecutor.evaluate, callable taking the list of results and
+        returning the value, slice_ fixed to the shape of the value), or None if the inputs of the function are not
+        known in advance
+        """
+        slice_ = utils.fix_slice(slice_, self.shape)
+        if self.content.get_parameter_reads(slice_) is None:
+            return None
+
+        chunks = self._get_chunks(slice_)
+        work = [self._get_work(c, pval_callback) for c in chunks or [slice_]]
+        return work, lambda results: self._assemble(slice_, chunks, (self._encode(v) for v in results), pval_callback), slice_
+
+    def _evaluate(self, slice_, pval_callback=None):
+        pval_callback = pval_callback or self._pval_callback
+        chunks = self._get_chunks(slice_)
+        if self.executor is not None and self.content.get_parameter_reads(slice_) is not None:
+            values = self._iter_concurrent(chunks or [slice_], pval_callback)
+        else:
+            values = (self._compute(c, pval_callback) for c in chunks or [slice_])
+
+        return self._assemble(slice_, chunks, values, pval_callback)
+
+    def _iter_concurrent(self, chunks, pval_callback):
+        # Chunks are evaluated num_workers at a time, so the inputs of at most that many chunks are held at once
+        n = max(1, self.executor.num_workers)
+        for i in xrange(0, len(chunks), n):
+            for v in self.executor.evaluate([self._get_work(c, pval_callback) for c in chunks[i:i + n]]):
+                yield self._encode(v)
+
+    def _get_work(self, slice_, pval_callback):
+        inputs = dict(((a, repr(sl)), pval_callback(a, sl)) for a, sl in self.content.get_parameter_reads(slice_))
+        return self.content, inputs, slice_, self.parameter_type.fill_value
+
+    def _assemble(self, slice_, chunks, values, pval_callback):
+        # Assemble the values of the chunks (None for a single one) into the value for slice_
+        if chunks is None:
+            return _cleanse_value(next(iter(values)), slice_)
+
+        # Each chunk is written into the preallocated result and its inputs released before the next is evaluated
+        r = None
+        i = 0
+        for c, v in itertools.izip(chunks, values):
+            v = np.asanyarray(v)
+            n = utils.slice_shape(c[0], self.shape[0])[0]
+            if v.ndim == 0:
+                v = np.resize(v, (n,))
+            elif v.shape[0] != n:
+                # Not element-wise after all - evaluate in one shot
+                log.debug('Function \'%s\' returned %s values for %s indices; not chunking', self.content.name, v.shape[0], n)
+                r = self._compute(slice_, pval_callback)
+                break
+            if r is None:
+                r = np.empty((utils.slice_shape(slice_[0], self.shape[0])[0],) + v.shape[1:], dtype=v.dtype)
+            r[i:i + n] = v
+            i += n
+
+        return _cleanse_value(r, slice_)
+
+    def _compute(self, slice_, pval_callback=None):
+        try:
+            r = self.content.evaluate(pval_callback or self._pval_callback, slice_, self.parameter_type.fill_value)
+        except Exception as ex:
+            import sys
+            raise ParameterFunctionException(ex.message, type(ex)), None, sys.exc_traceback
+
+        return self._encode(r)
+
+    def _encode(self, r):
+        try:
+            ve = self.parameter_type.value_encoding
+            if hasattr(self.parameter_type, 'inner_encoding'):
+                ve = self.parameter_type.inner_encoding
+
+            if ve is not None:
+                r = np.asanyarray(r, dtype=ve)
+        except Exception as ex:
+            import sys
+            raise ParameterFunctionException(ex.message, type(ex)), None, sys.exc_traceback
+
+        return r
 
     def __setitem__(self, slice_, value):
         self._memoized_values = value
@@ -7,16 +7,21 @@
 @brief The core classes comprising the Persistence Layer
 """
 
-from coverage_model.brick_dispatch import BrickWriterDispatcher
+from coverage_model.brick_dispatch import acquire_brick_writer_dispatcher, work_size
+from coverage_model.brick_worker import merge_brick_work
+from coverage_model.metrics import get_telemetry, timed
 from ooi.logging import log
 from coverage_model.basic_types import create_guid, AbstractStorage, InMemoryStorage
-from coverage_model.persistence_helpers import MasterManager, ParameterManager, pack, unpack
+from coverage_model.utils import get_class
+from coverage_model.persistence_helpers import MasterManager, ParameterManager, MetadataSnapshot, pack, unpack, pack_raw, unpack_raw, is_binary_vlen, get_storage_dtype, write_binary_values, brick_lock, BINARY_OBJECT_DTYPE
 import numpy as np
 import h5py
 import os
 import itertools
 from copy import deepcopy
 
+_telemetry = get_telemetry()
+
 # TODO: Make persistence-specific error classes
 class PersistenceError(Exception):
     pass
@@ -55,6 +60,14 @@ class SimplePersistenceLayer(object):
         # No-op - would be called by parameters stored in a ComplexCoverage, which can only be ParameterFunctions
         pass
 
+    def get_materialized_ranges(self, parameter_name):
+        # Nothing is materialized in a ComplexCoverage
+        return []
+
+    def set_materialized_ranges(self, parameter_name, ranges):
+        # No-op
+        pass
+
     def has_dirty_values(self):
         # Never has dirty values
         return False
@@ -103,7 +116,7 @@ class PersistenceLayer(object):
     The PersistenceLayer class manages the disk-level storage (and retrieval) of the Coverage Model using HDF5 files.
     """
 
-    def __init__(self, root, guid, name=None, tdom=None, sdom=None, mode=None, bricking_scheme=None, inline_data_writes=True, auto_flush_values=True, value_caching=True, coverage_type=None, **kwargs):
+    def __init__(self, root, guid, name=None, tdom=None, sdom=None, mode=None, bricking_scheme=None, inline_data_writes=True, auto_flush_values=True, value_caching=True, coverage_type=None, metadata_snapshot=False, writer_backend='zmq', writer_options=None, **kwargs):
         """
         Constructor for PersistenceLayer
 
@@ -115,6 +128,9 @@ class PersistenceLayer(object):
         @param bricking_scheme  A dictionary containing the brick and chunk sizes
         @param auto_flush_values    True = Values flushed to HDF5 files automatically, False = Manual
         @param value_caching  if True (default), value requests should be cached for rapid duplicate retrieval
+        @param metadata_snapshot    if True, a MetadataSnapshot is written on close to speed up subsequent opens
+        @param writer_backend   The backend used for out-of-band writes: 'zmq' (worker processes) or 'thread' (in-process threads)
+        @param writer_options   Keyword arguments for the brick writer dispatcher, i.e. max_pending_items, max_pending_bytes and overflow_policy
         @param kwargs
         @return None
         """
@@ -122,7 +138,13 @@ class PersistenceLayer(object):
         log.debug('Persistence GUID: %s', guid)
         root = '.' if root is ('' or None) else root
 
-        self.master_manager = MasterManager(root, guid, name=name, tdom=tdom, sdom=sdom, global_bricking_scheme=bricking_scheme, parameter_bounds=None, coverage_type=coverage_type)
+        # A current snapshot lets the coverage be opened without touching the master or parameter files
+        self._metadata_snapshot = MetadataSnapshot(os.path.join(root, guid), guid)
+        snapshot = self._metadata_snapshot.read()
+        if snapshot is not None:
+            log.debug('Loading metadata from snapshot: %s', self._metadata_snapshot.file_path)
+
+        self.master_manager = MasterManager(root, guid, snapshot=snapshot, name=name, tdom=tdom, sdom=sdom, global_bricking_scheme=bricking_scheme, parameter_bounds=None, coverage_type=coverage_type)
 
         self.mode = mode
         if not hasattr(self.master_manager, 'auto_flush_values'):
@@ -133,6 +155,10 @@ class PersistenceLayer(object):
             self.master_manager.value_caching = value_caching
         if not hasattr(self.master_manager, 'coverage_type'):
             self.master_manager.coverage_type = coverage_type
+        if not hasattr(self.master_manager, 'metadata_snapshot'):
+            self.master_manager.metadata_snapshot = metadata_snapshot
+        if not hasattr(self.master_manager, 'writer_backend'):
+            self.master_manager.writer_backend = writer_backend
 
         # TODO: This is not done correctly
         if tdom != None:
@@ -144,7 +170,9 @@ class PersistenceLayer(object):
 
         for pname in self.param_groups:
             log.debug('parameter group: %s', pname)
-            self.parameter_metadata[pname] = ParameterManager(os.path.join(self.root_dir, self.guid, pname), pname)
+            # Parameter files are not opened until the parameter is first used
+            snapshot_attrs = snapshot['params'].get(pname) if snapshot is not None else None
+            self.parameter_metadata[pname] = ParameterManager(os.path.join(self.root_dir, self.guid, pname), pname, lazy_load=True, snapshot_attrs=snapshot_attrs)
 
         if self.mode != 'r':
             if self.master_manager.is_dirty():
@@ -153,8 +181,8 @@ class PersistenceLayer(object):
         if self.mode == 'r' or self.inline_data_writes:
             self.brick_dispatcher = None
         else:
-            self.brick_dispatcher = BrickWriterDispatcher(self.write_failure_callback)
-            self.brick_dispatcher.run()
+            # Coverages share one dispatcher (and its workers) per backend and options; this coverage gets a namespace on it
+            self.brick_dispatcher = acquire_brick_writer_dispatcher(self.writer_backend, self.write_failure_callback, name=guid, **(writer_options or {}))
 
         self._closed = False
 
@@ -181,6 +209,21 @@ class PersistenceLayer(object):
         self.parameter_bounds[parameter_name] = (dmin, dmax)
         self.master_manager.flush()
 
+    def get_materialized_ranges(self, parameter_name):
+        """
+        Returns the temporal index ranges over which the stored values of a materialized parameter function are valid
+
+        @param parameter_name   The name of the parameter
+        @return A sorted list of disjoint, half-open ranges, each a [start, stop] list
+        """
+        return getattr(self.master_manager, 'materialized_ranges', {}).get(parameter_name, [])
+
+    def set_materialized_ranges(self, parameter_name, ranges):
+        # Persisted with the master file on the next flush
+        if not hasattr(self.master_manager, 'materialized_ranges'):
+            self.master_manager.materialized_ranges = {}
+        self.master_manager.materialized_ranges[parameter_name] = ranges
+
     def _init_master(self, tD, bricking_scheme):
         log.debug('Performing Rtree dict setup')
         # tD = parameter_context.dom.total_extents
@@ -295,7 +338,7 @@ class PersistenceLayer(object):
         do_write = True
         brick_guid = ''
         for x,v in self.master_manager.brick_list.iteritems():
-            if brick_extents == v[0]:
+            if tuple(map(tuple, brick_extents)) == tuple(map(tuple, v[0])):
                 log.debug('Brick found with matching extents: guid=%s', x)
                 do_write = False
                 brick_guid = x
@@ -345,6 +388,7 @@ class PersistenceLayer(object):
         self.master_manager.update_rtree(brick_count, rtree_extents, obj=brick_guid)
 
     # Expand the domain
+    @timed('persistence.expand_domain')
     def expand_domain(self, total_extents, do_flush=False):
         """
         Expands a parameter's total domain based on the requested new temporal and/or spatial domains.
@@ -388,7 +432,8 @@ class PersistenceLayer(object):
             # Gather brick origins
             need_origins = set(itertools.product(*lst))
             log.trace('need_origins: %s', need_origins)
-            have_origins = set([v[1] for k,v in self.master_manager.brick_list.iteritems() if (v[2] == v[3])])
+            # Bricks loaded from disk hold lists rather than tuples
+            have_origins = set([tuple(v[1]) for k,v in self.master_manager.brick_list.iteritems() if (tuple(v[2]) == tuple(v[3]))])
             log.trace('have_origins: %s', have_origins)
             need_origins.difference_update(have_origins)
             log.trace('need_origins: %s', need_origins)
@@ -502,16 +547,82 @@ class PersistenceLayer(object):
         if do_flush:
             self.master_manager.flush()
 
+    def refresh(self):
+        """
+        Brings a read-only PersistenceLayer up to date with changes written to the coverage since it was opened
+
+        Only the metadata that has changed is reloaded.  Structures shared with PersistedStorage objects (brick_list,
+        brick_domains, brick_tree and the domains) are updated in place.  Newly added parameters are registered
+        but not loaded.
+
+        @return A tuple of (set of changed master attribute names, list of new parameter names)
+        """
+        if self.mode != 'r':
+            raise IOError('PersistenceLayer can only be refreshed in read mode: mode == \'{0}\''.format(self.mode))
+
+        changed = self.master_manager.refresh()
+        if changed:
+            for pm in self.parameter_metadata.itervalues():
+                if pm.is_loaded:
+                    pm.refresh()
+                else:
+                    # Attributes from the snapshot may no longer be current
+                    pm._snapshot_attrs = None
+
+        new_params = sorted(self.param_groups.difference(self.parameter_metadata))
+        for pname in new_params:
+            log.debug('New parameter group: %s', pname)
+            self.parameter_metadata[pname] = ParameterManager(os.path.join(self.root_dir, self.guid, pname), pname, lazy_load=True)
+
+        return changed, new_params
+
+    def get_brick_signatures(self, parameter_name):
+        """
+        Returns the modification time and size of each file in the brick directory of a parameter
+
+        @param parameter_name   The name of the parameter
+        @return A dict of {file_name: [mtime, size]}
+        """
+        brick_path = self.parameter_metadata[parameter_name].root_dir
+        if not os.path.exists(brick_path):
+            return {}
+
+        ret = {}
+        for fname in os.listdir(brick_path):
+            st = os.stat(os.path.join(brick_path, fname))
+            ret[fname] = [st.st_mtime, st.st_size]
+
+        return ret
+
+    def get_telemetry(self):
+        """
+        Returns a snapshot of the process-wide write path telemetry (see coverage_model.metrics.Telemetry)
+        """
+        return _telemetry.snapshot()
+
+    @timed('persistence.flush_values')
     def flush_values(self):
+        """
+        Submits the queued values of all parameters as a single group of work, with one work item per brick
+
+        @return An AsyncResult set once the submitted values have been written (or, if nothing was queued, once there
+        are no dirty values)
+        """
         if self.mode == 'r':
             log.warn('PersistenceLayer not open for writing: mode=%s', self.mode)
             return
 
+        batch = []
         for k, v in self.value_list.iteritems():
-            v.flush_values()
+            if v.has_dirty_values():
+                batch.extend(v.take_pending_work())
+
+        if len(batch) > 0:
+            return self.brick_dispatcher.put_batch(batch)
 
         return self.get_dirty_values_async_result()
 
+    @timed('persistence.flush')
     def flush(self):
         if self.mode == 'r':
             log.warn('PersistenceLayer not open for writing: mode=%s', self.mode)
@@ -524,15 +635,46 @@ class PersistenceLayer(object):
             log.debug('Flushing ParameterManager for \'%s\'...', pk)
             pm.flush()
 
+    def write_metadata_snapshot(self):
+        """
+        Write the MetadataSnapshot for the current state of the coverage
+
+        Called on close when metadata_snapshot is enabled; not done on every flush, as building the snapshot reads the
+        whole master file (including the brick index)
+
+        @return True if the snapshot was written, False if it was already up to date
+        """
+        if self.mode == 'r':
+            raise IOError('PersistenceLayer not open for writing: mode == \'{0}\''.format(self.mode))
+
+        self.flush()
+        log.debug('Writing MetadataSnapshot...')
+        return self._metadata_snapshot.write(self.master_manager, self.parameter_metadata)
+
     def close(self, force=False, timeout=None):
         if not self._closed:
             if self.mode != 'r':
                 self.flush()
                 if self.brick_dispatcher is not None:
                     self.brick_dispatcher.shutdown(force=force, timeout=timeout)
+                if self.metadata_snapshot:
+                    self._metadata_snapshot.write(self.master_manager, self.parameter_metadata)
 
         self._closed = True
 
+def _stores_binary_objects(file_path, dataset_name):
+    """
+    Indicates if object values for the dataset are stored as raw bytes (vlen uint8)
+
+    Datasets written before binary storage existed keep the legacy (escaped vlen str) format
+    """
+    if os.path.exists(file_path):
+        with h5py.File(file_path, 'r') as f:
+            if dataset_name in f:
+                return is_binary_vlen(f[dataset_name].dtype)
+
+    return True
+
 class PersistedStorage(AbstractStorage):
     """
     A concrete implementation of AbstractStorage utilizing the ParameterManager and brick dispatcher
@@ -556,6 +698,7 @@ class PersistedStorage(AbstractStorage):
 
         # Filesystem path to HDF brick file(s)
         self.brick_path = parameter_manager.root_dir
+        self.parameter_name = parameter_manager.parameter_name
 
         from coverage_model.coverage import DomainSet
         self.total_domain = DomainSet(master_manager.tdom, master_manager.sdom)
@@ -569,18 +712,37 @@ class PersistedStorage(AbstractStorage):
         self.mode = mode
         self.inline_data_writes = inline_data_writes
         self.auto_flush = auto_flush
+        self._binary_bricks = {} # {brick_guid: True if the brick stores objects as raw bytes}
 
     def has_dirty_values(self):
         return len(self._pending_values) > 0
 
+    def _is_binary_brick(self, brick_guid, brick_file_path):
+        if brick_guid not in self._binary_bricks:
+            self._binary_bricks[brick_guid] = _stores_binary_objects(brick_file_path, brick_guid)
+
+        return self._binary_bricks[brick_guid]
+
     def flush_values(self):
         if self.has_dirty_values():
-            for k, v in self._pending_values.iteritems():
-                wk, wm = k
-                for vi in v:
-                    self.brick_dispatcher.put_work(wk, wm, vi)
+            return self.brick_dispatcher.put_batch(self.take_pending_work())
 
-            self._pending_values = {}
+    def take_pending_work(self):
+        """
+        Removes and returns the queued work, with the queued writes to each brick merged into as few writes as possible
+
+        @return A list of (work_key, work_metrics, work) tuples, one per brick
+        """
+        ret = []
+        for (wk, wm), v in self._pending_values.iteritems():
+            # Object values are packed per element and cannot share a buffer
+            dtype = np.dtype(get_storage_dtype(wm[3]))
+            if len(v) > 1 and dtype.kind != 'O':
+                v = [(brick_slice, value) for brick_slice, value, _ in merge_brick_work(v, tuple(wm[1]), dtype)]
+            ret.append((wk, wm, v))
+
+        self._pending_values = {}
+        return ret
 
     def _queue_work(self, work_key, work_metrics, work):
         wk = (work_key, work_metrics)
@@ -641,12 +803,14 @@ class PersistedStorage(AbstractStorage):
             else:
                 log.trace('Found real brick file: %s', brick_file_path)
 
-                with h5py.File(brick_file_path) as brick_file:
+                _telemetry.incr('file_opens')
+                with brick_lock(brick_file_path), h5py.File(brick_file_path, 'r') as brick_file:
                     ret_vals = brick_file[bid][brick_slice]
 
                 # Check if object type
                 if self.dtype == '|O8':
-                    if hasattr(ret_vals, '__iter__'):
+                    # Binary bricks return each value as a uint8 array, so only an object array holds multiple values
+                    if isinstance(ret_vals, np.ndarray) and ret_vals.dtype == np.object_:
                         ret_vals = [self._object_unpack_hook(x) for x in ret_vals]
                     else:
                         ret_vals = self._object_unpack_hook(ret_vals)
@@ -761,6 +925,7 @@ class PersistedStorage(AbstractStorage):
 
             self._set_values_to_brick(bid, brick_slice, v)
 
+    @timed('storage.set_values_to_brick')
     def _set_values_to_brick(self, brick_guid, brick_slice, values, value_slice=None):
         brick_file_path = os.path.join(self.brick_path, '{0}.hdf5'.format(brick_guid))
         log.trace('Brick slice to fill: %s', brick_slice)
@@ -783,20 +948,31 @@ class PersistedStorage(AbstractStorage):
 
         # Check for object type
         if data_type == '|O8':
+            if self._is_binary_brick(brick_guid, brick_file_path):
+                packer = pack_raw
+                data_type = BINARY_OBJECT_DTYPE
+            else:
+                packer = pack
+
             if np.iterable(vals):
-                vals = [pack(x) for x in vals]
+                vals = [packer(x) for x in vals]
             else:
-                vals = pack(vals)
+                vals = packer(vals)
+
+        if _telemetry.enabled:
+            _telemetry.incr('bytes_written.{0}'.format(self.parameter_name), work_size((brick_slice, vals))[1])
 
         if self.inline_data_writes:
-            if data_type == '|O8':
-                data_type = h5py.special_dtype(vlen=str)
             if 0 in cD or 1 in cD:
                 cD = True
-            with h5py.File(brick_file_path, 'a') as f:
+            _telemetry.incr('file_opens')
+            with brick_lock(brick_file_path), h5py.File(brick_file_path, 'a') as f:
                 # TODO: Due to usage concerns, currently locking chunking to "auto"
-                f.require_dataset(brick_guid, shape=bD, dtype=data_type, chunks=None, fillvalue=fv)
-                f[brick_guid][brick_slice] = vals
+                f.require_dataset(brick_guid, shape=bD, dtype=get_storage_dtype(data_type), chunks=None, fillvalue=fv)
+                if data_type == BINARY_OBJECT_DTYPE:
+                    write_binary_values(f[brick_guid], brick_slice, vals)
+                else:
+                    f[brick_guid][brick_slice] = vals
         else:
             work_key = brick_guid
             work = (brick_slice, vals)
@@ -807,13 +983,12 @@ class PersistedStorage(AbstractStorage):
 
             # If the brick file doesn't exist, 'touch' it to make sure it's immediately available
             if not os.path.exists(brick_file_path):
-                if data_type == '|O8':
-                    data_type = h5py.special_dtype(vlen=str)
                 if 0 in cD or 1 in cD:
                     cD = True
-                with h5py.File(brick_file_path, 'a') as f:
+                _telemetry.incr('file_opens')
+                with brick_lock(brick_file_path), h5py.File(brick_file_path, 'a') as f:
                     # TODO: Due to usage concerns, currently locking chunking to "auto"
-                    f.require_dataset(brick_guid, shape=bD, dtype=data_type, chunks=None, fillvalue=fv)
+                    f.require_dataset(brick_guid, shape=bD, dtype=get_storage_dtype(data_type), chunks=None, fillvalue=fv)
 
             if self.auto_flush:
                 # Immediately submit work to the dispatcher
@@ -857,6 +1032,7 @@ class SparsePersistedStorage(AbstractStorage):
 
         # Filesystem path to HDF brick file(s)
         self.brick_path = parameter_manager.root_dir
+        self.parameter_name = parameter_manager.parameter_name
 
         from coverage_model.coverage import DomainSet
         self.total_domain = DomainSet(master_manager.tdom, master_manager.sdom)
@@ -870,18 +1046,24 @@ class SparsePersistedStorage(AbstractStorage):
         self.mode = mode
         self.inline_data_writes = inline_data_writes
         self.auto_flush = auto_flush
+        self._binary = None # True if the values are stored as raw bytes; determined on first write
 
     def has_dirty_values(self):
         return len(self._pending_values) > 0
 
     def flush_values(self):
         if self.has_dirty_values():
-            for k, v in self._pending_values.iteritems():
-                wk, wm = k
-                for vi in v:
-                    self.brick_dispatcher.put_work(wk, wm, vi)
+            return self.brick_dispatcher.put_batch(self.take_pending_work())
 
-            self._pending_values = {}
+    def take_pending_work(self):
+        """
+        Removes and returns the queued work
+
+        @return A list of (work_key, work_metrics, work) tuples, one per brick
+        """
+        ret = [(wk, wm, v) for (wk, wm), v in self._pending_values.iteritems()]
+        self._pending_values = {}
+        return ret
 
     def _queue_work(self, work_key, work_metrics, work):
         wk = (work_key, work_metrics)
@@ -900,20 +1082,23 @@ class SparsePersistedStorage(AbstractStorage):
         brick_file_path = '{0}/{1}.hdf5'.format(self.brick_path, bid)
 
         if os.path.exists(brick_file_path):
-            with h5py.File(brick_file_path) as f:
+            _telemetry.incr('file_opens')
+            with brick_lock(brick_file_path), h5py.File(brick_file_path, 'r') as f:
                 ret_vals = f[bid][0]
         else:
             ret_vals = None
 
-        if ret_vals is None:
+        binary = isinstance(ret_vals, np.ndarray)
+        if ret_vals is None or (binary and len(ret_vals) == 0):
             return self.fill_value
 
         ret_vals = unpack(ret_vals)
 
-        ret = [self.__deserialize(v) for v in ret_vals]
+        ret = [self.__deserialize(v, binary) for v in ret_vals]
 
         return ret
 
+    @timed('storage.set_sparse_values')
     def __setitem__(self, slice_, value):
         # Always storing in first slot - ignore slice
         bid = 'sparse_value_brick'
@@ -922,19 +1107,30 @@ class SparsePersistedStorage(AbstractStorage):
         cD = None
         brick_file_path = '{0}/{1}.hdf5'.format(self.brick_path, bid)
 
-        vals = [self.__serialize(v) for v in value]
+        if self._binary is None:
+            self._binary = _stores_binary_objects(brick_file_path, bid)
 
-        vals = pack(vals)
+        vals = [self.__serialize(v, self._binary) for v in value]
 
         set_arr = np.empty(1, dtype=object)
-        set_arr[0] = vals
+        if self._binary:
+            set_arr[0] = pack_raw(vals)
+            data_type = BINARY_OBJECT_DTYPE
+        else:
+            set_arr[0] = pack(vals)
+            data_type = '|O8'
 
-        data_type = h5py.special_dtype(vlen=str)
+        if _telemetry.enabled:
+            _telemetry.incr('bytes_written.{0}'.format(self.parameter_name), len(set_arr[0]))
 
         if self.inline_data_writes:
-            with h5py.File(brick_file_path, 'a') as f:
-                f.require_dataset(bid, shape=bD, dtype=data_type, chunks=cD, fillvalue=None)
-                f[bid][0] = set_arr
+            _telemetry.incr('file_opens')
+            with brick_lock(brick_file_path), h5py.File(brick_file_path, 'a') as f:
+                f.require_dataset(bid, shape=bD, dtype=get_storage_dtype(data_type), chunks=cD, fillvalue=None)
+                if self._binary:
+                    write_binary_values(f[bid], 0, set_arr[0])
+                else:
+                    f[bid][0] = set_arr
         else:
             work_key = bid
             work = ((0,), set_arr)
@@ -942,9 +1138,10 @@ class SparsePersistedStorage(AbstractStorage):
 
             # If the brick file doesn't exist, 'touch' it to make sure it's immediately available
             if not os.path.exists(brick_file_path):
-                with h5py.File(brick_file_path, 'a') as f:
+                _telemetry.incr('file_opens')
+                with brick_lock(brick_file_path), h5py.File(brick_file_path, 'a') as f:
                     # TODO: Due to usage concerns, currently locking chunking to "auto"
-                    f.require_dataset(bid, shape=bD, dtype=data_type, chunks=cD, fillvalue=None)
+                    f.require_dataset(bid, shape=bD, dtype=get_storage_dtype(data_type), chunks=cD, fillvalue=None)
 
             if self.auto_flush:
                 # Immediately submit work to the dispatcher
@@ -953,22 +1150,20 @@ class SparsePersistedStorage(AbstractStorage):
                 # Queue the work for later flushing
                 self._queue_work(work_key, work_metrics, work)
 
-    def __deserialize(self, payload):
+    def __deserialize(self, payload, binary):
         if isinstance(payload, basestring) and payload.startswith('DICTABLE'):
             i = payload.index('|', 9)
             smod, sclass = payload[9:i].split(':')
-            value = unpack(payload[i + 1:])
-            module = __import__(smod, fromlist=[sclass])
-            classobj = getattr(module, sclass)
-            payload = classobj._fromdict(value)
+            value = unpack_raw(payload[i + 1:]) if binary else unpack(payload[i + 1:])
+            payload = get_class(smod, sclass)._fromdict(value)
 
         return payload
 
-    def __serialize(self, payload):
+    def __serialize(self, payload, binary):
         from coverage_model.basic_types import Dictable
         if isinstance(payload, Dictable):
             prefix = 'DICTABLE|{0}:{1}|'.format(payload.__module__, payload.__class__.__name__)
-            payload = prefix + pack(payload.dump())
+            payload = prefix + (pack_raw(payload.dump()) if binary else pack(payload.dump()))
 
         return payload
 
@@ -1012,6 +1207,12 @@ class InMemoryPersistenceLayer(object):
             dmax = max(dmax, pmax)
         self.parameter_bounds[parameter_name] = (dmin, dmax)
 
+    def get_materialized_ranges(self, parameter_name):
+        return self.__dict__.get('materialized_ranges', {}).get(parameter_name, [])
+
+    def set_materialized_ranges(self, parameter_name, ranges):
+        self.__dict__.setdefault('materialized_ranges', {})[parameter_name] = ranges
+
     def get_dirty_values_async_result(self):
         from gevent.event import AsyncResult
         ret = AsyncResult()
@@ -10,25 +10,133 @@
 from pyon.core.interceptor.encode import encode_ion, decode_ion
 from ooi.logging import log
 from coverage_model.basic_types import Dictable
+from coverage_model.metrics import timed
 from coverage_model import utils
 
 import os
+import struct
 import h5py
+from h5py import h5s, h5t
+from gevent.monkey import get_original
+from h5py._hl import selections
 import msgpack
+import numpy as np
+
+# Binary attributes must fit in the object header (64KB) - larger values are stored as escaped strings
+MAX_BINARY_ATTR_SIZE = 60000
+# Stand-in for the object dtype ('|O8') when values are stored as raw bytes in a BINARY_VLEN_DTYPE dataset
+BINARY_OBJECT_DTYPE = 'vlen_uint8'
+BINARY_VLEN_DTYPE = h5py.special_dtype(vlen=np.dtype('uint8'))
+
+
+def pack_raw(payload):
+    return msgpack.packb(payload, default=encode_ion)
+
+
+def unpack_raw(msg):
+    return msgpack.unpackb(msg, object_hook=decode_ion)
+
+
+def escape(msg):
+    # vlen strings cannot contain null bytes
+    return msg.replace('\x01','\x01\x02').replace('\x00','\x01\x01')
+
+
+def unescape(msg):
+    return msg.replace('\x01\x01','\x00').replace('\x01\x02','\x01')
 
 
 def pack(payload):
-    return msgpack.packb(payload, default=encode_ion).replace('\x01','\x01\x02').replace('\x00','\x01\x01')
+    return escape(pack_raw(payload))
 
 
 def unpack(msg):
-    return msgpack.unpackb(msg.replace('\x01\x01','\x00').replace('\x01\x02','\x01'), object_hook=decode_ion)
+    if isinstance(msg, (np.void, np.ndarray)):
+        # Binary attribute or vlen uint8 element - raw msgpack
+        return unpack_raw(msg.tostring())
+
+    # Legacy escaped string
+    return unpack_raw(unescape(msg))
+
+
+def is_binary_vlen(dtype):
+    """
+    Indicates if dtype is the vlen uint8 dtype used to store raw bytes (as opposed to the legacy vlen str)
+    """
+    return h5py.check_dtype(vlen=dtype) not in (None, str, unicode)
+
+
+def get_storage_dtype(data_type):
+    """
+    Resolve the dtype used to create a brick dataset; object types are stored as vlen str (legacy) or vlen uint8
+    """
+    if data_type == '|O8':
+        return h5py.special_dtype(vlen=str)
+    elif data_type == BINARY_OBJECT_DTYPE:
+        return BINARY_VLEN_DTYPE
+
+    return data_type
+
+
+def to_binary_array(vals):
+    """
+    Convert a raw byte string, or a list of them, to the uint8 array(s) written to a BINARY_VLEN_DTYPE dataset
+    """
+    if isinstance(vals, basestring):
+        return np.frombuffer(vals, dtype=np.uint8)
+
+    ret = np.empty(len(vals), dtype=object)
+    for i, v in enumerate(vals):
+        ret[i] = np.frombuffer(v, dtype=np.uint8)
+
+    return ret
+
+
+def write_binary_values(ds, slice_, vals):
+    """
+    Write a raw byte string, or a list of them, to the selection slice_ of a BINARY_VLEN_DTYPE dataset
+
+    A single string is written to every element selected.  The values are written in one call to the low-level
+    dataset: h5py coerces equally sized elements into a 2d array (and cannot broadcast one), so ds[slice_] = ... fails
+    for them
+    """
+    sel = selections.select(ds.shape, tuple(slice_) if isinstance(slice_, list) else slice_, ds.id)
+    if isinstance(vals, basestring):
+        arr = np.empty(sel.nselect, dtype=object)
+        arr.fill(to_binary_array(vals))
+    else:
+        arr = to_binary_array(vals)
+        if len(arr) != sel.nselect:
+            raise ValueError('Cannot write {0} values to a selection of {1} elements'.format(len(arr), sel.nselect))
+
+    ds.id.write(h5s.create_simple((sel.nselect,)), sel.id, arr, mtype=h5t.py_create(ds.dtype))
+
+
+# Real (not monkey-patched) locks - they are shared with the threads of a ThreadedBrickWriterDispatcher
+_allocate_lock = get_original('thread', 'allocate_lock')
+_brick_locks = {}
+_brick_locks_lock = _allocate_lock()
+
+def brick_lock(path):
+    """
+    Returns the lock serializing the opening of the brick file at path among the threads of this process
+
+    HDF5 refuses to open a file for writing while it is open elsewhere in the same process, so brick files are only
+    opened while holding this lock; other processes have their own HDF5 library and are not affected
+
+    @param path The path of the brick file
+    """
+    with _brick_locks_lock:
+        if path not in _brick_locks:
+            _brick_locks[path] = _allocate_lock()
+
+        return _brick_locks[path]
 
 
 def get_coverage_type(path):
     ctype = 'simplex'
     if os.path.exists(path):
-        with h5py.File(path) as f:
+        with h5py.File(path, 'r') as f:
             if 'coverage_type' in f.attrs:
                 ctype = unpack(f.attrs['coverage_type'])
 
@@ -94,18 +202,24 @@ class RTreeProxy(object):
 
 class BaseManager(object):
 
-    def __init__(self, root_dir, file_name, **kwargs):
+    def __init__(self, root_dir, file_name, lazy_load=False, snapshot_attrs=None, **kwargs):
         super(BaseManager, self).__setattr__('_hmap',{})
         super(BaseManager, self).__setattr__('_dirty',set())
         super(BaseManager, self).__setattr__('_ignore',set())
+        super(BaseManager, self).__setattr__('_pending_load',lazy_load)
+        super(BaseManager, self).__setattr__('_snapshot_attrs',snapshot_attrs)
+        super(BaseManager, self).__setattr__('_raw_attrs',{})
+        super(BaseManager, self).__setattr__('_signature',None)
         self.root_dir = root_dir
         self.file_path = os.path.join(root_dir, file_name)
 
-        if not os.path.exists(self.root_dir):
-            os.makedirs(self.root_dir)
+        # When lazy, the filesystem isn't touched until an attribute that was not explicitly set is requested
+        if not lazy_load:
+            if not os.path.exists(self.root_dir):
+                os.makedirs(self.root_dir)
 
-        if os.path.exists(self.file_path):
-            self._load()
+            if os.path.exists(self.file_path):
+                self._load()
 
         for k, v in kwargs.iteritems():
             # Don't overwrite with None
@@ -123,11 +237,15 @@ class BaseManager(object):
     #                    log.debug('FLUSH: key=%s  v=%s', k, v)
                         if isinstance(v, Dictable):
                             prefix='DICTABLE|{0}:{1}|'.format(v.__module__, v.__class__.__name__)
-                            value = prefix + pack(v.dump())
+                            raw = pack_raw(v.dump())
                         else:
-                            value = pack(v)
+                            prefix = ''
+                            raw = pack_raw(v)
 
-                        f.attrs[k] = value
+                        if len(prefix) + len(raw) <= MAX_BINARY_ATTR_SIZE:
+                            f.attrs[k] = np.void(prefix + raw)
+                        else:
+                            f.attrs[k] = prefix + escape(raw)
 
                         # Update the hash_value in _hmap
                         self._hmap[k] = utils.hash_any(v)
@@ -141,23 +259,89 @@ class BaseManager(object):
 
             super(BaseManager, self).__setattr__('_is_dirty',False)
 
+    def __getattr__(self, key):
+        # Only called when normal attribute lookup fails - complete any deferred load and try again
+        if not key.startswith('_') and self.__dict__.get('_pending_load', False):
+            self._complete_load()
+            return getattr(self, key)
+
+        raise AttributeError('\'{0}\' object has no attribute \'{1}\''.format(self.__class__.__name__, key))
+
+    def _complete_load(self):
+        super(BaseManager, self).__setattr__('_pending_load',False)
+
+        # Attributes set since construction take precedence over the persisted ones
+        preset = dict((k, v) for k, v in self.__dict__.iteritems() if not k.startswith('_'))
+        if self._snapshot_attrs is not None:
+            # The raw attributes were provided by a MetadataSnapshot - no need to open the file
+            self._load_attrs(self._snapshot_attrs.iteritems())
+        else:
+            if not os.path.exists(self.root_dir):
+                os.makedirs(self.root_dir)
+
+            if not os.path.exists(self.file_path):
+                return
+
+            self._load()
+
+        for k, v in preset.iteritems():
+            setattr(self, k, v)
+
+    @property
+    def is_loaded(self):
+        return not self._pending_load
+
+    def refresh(self):
+        """
+        Reload the attributes that have changed on disk since the last load or refresh
+
+        Nothing is read if the modification time and size of the file are unchanged
+
+        @return A set of the names of the attributes that changed
+        """
+        if self._pending_load or not os.path.exists(self.file_path):
+            return set()
+
+        sig = _file_signature(self.file_path)
+        if sig == self._signature:
+            return set()
+
+        with h5py.File(self.file_path, 'r') as f:
+            return self._refresh(f, sig)
+
+    def _refresh(self, f, sig):
+        super(BaseManager, self).__setattr__('_signature',sig)
+        items = [(k, v) for k, v in f.attrs.iteritems() if self._raw_attrs.get(k) != _raw_attr(v)]
+        self._load_attrs(items)
+
+        return set(k for k, v in items)
+
     def _load(self):
         raise NotImplementedError('Not implemented by base class')
 
     def _base_load(self, f):
-        for key, val in f.attrs.iteritems():
+        super(BaseManager, self).__setattr__('_signature',_file_signature(self.file_path))
+        self._load_attrs(f.attrs.iteritems())
+
+    def _load_attrs(self, items):
+        for key, val in items:
+            # Binary (opaque) attributes hold raw msgpack, string attributes the legacy escaped form
+            binary = isinstance(val, np.void)
+            if binary:
+                val = val.tostring()
+            # Keep the raw value so refresh can tell which attributes have changed
+            self._raw_attrs[key] = val
+
             if isinstance(val, basestring) and val.startswith('DICTABLE'):
                 i = val.index('|', 9)
                 smod, sclass = val[9:i].split(':')
-                value = unpack(val[i+1:])
-                module = __import__(smod, fromlist=[sclass])
-                classobj = getattr(module, sclass)
-                value = classobj._fromdict(value)
+                value = unpack_raw(val[i+1:]) if binary else unpack(val[i+1:])
+                value = utils.get_class(smod, sclass)._fromdict(value)
             elif key in ('root_dir', 'file_path'):
                 # No op - set in constructor
                 continue
             else:
-                value = unpack(val)
+                value = unpack_raw(val) if binary else unpack(val)
 
             if isinstance(value, tuple):
                 value = list(value)
@@ -191,7 +375,9 @@ class BaseManager(object):
 
 class MasterManager(BaseManager):
 
-    def __init__(self, root_dir, guid, **kwargs):
+    def __init__(self, root_dir, guid, snapshot=None, **kwargs):
+        # Set before BaseManager.__init__ so that _load can make use of it
+        object.__setattr__(self, '_snapshot_data', snapshot)
         BaseManager.__init__(self, root_dir=os.path.join(root_dir,guid), file_name='{0}_master.hdf5'.format(guid), **kwargs)
         self.guid = guid
         if hasattr(self, 'parameter_bounds') and self.parameter_bounds is None:
@@ -202,6 +388,10 @@ class MasterManager(BaseManager):
         if not hasattr(self, 'param_groups'):
             self.param_groups = set()
 
+    @timed('master.flush')
+    def flush(self):
+        super(MasterManager, self).flush()
+
     def update_rtree(self, count, extents, obj):
         log.debug('MM count: {0}'.format(count))
         if not hasattr(self, 'brick_tree'):
@@ -209,9 +399,14 @@ class MasterManager(BaseManager):
 
         log.debug('self.file_path: {0}'.format(self.file_path))
         with h5py.File(self.file_path, 'a') as f:
-            rtree_ds = f.require_dataset('rtree', shape=(count,), dtype=h5py.special_dtype(vlen=str), maxshape=(None,))
+            # Keep appending to a legacy (vlen str) rtree in its own format
+            dtype = f['rtree'].dtype if 'rtree' in f.keys() else BINARY_VLEN_DTYPE
+            rtree_ds = f.require_dataset('rtree', shape=(count,), dtype=dtype, maxshape=(None,))
             rtree_ds.resize((count+1,))
-            rtree_ds[count] = pack((extents, obj))
+            if is_binary_vlen(rtree_ds.dtype):
+                write_binary_values(rtree_ds, count, pack_raw((extents, obj)))
+            else:
+                rtree_ds[count] = pack((extents, obj))
 
             self.brick_tree.insert(count, extents, obj=obj)
 
@@ -219,6 +414,14 @@ class MasterManager(BaseManager):
         self.brick_tree = RTreeProxy()
 
     def _load(self):
+        if self._snapshot_data is not None:
+            # The snapshot has been verified against the current signature of the master file
+            super(MasterManager, self).__setattr__('_signature',_file_signature(self.file_path))
+            self._load_attrs(self._snapshot_data['master'].iteritems())
+            self.param_groups = set(self._snapshot_data['param_groups'])
+            self._load_rtree(self._snapshot_data['rtree'])
+            return
+
         with h5py.File(self.file_path, 'r') as f:
             self._base_load(f)
 
@@ -230,20 +433,55 @@ class MasterManager(BaseManager):
             # Don't forget brick_tree!
             if 'rtree' in f.keys():
                 # Populate brick tree from the 'rtree' dataset
-                ds = f['/rtree']
+                self._load_rtree(f['/rtree'][:])
+            else:
+                setattr(self, 'brick_tree', RTreeProxy())
 
-                def tree_loader(darr):
-                    for i, x in enumerate(darr):
-                        ext, obj = unpack(x)
-                        yield (i, ext, obj)
+    def _load_rtree(self, entries):
+        rtp = RTreeProxy()
+        for i, x in enumerate(entries):
+            ext, obj = unpack(x)
+            rtp.insert(i, ext, obj)
+
+        setattr(self, 'brick_tree', rtp)
+        super(MasterManager, self).__setattr__('_rtree_count',len(entries))
+
+    def _refresh(self, f, sig):
+        # Keep the identity of the objects shared with storage and domain objects - update them in place instead
+        previous = dict((k, self.__dict__[k]) for k in ('tdom', 'sdom', 'brick_list', 'brick_domains', 'parameter_bounds') if k in self.__dict__)
+        changed = BaseManager._refresh(self, f, sig)
+        for k in changed.intersection(previous):
+            old, new = previous[k], getattr(self, k)
+            if isinstance(old, dict) and isinstance(new, dict):
+                old.clear()
+                old.update(new)
+            elif isinstance(old, list) and isinstance(new, list):
+                old[:] = new
+            elif isinstance(old, Dictable) and type(old) is type(new):
+                old.__dict__.update(new.__dict__)
+            else:
+                continue
 
-                rtp = RTreeProxy()
-                for x in tree_loader(ds[:]):
-                    rtp.insert(*x)
+            setattr(self, k, old)
 
-                setattr(self, 'brick_tree', rtp)
-            else:
-                setattr(self, 'brick_tree', RTreeProxy())
+        groups = set()
+        f.visit(groups.add)
+        groups.discard('rtree')
+        self.param_groups.update(groups)
+
+        # The rtree is append-only - only insert the new entries
+        if 'rtree' in f.keys() and hasattr(self, 'brick_tree'):
+            count = getattr(self, '_rtree_count', 0)
+            rtree_ds = f['rtree']
+            if rtree_ds.shape[0] > count:
+                for i, x in enumerate(rtree_ds[count:]):
+                    ext, obj = unpack(x)
+                    self.brick_tree.insert(count+i, ext, obj)
+
+                super(MasterManager, self).__setattr__('_rtree_count',rtree_ds.shape[0])
+                changed.add('brick_tree')
+
+        return changed
 
     def add_external_link(self, link_path, rel_ext_path, link_name):
         with h5py.File(self.file_path, 'r+') as f:
@@ -256,8 +494,8 @@ class MasterManager(BaseManager):
 
 class ParameterManager(BaseManager):
 
-    def __init__(self, root_dir, parameter_name, read_only=True, **kwargs):
-        BaseManager.__init__(self, root_dir=root_dir, file_name='{0}.hdf5'.format(parameter_name), **kwargs)
+    def __init__(self, root_dir, parameter_name, read_only=True, lazy_load=False, **kwargs):
+        BaseManager.__init__(self, root_dir=root_dir, file_name='{0}.hdf5'.format(parameter_name), lazy_load=lazy_load, **kwargs)
         self.parameter_name = parameter_name
         self.read_only = read_only
 
@@ -267,6 +505,7 @@ class ParameterManager(BaseManager):
     def thin_origins(self, origins):
         pass
 
+    @timed('parameter.flush')
     def flush(self):
         if not self.read_only:
             super(ParameterManager, self).flush()
@@ -275,3 +514,151 @@ class ParameterManager(BaseManager):
         with h5py.File(self.file_path, 'r') as f:
             self._base_load(f)
 
+
+
+SNAPSHOT_MAGIC = 'CMSNAP'
+SNAPSHOT_VERSION = 2
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size]
+
+
+def _raw_attr(val):
+    return val.tostring() if isinstance(val, np.void) else val
+
+
+def _snapshot_encode(val):
+    # Binary values (opaque attributes, vlen uint8 elements) are wrapped in a list; strings are kept as-is
+    if isinstance(val, (np.void, np.ndarray)):
+        return [val.tostring()]
+
+    return val
+
+
+def _snapshot_decode(val):
+    if isinstance(val, (list, tuple)):
+        return np.void(val[0])
+
+    return val
+
+
+class MetadataSnapshot(object):
+    """
+    A single-file copy of the metadata needed to open a coverage: the raw master attributes, the parameter groups,
+    the brick index (rtree) and the raw attributes of each parameter file.
+
+    The snapshot records the modification time and size of every file it was built from and is ignored by readers
+    if any of them has changed since.
+    """
+
+    def __init__(self, root_dir, guid):
+        """
+        Constructor for MetadataSnapshot
+
+        @param root_dir The directory of the coverage (/<root>/<guid>)
+        @param guid The guid of the coverage
+        """
+        self.root_dir = root_dir
+        self.file_path = os.path.join(root_dir, '{0}_metadata.snapshot'.format(guid))
+        self._signatures = None
+        # {parameter_name: (signature, attrs)} - parameter files rarely change, avoid reopening them
+        self._param_cache = {}
+
+    def _rel_path(self, path):
+        return os.path.relpath(path, self.root_dir)
+
+    def read(self):
+        """
+        Read the snapshot
+
+        @return A dict of metadata, or None if the snapshot does not exist, is from another version or is stale
+        """
+        if not os.path.exists(self.file_path):
+            return None
+
+        try:
+            with open(self.file_path, 'rb') as f:
+                data = f.read()
+
+            hlen = len(SNAPSHOT_MAGIC)
+            if not data.startswith(SNAPSHOT_MAGIC):
+                log.warn('Ignoring metadata snapshot with unknown format: %s', self.file_path)
+                return None
+
+            version = struct.unpack('>H', data[hlen:hlen+2])[0]
+            if version != SNAPSHOT_VERSION:
+                log.debug('Ignoring metadata snapshot with version %s (expected %s)', version, SNAPSHOT_VERSION)
+                return None
+
+            snap = msgpack.unpackb(data[hlen+2:])
+        except Exception, ex:
+            log.warn('Unable to read metadata snapshot \'%s\': %s', self.file_path, ex)
+            return None
+
+        for rel_path, sig in snap['signatures'].iteritems():
+            path = os.path.join(self.root_dir, rel_path)
+            if not os.path.exists(path) or _file_signature(path) != list(sig):
+                log.debug('Metadata snapshot is stale: %s', rel_path)
+                return None
+
+        snap['master'] = dict((k, _snapshot_decode(v)) for k, v in snap['master'].iteritems())
+        snap['params'] = dict((p, dict((k, _snapshot_decode(v)) for k, v in attrs.iteritems())) for p, attrs in snap['params'].iteritems())
+        snap['rtree'] = [_snapshot_decode(v) for v in snap['rtree']]
+
+        return snap
+
+    def write(self, master_manager, parameter_managers):
+        """
+        Write the snapshot if any of the underlying files have changed since it was last written
+
+        @param master_manager   The MasterManager of the coverage
+        @param parameter_managers   A dict of {parameter_name: ParameterManager}
+        @return True if the snapshot was written
+        """
+        if not os.path.exists(master_manager.file_path):
+            return False
+
+        sigs = {self._rel_path(master_manager.file_path): _file_signature(master_manager.file_path)}
+        params = {}
+        for pname, pm in parameter_managers.iteritems():
+            if not os.path.exists(pm.file_path):
+                continue
+
+            psig = _file_signature(pm.file_path)
+            cached = self._param_cache.get(pname)
+            if cached is None or cached[0] != psig:
+                with h5py.File(pm.file_path, 'r') as f:
+                    cached = (psig, dict((k, _snapshot_encode(v)) for k, v in f.attrs.iteritems()))
+                self._param_cache[pname] = cached
+
+            sigs[self._rel_path(pm.file_path)] = psig
+            params[pname] = cached[1]
+
+        if sigs == self._signatures and os.path.exists(self.file_path):
+            return False
+
+        with h5py.File(master_manager.file_path, 'r') as f:
+            master_attrs = dict((k, _snapshot_encode(v)) for k, v in f.attrs.iteritems())
+            param_groups = set()
+            f.visit(param_groups.add)
+            param_groups.discard('rtree')
+            rtree = [_snapshot_encode(v) for v in f['rtree'][:]] if 'rtree' in f.keys() else []
+
+        payload = {
+            'signatures': sigs,
+            'master': master_attrs,
+            'param_groups': list(param_groups),
+            'params': params,
+            'rtree': rtree,
+        }
+
+        # Write to a temporary file and move it into place so readers never see a partial snapshot
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + struct.pack('>H', SNAPSHOT_VERSION) + msgpack.packb(payload))
+        os.rename(tmp_path, self.file_path)
+
+        self._signatures = sigs
+        return True
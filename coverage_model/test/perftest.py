@@ -119,6 +119,127 @@ def run_perf_get_test(root_dir, guid):
 
     return arr
 
+# run_perf_open_test(param_counts=[1,10,50,100,200], repeat=5)
+def run_perf_open_test(param_counts=[1, 10, 50, 100], timesteps=100, repeat=5, metadata_snapshot=False):
+    """
+    Measure the time to open an existing coverage (and read one parameter) as the number of parameters grows
+
+    Pass metadata_snapshot=True to compare against coverages opened from a MetadataSnapshot
+    """
+    results = {}
+    for pcount in param_counts:
+        pdict = ParameterDictionary()
+        t_ctxt = ParameterContext('time', param_type=QuantityType(value_encoding=np.dtype('int64')), variability=VariabilityEnum.TEMPORAL)
+        t_ctxt.axis = AxisTypeEnum.TIME
+        pdict.add_context(t_ctxt)
+        for i in xrange(pcount - 1):
+            pdict.add_context(ParameterContext('param_{0}'.format(i), param_type=QuantityType(value_encoding=np.dtype('float32'))))
+
+        tdom = GridDomain(GridShape('temporal', [0]), CRS([AxisTypeEnum.TIME]), MutabilityEnum.EXTENSIBLE)
+        scov = SimplexCoverage('test_data', create_guid(), 'open latency test coverage', pdict, temporal_domain=tdom, metadata_snapshot=metadata_snapshot)
+        scov.insert_timesteps(timesteps)
+        scov.set_time_values(np.arange(timesteps))
+        scov_path = scov.persistence_dir
+        scov.close()
+
+        open_timer = []
+        read_timer = []
+        for r in xrange(repeat):
+            st = time.time()
+            cov = AbstractCoverage.load(scov_path, mode='r')
+            open_timer.append(time.time() - st)
+
+            st = time.time()
+            cov.get_time_values()
+            read_timer.append(time.time() - st)
+            cov.close()
+
+        open_avg = sum(open_timer) / len(open_timer)
+        read_avg = sum(read_timer) / len(read_timer)
+        print 'Parameters: {0}\tOpen Average: {1:.6f}s\tFirst Read Average: {2:.6f}s'.format(pcount, open_avg, read_avg)
+        results[pcount] = (open_avg, read_avg)
+
+    return results
+
+def run_perf_dictable_test(num_contexts=100, repeat=10):
+    """
+    Measure the time to dump and load a ParameterDictionary via the Dictable machinery
+    """
+    from coverage_model.parameter import ParameterDictionary, ParameterContext
+    ptypes = [lambda: QuantityType(value_encoding=np.dtype('float32')),
+              lambda: ArrayType(),
+              lambda: CategoryType(categories={0: 'a', 1: 'b'}),
+              lambda: ConstantType(QuantityType(value_encoding=np.dtype('int32'))),
+              lambda: RecordType()]
+
+    pdict = ParameterDictionary()
+    t_ctxt = ParameterContext('time', param_type=QuantityType(value_encoding=np.dtype('int64')), variability=VariabilityEnum.TEMPORAL)
+    t_ctxt.axis = AxisTypeEnum.TIME
+    pdict.add_context(t_ctxt)
+    for i in xrange(num_contexts - 1):
+        pdict.add_context(ParameterContext('param_{0}'.format(i), param_type=ptypes[i % len(ptypes)]()))
+
+    dump_timer = []
+    load_timer = []
+    for r in xrange(repeat):
+        st = time.time()
+        d = pdict.dump()
+        dump_timer.append(time.time() - st)
+
+        st = time.time()
+        ParameterDictionary.load(d)
+        load_timer.append(time.time() - st)
+
+    dump_avg = sum(dump_timer) / len(dump_timer)
+    load_avg = sum(load_timer) / len(load_timer)
+    print 'Contexts: {0}\tDump Average: {1:.6f}s\tLoad Average: {2:.6f}s'.format(num_contexts, dump_avg, load_avg)
+
+    return dump_avg, load_avg
+
+def run_perf_telemetry_test(size=1000, limit=20000, brick_size=10000, chunk_size=1000, dtype='int64'):
+    """
+    Fill a coverage with telemetry enabled and print the per-stage latencies and counters
+    """
+    from coverage_model.metrics import get_telemetry
+    tel = get_telemetry()
+    tel.reset()
+    tel.enable()
+    try:
+        scov = _make_cov(brick_size, chunk_size, dtype=dtype)
+        _fill(scov, size, limit)
+        scov.close()
+        snap = tel.snapshot()
+    finally:
+        tel.disable()
+        tel.reset()
+
+    for name, lat in sorted(snap['latencies'].iteritems()):
+        print '{0:40}count: {1:6}\tmean: {2:.6f}s\tp99: {3:.6f}s\tmax: {4:.6f}s'.format(name, lat['count'], lat['mean'], lat['p99'], lat['max'])
+    for name, val in sorted(snap['counters'].iteritems()):
+        print '{0:40}{1}'.format(name, val)
+
+    return snap
+
+def run_perf_function_eval_test(slice_size=10, repeat=10000):
+    """
+    Measure the average time to evaluate NumExpr and Python parameter functions over a small slice
+    """
+    from coverage_model.parameter_functions import NumexprFunction, PythonFunction
+    vals = np.arange(slice_size, dtype='float64')
+    pval_callback = lambda name, slice_: vals
+    funcs = [NumexprFunction('numexpr', 'a*10+b', ['a', 'b'], {'a': 'a', 'b': 'b'}),
+             PythonFunction('python', 'coverage_model.test.test_parameter_functions', 'pyfunc', ['a', 'b'])]
+
+    results = {}
+    for func in funcs:
+        st = time.time()
+        for r in xrange(repeat):
+            func.evaluate(pval_callback, slice(None))
+        results[func.name] = (time.time() - st) / repeat
+        print 'Function: {0}	Average: {1:.8f}s'.format(func.name, results[func.name])
+
+    return results
+
 def size_dir(d):
     import os
     from os.path import join, getsize
@@ -10,9 +10,27 @@
 from nose.plugins.attrib import attr
 from coverage_model import CoverageModelUnitTestCase
 
-from coverage_model.basic_types import Span, NdSpan
+from coverage_model.basic_types import Span, NdSpan, Dictable, _get_spec
 import numpy as np
 
+
+class _PlainDictable(Dictable):
+
+    def __init__(self, name, dtype=None):
+        self.name = name
+        self.dtype = dtype or np.dtype('float32')
+        self.children = []
+
+
+class _ExcludingDictable(Dictable):
+
+    def __init__(self, name):
+        self.name = name
+        self._cache = {}
+
+    def _todict(self, exclude=None):
+        return super(_ExcludingDictable, self)._todict(exclude=['_cache'])
+
 @attr('UNIT', group='now')
 class TestBasicTypesUnit(CoverageModelUnitTestCase):
 
@@ -87,4 +105,32 @@ class TestBasicTypesUnit(CoverageModelUnitTestCase):
         self.assertEqual(s.shape, (20, 4, 9))
         self.assertEqual(len(s), 20 * 4 * 9)
 
-    
\ No newline at end of file
+    
+
+    def test_dictable_round_trip(self):
+        obj = _PlainDictable('one', np.dtype('int16'))
+        obj.children = [_PlainDictable('two'), (1, 'a')]
+
+        for i in xrange(2):
+            # The first load goes through the initializer, subsequent loads may skip it
+            ret = _PlainDictable.load(obj.dump())
+            self.assertIsInstance(ret, _PlainDictable)
+            self.assertEqual(ret.name, 'one')
+            self.assertEqual(ret.dtype, np.dtype('int16'))
+            self.assertIsInstance(ret.children[0], _PlainDictable)
+            self.assertEqual(ret.children[0].name, 'two')
+            self.assertEqual(ret.children[1], (1, 'a'))
+
+        self.assertIsNotNone(_get_spec(_PlainDictable).direct_attrs)
+
+    def test_dictable_initializer_required(self):
+        obj = _ExcludingDictable('one')
+        self.assertNotIn('_cache', obj.dump())
+
+        for i in xrange(2):
+            ret = _ExcludingDictable.load(obj.dump())
+            self.assertEqual(ret.name, 'one')
+            # Only set by the initializer, which must not be skipped
+            self.assertEqual(ret._cache, {})
+
+        self.assertIsNone(_get_spec(_ExcludingDictable).direct_attrs)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+"""
+@package coverage_model.test.test_brick_dispatch
+@file coverage_model/test/test_brick_dispatch.py
+@brief Tests for the brick writer dispatchers in coverage_model.brick_dispatch
+"""
+
+from coverage_model.brick_dispatch import get_brick_writer_dispatcher, pack_work, unpack_work, ConsistentHashRing, BrickDispatcherFullError, acquire_brick_writer_dispatcher, _shared_dispatchers, STOP_POLL_INTERVAL, WORK_FAILURE_RETRIES, WORK_FAILURE_BACKOFF
+from coverage_model.brick_worker import merge_brick_work, write_brick_work
+from coverage_model.persistence_helpers import brick_lock
+from coverage_model.base_test_cases import CoverageModelIntTestCase, CoverageModelUnitTestCase
+from nose.plugins.attrib import attr
+import numpy as np
+import tempfile
+import time
+import h5py
+import os
+
+@attr('UNIT', group='cov')
+class TestBrickDispatchUnit(CoverageModelUnitTestCase):
+
+    def test_pack_work_round_trip(self):
+        arr = np.arange(12, dtype='f8').reshape(3, 4)
+        work = [([slice(0, 3), slice(0, 4)], arr),
+                ([slice(5, 6)], 7),
+                ([slice(0, 2)], np.array(['a', 'b'], dtype=object))]
+        frames = pack_work('a', ('path', [20], [10], 'f8', -1), work)
+
+        # Only the numeric array travels as a raw buffer, and it is not copied
+        self.assertEqual(len(frames), 2)
+        self.assertTrue(np.may_share_memory(frames[1], arr))
+
+        # Receivers get the frames as bytes
+        k, wm, uwork = unpack_work([frames[0], frames[1].tostring()])
+        self.assertEqual(k, 'a')
+        self.assertEqual(len(uwork), 3)
+        self.assertEqual(uwork[0][0], [slice(0, 3), slice(0, 4)])
+        self.assertEqual(uwork[0][1].dtype, arr.dtype)
+        np.testing.assert_array_equal(uwork[0][1], arr)
+        self.assertEqual(uwork[1], ([slice(5, 6)], 7))
+        np.testing.assert_array_equal(uwork[2][1], ['a', 'b'])
+
+    def test_merge_brick_work(self):
+        # Out-of-order single value appends, plus an overwrite of two of them
+        work = [([slice(i, i + 1)], np.array([i], dtype='f')) for i in xrange(9, -1, -1)]
+        work.append(([slice(3, 5)], 99))
+        writes = merge_brick_work(work, (20,), np.dtype('f'))
+
+        self.assertEqual(len(writes), 1)
+        brick_slice, value, indices = writes[0]
+        self.assertEqual(brick_slice, [slice(0, 10)])
+        self.assertEqual(indices, range(11))
+        np.testing.assert_array_equal(value, [0, 1, 2, 99, 99, 5, 6, 7, 8, 9])
+
+    def test_merge_brick_work_nd(self):
+        work = [([slice(0, 2), slice(0, 3)], np.ones((2, 3))),
+                ([slice(4, 5), slice(0, 3)], 4),
+                ([2, slice(0, 3)], np.array([5, 6, 7])),
+                ([slice(0, 5), 3], 8)]
+        writes = merge_brick_work(work, (5, 4), np.dtype('f'))
+
+        self.assertEqual(len(writes), 3)
+        self.assertEqual(writes[0][0], [slice(0, 3), slice(0, 3)])
+        self.assertEqual(writes[0][2], [0, 2])
+        np.testing.assert_array_equal(writes[0][1], [[1, 1, 1], [1, 1, 1], [5, 6, 7]])
+        self.assertEqual(writes[1][2], [1])
+        self.assertEqual(writes[2][2], [3])
+
+    def test_merge_brick_work_unmergeable(self):
+        # Merged writes would overlap the last item, which must be written last
+        work = [([slice(0, 2), slice(0, 2)], 1),
+                ([slice(2, 4), slice(0, 2)], 2),
+                ([slice(1, 3), slice(0, 4)], 3)]
+        writes = merge_brick_work(work, (4, 4), np.dtype('f'))
+        self.assertEqual([w[2] for w in writes], [[0], [1], [2]])
+
+        # Stepped slices are not merged
+        work = [([slice(0, 4, 2)], 1), ([slice(4, 6)], 2)]
+        writes = merge_brick_work(work, (10,), np.dtype('f'))
+        self.assertEqual([w[2] for w in writes], [[0], [1]])
+
+    def test_consistent_hash_ring(self):
+        keys = ['key_{0}'.format(x) for x in xrange(1000)]
+        ring = ConsistentHashRing(range(4))
+        shards = dict((k, ring.get_node(k)) for k in keys)
+
+        # Keys are spread over every node, and always map to the same one
+        counts = [shards.values().count(x) for x in xrange(4)]
+        self.assertTrue(all(c > 100 for c in counts), counts)
+        self.assertEqual(shards, dict((k, ConsistentHashRing(range(4)).get_node(k)) for k in keys))
+
+        # Adding a node only moves keys to that node
+        ring5 = ConsistentHashRing(range(5))
+        moved = [k for k in keys if ring5.get_node(k) != shards[k]]
+        self.assertTrue(all(ring5.get_node(k) == 4 for k in moved))
+        self.assertLess(len(moved), 400)
+
+@attr('INT', group='cov')
+class TestBrickDispatchInt(CoverageModelIntTestCase):
+
+    working_dir = os.path.join(tempfile.gettempdir(), 'cov_disp_tests')
+
+    def setUp(self):
+        self.failures = []
+
+    def _failure_callback(self, message, work):
+        self.failures.append((message, work))
+
+    def _get_dispatcher(self, backend, **kwargs):
+        disp = get_brick_writer_dispatcher(backend, self._failure_callback, **kwargs)
+        disp.run()
+        self.addCleanup(disp.shutdown, timeout=10)
+        return disp
+
+    def _metrics(self, key, bD=(20,)):
+        return (os.path.join(self.working_dir, '{0}.hdf5'.format(key)), bD, (10,), 'f', -1)
+
+    def _check_brick(self, key, expected):
+        with h5py.File(self._metrics(key)[0], 'r') as f:
+            np.testing.assert_array_equal(f[key][:], expected)
+
+    def _write_and_wait(self, backend, prefix='', **kwargs):
+        disp = self._get_dispatcher(backend, **kwargs)
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=1))
+
+        keys = [prefix + x for x in ['a', 'b', 'c']]
+        expected = dict((k, np.ones(20, dtype='f') * -1) for k in keys)
+        for i in xrange(15):
+            k = keys[i % len(keys)]
+            disp.put_work(k, self._metrics(k), ([slice(i, i + 1)], np.array([i], dtype='f')))
+            expected[k][i] = i
+            self.assertLessEqual(disp.items_in_flight, disp.max_pending_items or 15)
+
+        t = time.time()
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=10))
+        # Completion is signalled as the work is acknowledged, not on a polling interval
+        self.assertLess(time.time() - t, 1)
+        self.assertFalse(disp.is_dirty())
+        self.assertEqual(self.failures, [])
+
+        for k in keys:
+            self._check_brick(k, expected[k])
+
+        metrics = disp.get_metrics()
+        self.assertEqual(metrics['queue_depths'], [{'keys': 0, 'items': 0, 'active': 0}])
+        self.assertEqual((metrics['items_in_flight'], metrics['bytes_in_flight'], metrics['spilled_items']), (0, 0, 0))
+        self.assertGreater(metrics['write_latency']['count'], 0)
+        return disp
+
+    def test_zmq_dispatcher(self):
+        self._write_and_wait('zmq')
+
+    def test_thread_dispatcher(self):
+        self._write_and_wait('thread')
+
+    def _check_shared_dataset_name(self, backend):
+        # Bricks of different parameters share dataset names - their work must not be mixed
+        disp = self._get_dispatcher(backend)
+        paths = [os.path.join(self.working_dir, '{0}_{1}'.format(backend, x)) for x in ('p1', 'p2')]
+        for p in paths:
+            if not os.path.exists(p):
+                os.makedirs(p)
+        for i in xrange(10):
+            for j, p in enumerate(paths):
+                metrics = (os.path.join(p, 'same.hdf5'), (20,), (10,), 'f', -1)
+                disp.put_work('same', metrics, ([slice(i, i + 1)], np.array([i + j * 100], dtype='f')))
+
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=10))
+        self.assertEqual(self.failures, [])
+        for j, p in enumerate(paths):
+            with h5py.File(os.path.join(p, 'same.hdf5'), 'r') as f:
+                np.testing.assert_array_equal(f['same'][:10], np.arange(10) + j * 100)
+
+    def test_zmq_shared_dataset_name(self):
+        self._check_shared_dataset_name('zmq')
+
+    def test_thread_shared_dataset_name(self):
+        self._check_shared_dataset_name('thread')
+
+    def _check_overflow_raises(self, backend):
+        disp = self._get_dispatcher(backend, max_pending_items=2, overflow_policy='raise')
+        disp.put_work('raise_a', self._metrics('raise_a'), ([slice(0, 1)], np.array([0], dtype='f')))
+        disp.put_work('raise_a', self._metrics('raise_a'), ([slice(1, 2)], np.array([1], dtype='f')))
+        with self.assertRaises(BrickDispatcherFullError):
+            disp.put_work('raise_a', self._metrics('raise_a'), ([slice(2, 3)], np.array([2], dtype='f')))
+
+        # Room is made as the work is written
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=10))
+        disp.put_work('raise_a', self._metrics('raise_a'), ([slice(2, 3)], np.array([2], dtype='f')))
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=10))
+        self._check_brick('raise_a', [0, 1, 2] + [-1] * 17)
+
+    def test_zmq_overflow_block(self):
+        self._write_and_wait('zmq', prefix='zmq_block_', max_pending_items=2)
+
+    def test_thread_overflow_block(self):
+        self._write_and_wait('thread', prefix='thread_block_', max_pending_bytes=8)
+
+    def test_zmq_overflow_raise(self):
+        self._check_overflow_raises('zmq')
+
+    def test_thread_overflow_raise(self):
+        self._check_overflow_raises('thread')
+
+    def test_thread_overflow_spill(self):
+        disp = self._write_and_wait('thread', prefix='spill_', max_pending_items=2, overflow_policy='spill', spill_dir=self.working_dir)
+        self.assertFalse(disp.has_spilled_work())
+
+    def test_unknown_overflow_policy(self):
+        with self.assertRaises(ValueError):
+            get_brick_writer_dispatcher('thread', self._failure_callback, overflow_policy='drop')
+
+    def test_shared_dispatcher(self):
+        other_failures = []
+        ns1 = acquire_brick_writer_dispatcher('thread', self._failure_callback, name='ns1')
+        ns2 = acquire_brick_writer_dispatcher('thread', lambda m, w: other_failures.append(w), name='ns2')
+        ns3 = acquire_brick_writer_dispatcher('thread', self._failure_callback, name='ns3', max_pending_items=100)
+        self.addCleanup(_shared_dispatchers.clear)
+
+        # Namespaces with the same backend and options share a dispatcher
+        self.assertIs(ns1.dispatcher, ns2.dispatcher)
+        self.assertIsNot(ns1.dispatcher, ns3.dispatcher)
+        self.assertEqual(len(_shared_dispatchers), 2)
+
+        ns1.put_work('shared_a', self._metrics('shared_a'), ([slice(0, 2)], np.array([1, 2], dtype='f')))
+        bad_metrics = (os.path.join(self.working_dir, 'no_such_dir', 'b.hdf5'), (20,), (10,), 'f', -1)
+        ns2.put_work('shared_b', bad_metrics, ([slice(0, 2)], np.array([1, 2], dtype='f')))
+
+        # Each namespace sees its own work complete, and its own failures
+        self.assertTrue(ns1.get_dirty_values_async_result().get(timeout=10))
+        self.assertTrue(ns2.get_dirty_values_async_result().get(timeout=10))
+        self._check_brick('shared_a', [1, 2] + [-1] * 18)
+        self.assertEqual(self.failures, [])
+        self.assertEqual(len(other_failures), 1)
+        self.assertEqual(other_failures[0][0], 'shared_b')
+
+        disp = ns1.dispatcher
+        ns1.shutdown()
+        self.assertFalse(disp._shutdown)
+        with self.assertRaises(SystemError):
+            ns1.put_work('shared_a', self._metrics('shared_a'), ([slice(0, 2)], np.array([1, 2], dtype='f')))
+        ns2.shutdown()
+        self.assertTrue(disp._shutdown)
+        ns3.shutdown()
+        self.assertEqual(len(_shared_dispatchers), 0)
+
+    def test_namespace_put_batch(self):
+        ns = acquire_brick_writer_dispatcher('thread', self._failure_callback, name='batch')
+        self.addCleanup(_shared_dispatchers.clear)
+        self.addCleanup(ns.shutdown)
+
+        batch = [('batch_a', self._metrics('batch_a'), [([slice(0, 2)], np.array([1, 2], dtype='f')), ([slice(2, 4)], np.array([3, 4], dtype='f'))]),
+                 ('batch_b', self._metrics('batch_b'), [([slice(5, 6)], np.array([5], dtype='f'))])]
+        self.assertTrue(ns.put_batch(batch).get(timeout=10))
+        self._check_brick('batch_a', [1, 2, 3, 4] + [-1] * 16)
+        self._check_brick('batch_b', [-1] * 5 + [5] + [-1] * 14)
+
+        # An empty batch is complete immediately
+        self.assertTrue(ns.put_batch([]).ready())
+
+        # A batch with discarded work completes as False
+        bad_metrics = (os.path.join(self.working_dir, 'no_such_dir', 'c.hdf5'), (20,), (10,), 'f', -1)
+        ret = ns.put_batch([('batch_a', self._metrics('batch_a'), ([slice(6, 7)], np.array([7], dtype='f'))),
+                            ('batch_c', bad_metrics, ([slice(0, 2)], np.array([1, 2], dtype='f')))])
+        self.assertFalse(ret.get(timeout=10))
+        self.assertEqual([f[1][0] for f in self.failures], ['batch_c'])
+        self._check_brick('batch_a', [1, 2, 3, 4, -1, -1, 7] + [-1] * 13)
+
+    def test_write_brick_work_failure(self):
+        work = [([slice(0, 1)], 1),
+                ([slice(1, 2)], np.array([1, 2, 3])),
+                ([slice(2, 3)], 3)]
+        with self.assertRaises(Exception):
+            write_brick_work('fail', self._metrics('fail'), work)
+
+        # The first item was written; the rest remains, in order
+        self.assertEqual(len(work), 2)
+        self.assertEqual(work[0][0], [slice(1, 2)])
+        self._check_brick('fail', [1] + [-1] * 19)
+
+    def test_zmq_dispatcher_failure(self):
+        disp = self._get_dispatcher('zmq')
+        # The brick file cannot be created - every attempt fails
+        metrics = (os.path.join(self.working_dir, 'no_such_dir', 'a.hdf5'), (20,), (10,), 'f', -1)
+        work = ([slice(0, 2)], np.array([1, 2], dtype='f'))
+        disp.put_work('a', metrics, work)
+
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=10))
+        self.assertEqual(len(self.failures), 1)
+        self.assertFalse(disp._failures)
+
+        # The callback gets the work as it was put, not a re-packed copy
+        k, wm, fwork = self.failures[0][1]
+        self.assertEqual(k, 'a')
+        self.assertEqual(len(fwork), 1)
+        self.assertIs(fwork[0][1], work[1])
+
+    def test_thread_dispatcher_failure(self):
+        disp = self._get_dispatcher('thread')
+        metrics = (os.path.join(self.working_dir, 'no_such_dir', 'a.hdf5'), (20,), (10,), 'f', -1)
+        t = time.time()
+        disp.put_work('a', metrics, ([slice(0, 2)], np.array([1, 2], dtype='f')))
+
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=10))
+        self.assertEqual(len(self.failures), 1)
+        self.assertFalse(disp._failures)
+        # Each retry backs off a little longer than the last
+        self.assertGreaterEqual(time.time() - t, WORK_FAILURE_BACKOFF * sum(xrange(1, WORK_FAILURE_RETRIES + 1)))
+
+    def test_thread_dispatcher_waits_for_readers(self):
+        disp = self._get_dispatcher('thread')
+        key = 'locked'
+        path = self._metrics(key)[0]
+        disp.put_work(key, self._metrics(key), ([slice(0, 1)], np.array([0], dtype='f')))
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=10))
+
+        started = []
+        start_work = disp._start_work
+        def counting_start(work_key):
+            started.append(work_key)
+            return start_work(work_key)
+        disp._start_work = counting_start
+
+        # HDF5 won't open the brick for writing while this thread has it open - the writer waits rather than fails
+        with brick_lock(path), h5py.File(path, 'r') as f:
+            disp.put_work(key, self._metrics(key), ([slice(1, 2)], np.array([1], dtype='f')))
+            time.sleep(0.2)
+            self.assertTrue(disp.is_dirty())
+
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=10))
+        self.assertEqual(len(started), 1)
+        self.assertEqual(self.failures, [])
+        self._check_brick(key, [0, 1] + [-1] * 18)
+
+    def _check_drain(self, backend):
+        disp = get_brick_writer_dispatcher(backend, self._failure_callback)
+        disp.run()
+        # Let the worker connect and ask for work
+        self.assertTrue(disp.get_dirty_values_async_result().get(timeout=1))
+
+        key = '{0}_drain'.format(backend)
+        for i in xrange(20):
+            disp.put_work(key, self._metrics(key), ([slice(i, i + 1)], np.array([i], dtype='f')))
+
+        # Shutdown writes everything that was accepted, and is not held up by polling intervals
+        t = time.time()
+        disp.shutdown(timeout=10)
+        self.assertLess(time.time() - t, STOP_POLL_INTERVAL / 1000.0)
+        self.assertFalse(disp.is_dirty())
+        self.assertEqual(self.failures, [])
+        self._check_brick(key, np.arange(20))
+
+        with self.assertRaises(SystemError):
+            disp.put_work(key, self._metrics(key), ([slice(0, 1)], np.array([0], dtype='f')))
+
+    def test_zmq_shutdown_drains(self):
+        self._check_drain('zmq')
+
+    def test_thread_shutdown_drains(self):
+        self._check_drain('thread')
+
+    def test_worker_shard_assignment(self):
+        from coverage_model.brick_dispatch import ACK
+        disp = self._get_dispatcher('zmq')
+        saved = (disp.num_workers, disp._worker_shards, disp._worker_seen)
+        try:
+            # Exercise the assignment alone, as if the pool had 3 workers
+            disp.num_workers = 3
+            disp._worker_shards = {}
+            disp._worker_seen = {}
+            self.assertEqual([disp._register_worker(g) for g in ('w0', 'w1', 'w2')], [0, 1, 2])
+            self.assertEqual(disp._register_worker('w1'), 1)
+
+            # A restarted worker replaces the worker seen least recently, on its shard
+            disp._worker_seen.update(w0=3, w1=1, w2=2)
+            self.assertEqual(disp._register_worker('w3'), 1)
+            self.assertNotIn('w1', disp._worker_shards)
+
+            # Workers with active work are not presumed dead
+            disp._worker_seen.update(w0=1, w2=2, w3=3)
+            disp._active_work[('busy',)] = ('w0', None, 0)
+            self.assertEqual(disp._register_worker('w4'), 2)
+            self.assertIn('w0', disp._worker_shards)
+            disp._active_work.clear()
+
+            # A stopped worker leaves its shard to the next worker
+            disp._handle_response(ACK, 'w0', None, None)
+            self.assertNotIn('w0', disp._worker_shards)
+            self.assertEqual(disp._register_worker('w5'), 0)
+            self.assertEqual(sorted(disp._worker_shards.values()), [0, 1, 2])
+        finally:
+            disp.num_workers, disp._worker_shards, disp._worker_seen = saved
+            disp._stopped_workers.discard('w0')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            get_brick_writer_dispatcher('carrier_pigeon', self._failure_callback)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+@package coverage_model.test.test_metrics
+@file coverage_model/test/test_metrics.py
+@brief Tests for coverage_model.metrics
+"""
+
+from coverage_model.metrics import LatencyHistogram, Telemetry, statsd_sink, get_telemetry, timed
+from coverage_model.base_test_cases import CoverageModelUnitTestCase
+from nose.plugins.attrib import attr
+import socket
+
+@attr('UNIT', group='cov')
+class TestLatencyHistogramUnit(CoverageModelUnitTestCase):
+
+    def test_empty(self):
+        h = LatencyHistogram()
+        d = h.as_dict()
+        self.assertEqual((d['count'], d['mean'], d['max'], d['p50'], d['p99']), (0, 0.0, 0.0, 0.0, 0.0))
+
+    def test_record(self):
+        h = LatencyHistogram(min_latency=0.001, num_buckets=5)
+        for x in [0.0005, 0.001, 0.0015, 0.003, 0.1]:
+            h.record(x)
+
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.max, 0.1)
+        self.assertAlmostEqual(h.mean, 0.106 / 5)
+        # Bounds are 0.001, 0.002, 0.004 and 0.008; the last bucket holds the rest
+        self.assertEqual(h.counts, [2, 1, 1, 0, 1])
+        self.assertEqual(h.percentile(40), 0.001)
+        self.assertEqual(h.percentile(60), 0.002)
+        self.assertEqual(h.percentile(100), 0.1)
+        self.assertEqual(h.as_dict()['buckets'][-1], (float('inf'), 1))
+
+        h.reset()
+        self.assertEqual((h.count, h.counts), (0, [0] * 5))
+
+
+@attr('UNIT', group='cov')
+class TestTelemetryUnit(CoverageModelUnitTestCase):
+
+    def test_disabled(self):
+        t = Telemetry()
+        t.incr('a')
+        t.record('b', 0.1)
+        with t.timer('c'):
+            pass
+
+        self.assertEqual(t.snapshot(), {'counters': {}, 'latencies': {}})
+
+    def test_enabled(self):
+        t = Telemetry(enabled=True)
+        t.incr('a')
+        t.incr('a', 4)
+        t.record('b', 0.1)
+        with t.timer('c'):
+            pass
+
+        snap = t.snapshot()
+        self.assertEqual(snap['counters'], {'a': 5})
+        self.assertEqual(snap['latencies']['b']['count'], 1)
+        self.assertEqual(snap['latencies']['b']['max'], 0.1)
+        self.assertEqual(snap['latencies']['c']['count'], 1)
+
+        t.reset()
+        self.assertEqual(t.snapshot(), {'counters': {}, 'latencies': {}})
+
+    def test_timed(self):
+        tel = get_telemetry()
+        self.addCleanup(tel.reset)
+        self.addCleanup(tel.disable)
+
+        @timed('test.timed')
+        def f(x):
+            return x * 2
+
+        self.assertEqual(f(2), 4)
+        self.assertNotIn('test.timed', tel.snapshot()['latencies'])
+
+        tel.enable()
+        self.assertEqual(f(3), 6)
+        self.assertEqual(tel.snapshot()['latencies']['test.timed']['count'], 1)
+
+    def test_statsd_sink(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+        sink = statsd_sink('127.0.0.1', sock.getsockname()[1], prefix='cm')
+
+        t = Telemetry(enabled=True)
+        t.incr('opens', 3)
+        t.record('write', 0.002)
+        sink(t.snapshot())
+        lines = sock.recv(4096).split('\n')
+        self.assertIn('cm.opens:3|c', lines)
+        self.assertIn('cm.write.max:2.000|g', lines)
+
+        # Counters are sent as deltas
+        t.incr('opens', 2)
+        sink(t.snapshot())
+        self.assertIn('cm.opens:2|c', sock.recv(4096).split('\n'))
@@ -10,7 +10,7 @@
 
 from nose.plugins.attrib import attr
 from coverage_model import *
-from coverage_model.parameter_functions import ParameterFunctionException
+from coverage_model.parameter_functions import ParameterFunctionException, SharedEvaluation, EvaluationPlan
 import numpy as np
 
 def errfunc(val1, val2):
@@ -62,6 +62,24 @@ class TestParameterFunctionsUnit(CoverageModelUnitTestCase):
         ret = func.evaluate(_get_vals, slice(None))
         np.testing.assert_array_equal(ret, np.array([1*23, 3*23, 5*23, 6*23, 23*23]))
 
+    def test_numexpr_function_compiled(self):
+        func = NumexprFunction('v*10', 'v*10', ['v'], {'v': 'VALS'})
+        func.evaluate(_get_vals, slice(None))
+        func.evaluate(_get_vals, slice(1, 3))
+        self.assertEqual(len(func._compiled[3]), 1)
+
+        # Compiled again for other argument types
+        ret = func.evaluate(lambda n, sl: np.array([1.5, 2.5]), slice(None))
+        np.testing.assert_array_equal(ret, [15, 25])
+        self.assertEqual(len(func._compiled[3]), 2)
+
+        # ...and for a changed expression
+        func.expression = 'v*100'
+        np.testing.assert_array_equal(func.evaluate(_get_vals, slice(0, 2)), [100, 300])
+
+        self.assertNotIn('_compiled', func._todict())
+        self.assertEqual(NumexprFunction._fromdict(func._todict()), func)
+
     def test_python_function(self):
         owner = 'coverage_model.test.test_parameter_functions'
         func = PythonFunction('multiplier', owner, 'pyfunc', ['first', 'second'])
@@ -76,6 +94,21 @@ class TestParameterFunctionsUnit(CoverageModelUnitTestCase):
         ret = func.evaluate(_get_vals, slice(None))
         np.testing.assert_array_equal(ret, np.array([1*10, 2*10, 3*10, 4*10, 5*10]))
 
+    def test_python_function_callable(self):
+        owner = 'coverage_model.test.test_parameter_functions'
+        func = PythonFunction('multiplier', owner, 'pyfunc', ['first', 'second'])
+        func.evaluate(_get_vals, slice(None))
+        resolved = func._callable
+        func.evaluate(_get_vals, slice(1, 4))
+        self.assertIs(func._callable, resolved)
+
+        func.func_name = 'errfunc'
+        self.assertRaises(StandardError, func.evaluate, _get_vals, slice(None))
+
+        d = func._todict()
+        self.assertNotIn('_callable', d)
+        self.assertNotIn('_callable_source', d)
+
     def test_python_function_exception(self):
         owner = 'coverage_model.test.test_parameter_functions'
         func = PythonFunction('multiplier', owner, 'errfunc', ['first', 'second'])
@@ -120,6 +153,125 @@ class TestParameterFunctionsUnit(CoverageModelUnitTestCase):
         efm = {'[square]': {'arg_0': '!first :|: first!', 'arg_1': '!first :|: first!'}}
         self.assertEqual(func1.get_function_map(), efm)
 
+    def test_get_parameter_inputs(self):
+        owner = 'coverage_model.test.test_parameter_functions'
+        func1 = NumexprFunction('v*10', 'v*10', ['v', 'c'], {'v': 'VALS', 'c': 2})
+        self.assertEqual(func1.get_parameter_inputs(), (set(['VALS']), True))
+
+        func2 = NumexprFunction('v*a', 'v*a', ['v', 'a*'], {'v': func1, 'a*': 'first'})
+        self.assertEqual(func2.get_parameter_inputs(), (set(['VALS', 'first']), False))
+
+        func3 = PythonFunction('multiplier', owner, 'pyfunc', ['first', 'second'])
+        self.assertEqual(func3.get_parameter_inputs(), (set(['first', 'second']), False))
+
+        func4 = PythonFunction('callback', owner, 'callback_arg_func', ['pv_callback'])
+        self.assertEqual(func4.get_parameter_inputs(), (None, False))
+
+    def test_node_key(self):
+        owner = 'coverage_model.test.test_parameter_functions'
+        self.assertEqual(NumexprFunction('a', 'v*10', ['v'], {'v': 'VALS'}).get_node_key(),
+                         NumexprFunction('b', 'v*10', ['v'], {'v': 'VALS'}).get_node_key())
+        self.assertNotEqual(NumexprFunction('a', 'v*10', ['v'], {'v': 'VALS'}).get_node_key(),
+                            NumexprFunction('a', 'v*100', ['v'], {'v': 'VALS'}).get_node_key())
+        self.assertNotEqual(PythonFunction('a', owner, 'pyfunc', ['first', 'second']).get_node_key(),
+                            PythonFunction('a', owner, 'pyfunc', ['second', 'first']).get_node_key())
+
+    def test_shared_evaluation(self):
+        owner = 'coverage_model.test.test_parameter_functions'
+        fetched = []
+        def get_vals(name, slice_):
+            fetched.append(name)
+            return _get_vals(name, slice_)
+
+        func1 = NumexprFunction('v*10', 'v*10', ['v'], {'v': 'VALS'})
+        func2 = NumexprFunction('v+f', 'v+f', ['v', 'f'], {'v': 'VALS', 'f': func1})
+        func3 = PythonFunction('multiplier', owner, 'pyfunc', ['a', 'b'], param_map={'a': NumexprFunction('x', 'v*10', ['v'], {'v': 'VALS'}), 'b': 'first'})
+
+        shared = SharedEvaluation(get_vals)
+        np.testing.assert_array_equal(shared.evaluate(func2, slice(None)), func2.evaluate(_get_vals, slice(None)))
+        np.testing.assert_array_equal(shared.evaluate(func3, slice(None)), func3.evaluate(_get_vals, slice(None)))
+
+        # VALS is fetched once, and v*10 evaluated once, for both functions
+        self.assertEqual(sorted(fetched), ['VALS', 'first'])
+        self.assertEqual(shared.evaluations, 3)
+
+        # Another slice is another evaluation
+        shared.evaluate(func2, slice(1, 3))
+        self.assertEqual(shared.fetches, 3)
+
+    def test_evaluation_plan(self):
+        class FunctionValue(object):
+            def __init__(self, function):
+                self.content = function
+
+            def evaluate_with(self, pval_callback, slice_):
+                return self.content.evaluate(pval_callback, slice_)
+
+        functions = {'x10': FunctionValue(NumexprFunction('x10', 'v*10', ['v'], {'v': 'VALS'}))}
+        functions['x10_plus'] = FunctionValue(NumexprFunction('x10_plus', 'a+b', ['a', 'b'], {'a': 'x10', 'b': 'VALS'}))
+        functions['x10_times'] = FunctionValue(NumexprFunction('x10_times', 'a*b', ['a', 'b'], {'a': 'x10', 'b': 'first'}))
+
+        plan = EvaluationPlan(['x10_plus', 'x10_times', 'first'], functions.get)
+        self.assertEqual(plan.get_independent_parameters(), set(['VALS', 'first']))
+        self.assertEqual(plan.get_shared_nodes(), set([('function', 'x10'), ('parameter', 'VALS')]))
+
+        fetched = []
+        def get_vals(name, slice_):
+            fetched.append(name)
+            return _get_vals(name, slice_)
+
+        ret = plan.evaluate(get_vals, slice(None))
+        vals = np.array([1, 3, 5, 6, 23])
+        np.testing.assert_array_equal(ret['x10_plus'], vals * 10 + vals)
+        np.testing.assert_array_equal(ret['x10_times'], vals * 10 * np.array([1, 2, 3, 4, 5]))
+        np.testing.assert_array_equal(ret['first'], np.array([1, 2, 3, 4, 5]))
+        self.assertEqual(sorted(fetched), ['VALS', 'first'])
+
+    def test_get_parameter_reads(self):
+        func = NumexprFunction('nest', 'a+b', ['a', 'b'], {'a': 'first', 'b': NumexprFunction('inner', 'c*2', ['c'], {'c': 'second'})})
+        self.assertEqual(func.get_parameter_reads(slice(1, 3)), [('first', slice(1, 3)), ('second', slice(1, 3))])
+
+        func = PythonFunction('splat', __name__, 'pyfunc', ['a', 'b*'], param_map={'a': 'first', 'b*': 'second'})
+        self.assertEqual(func.get_parameter_reads(slice(1, 3)), [('first', slice(1, 3)), ('second', -1)])
+
+        func = PythonFunction('callback', __name__, 'callback_arg_func', ['pv_callback'])
+        self.assertIsNone(func.get_parameter_reads(slice(1, 3)))
+
+    def test_numexpr_function_elementwise(self):
+        self.assertTrue(NumexprFunction('x10', 'a*10', ['a'], {'a': 'first'})._is_elementwise())
+        self.assertTrue(NumexprFunction('where', 'where(a > 1, a, 0)', ['a'], {'a': 'first'})._is_elementwise())
+        # Reductions and arguments read in full depend on every index
+        self.assertFalse(NumexprFunction('total', 'sum(a)', ['a'], {'a': 'first'})._is_elementwise())
+        self.assertFalse(NumexprFunction('scaled', 'a / prod(a, axis=0)', ['a'], {'a': 'first'})._is_elementwise())
+        self.assertFalse(NumexprFunction('splat', 'a+b', ['a', 'b*'], {'a': 'first', 'b*': 'second'})._is_elementwise())
+
+        func = NumexprFunction('changed', 'sum(a)', ['a'], {'a': 'first'})
+        self.assertFalse(func._is_elementwise())
+        func.expression = 'a+1'
+        self.assertTrue(func._is_elementwise())
+
+    def test_function_executor(self):
+        executor = FunctionExecutor(num_workers=2)
+        try:
+            func = PythonFunction('multiplier', __name__, 'pyfunc', ['first', 'second'])
+            expr = NumexprFunction('adder', 'a+b', ['a', 'b'], {'a': 'first', 'b': 'second'})
+            work = []
+            for f in (func, expr):
+                for sl in (slice(0, 2), slice(2, 5)):
+                    values = dict(((a, repr(s)), _get_vals(a, s)) for a, s in f.get_parameter_reads(sl))
+                    work.append((f, values, sl, -9999))
+
+            ret = executor.evaluate(work)
+            np.testing.assert_array_equal(np.concatenate(ret[:2]), np.array([1, 8, 18, 32, 50]))
+            np.testing.assert_array_equal(np.concatenate(ret[2:]), np.array([2, 6, 9, 12, 15]))
+
+            # Failures are raised as ParameterFunctionExceptions
+            func = PythonFunction('error', __name__, 'errfunc', ['first', 'second'])
+            values = dict(((a, repr(s)), _get_vals(a, s)) for a, s in func.get_parameter_reads(slice(None)))
+            self.assertRaises(ParameterFunctionException, executor.evaluate, [(func, values, slice(None), -9999)])
+        finally:
+            executor.shutdown()
+
 @attr('INT',group='cov')
 class TestParameterFunctionsInt(CoverageModelIntTestCase):
 
@@ -219,6 +371,56 @@ class TestParameterFunctionsInt(CoverageModelIntTestCase):
         dps = ('condwat_l1', 'preswat_l1', 'pracsal', 'tempwat_l1')
         self.assertEqual(dps, self.contexts['pracsal'].param_type.get_dependent_parameters())
 
+    def test_dependency_cache(self):
+        self.contexts = _get_pc_dict('tempwat_l0', 'condwat_l0', 'preswat_l0',
+                                     'tempwat_l1', 'condwat_l1', 'preswat_l1',
+                                     'pracsal')
+
+        calls = []
+        def counting_callback(context_name):
+            calls.append(context_name)
+            return self.contexts[context_name]
+
+        for n, p in self.contexts.iteritems():
+            if hasattr(p, '_pctxt_callback'):
+                p._pctxt_callback = counting_callback
+
+        ptype = self.contexts['pracsal'].param_type
+        g = ptype.get_dependency_graph()
+        ips = ptype.get_independent_parameters()
+        dps = ptype.get_dependent_parameters()
+        self.assertTrue(len(calls) > 0)
+
+        # Answered from the cache - each context read is resolved once, only to check that it has not changed
+        del calls[:]
+        self.assertEqual(ips, ptype.get_independent_parameters())
+        self.assertEqual(sorted(calls), ['condwat_l0', 'condwat_l1', 'preswat_l0', 'preswat_l1', 'tempwat_l0', 'tempwat_l1'])
+        self.assertEqual(sorted(g.nodes()), sorted(ptype.get_dependency_graph().nodes()))
+        self.assertEqual(dps, ptype.get_dependent_parameters())
+
+        # The graph returned may be modified without affecting the cache
+        g.remove_node('pracsal')
+        self.assertIn('pracsal', ptype.get_dependency_graph().node)
+
+        # Changing the param_map of a parameter function read invalidates the cache
+        self.contexts['tempwat_l1'].param_type.function.param_map = {'T': 'preswat_l0'}
+        self.assertEqual(('condwat_l0', '679.34040721', 'preswat_l0'), ptype.get_independent_parameters())
+        self.assertNotIn('tempwat_l0', ptype.get_dependency_graph().node)
+
+        # As does changing its own param_map
+        ptype.function.param_map['t'] = 'condwat_l1'
+        self.assertEqual(('condwat_l0', '679.34040721', 'preswat_l0'), ptype.get_independent_parameters())
+        self.assertNotIn('tempwat_l1', ptype.get_dependency_graph().node)
+        self.assertTrue(len(calls) > 0)
+
+        # As does replacing the context callback
+        del calls[:]
+        ptype._pctxt_callback = self._ctxt_callback
+        ptype.get_dependency_graph()
+        ptype._pctxt_callback = counting_callback
+        ptype.get_dependency_graph()
+        self.assertTrue(len(calls) > 0)
+
     def test_get_module_dependencies(self):
         self.contexts = _get_pc_dict('tempwat_l0', 'condwat_l0', 'preswat_l0',
                                      'tempwat_l1', 'condwat_l1', 'preswat_l1',
@@ -439,6 +641,44 @@ class TestParameterValidatorInt(CoverageModelIntTestCase):
         for o in out_values:
             self.assertRaises(ParameterFunctionException, pfv.validate, o)
 
+    def test_validate_all(self):
+        in_values = _get_pc_list('time', 'lat', 'lon', 'tempwat_l0', 'condwat_l0', 'preswat_l0')
+        in_contexts = in_values
+        out_contexts = _get_pc_list('density', 'pracsal', 'tempwat_l1', 'condwat_l1', 'preswat_l1')
+        out_values = [p.name for p in out_contexts]
+
+        pfv = ParameterFunctionValidator(in_values, in_contexts, out_contexts)
+
+        g = pfv.validate_all(out_values)
+        self.assertIsInstance(g, nx.DiGraph)
+        for o in out_values:
+            self.assertIn(o, g.node)
+            pfv.validate(o)
+
+        # Defaults to all the contexts
+        pfv.validate_all()
+
+    def test_validate_all_fail(self):
+        in_values = _get_pc_list('time', 'lat', 'lon', 'tempwat_l0', 'condwat_l0')
+        in_contexts = in_values
+        out_contexts = _get_pc_list('density', 'pracsal', 'tempwat_l1', 'condwat_l1', 'preswat_l1')
+
+        pfv = ParameterFunctionValidator(in_values, in_contexts, out_contexts)
+
+        with self.assertRaises(ParameterFunctionException) as cm:
+            pfv.validate_all(['tempwat_l1', 'condwat_l1', 'preswat_l1', 'pracsal'])
+
+        msg = cm.exception.message
+        self.assertNotIn('\'tempwat_l1\'', msg)
+        self.assertNotIn('\'condwat_l1\'', msg)
+        self.assertIn('\'preswat_l1\', missing values or functions: [\'preswat_l0\']', msg)
+        self.assertIn('\'pracsal\', missing values or functions: [\'preswat_l0\']', msg)
+
+        # Agrees with validating the contexts one at a time
+        pfv.validate('tempwat_l1')
+        self.assertRaises(ParameterFunctionException, pfv.validate, 'preswat_l1')
+        self.assertRaises(ParameterFunctionException, pfv.validate, 'pracsal')
+
 def _get_pc_dict(*pnames):
     all_pc = _create_all_params()
     return {x: all_pc[x] for x in pnames}
@@ -156,6 +156,13 @@ class TestParameterValuesUnit(CoverageModelUnitTestCase):
         self.assertEqual(fval[5], 200)
         self.assertEqual(fval[9], 300)
 
+        # The nested expression is reused until a clause changes
+        content = fval.content
+        self.assertIs(fval.content, content)
+        fval[:] = make_range_expr(400, min=10, else_val=-9999)
+        self.assertNotEqual(fval.content, content)
+        self.assertEqual(fval[9], 300)
+
     def test_parameter_function_values(self):
         pass
 
@@ -223,7 +230,7 @@ class TestParameterValuesInt(CoverageModelIntTestCase):
         pass
 
     def test_value_caching(self):
-        import collections
+        from coverage_model.value_cache import CoverageValueCache
 
         cov = self._make_empty_oneparamcov()
 
@@ -234,8 +241,8 @@ class TestParameterValuesInt(CoverageModelIntTestCase):
         vals = np.arange(nt, dtype=cov._range_dictionary.get_context('time').param_type.value_encoding)
         cov.set_time_values(vals)
 
-        # Make sure the _value_cache is an instance of OrderedDict and that it's empty
-        self.assertIsInstance(cov._value_cache, collections.OrderedDict)
+        # Make sure the _value_cache is the coverage's share of the process-wide cache and that it's empty
+        self.assertIsInstance(cov._value_cache, CoverageValueCache)
         self.assertEqual(len(cov._value_cache), 0)
 
         # Get the time values and make sure they match what we assigned
@@ -251,14 +258,27 @@ class TestParameterValuesInt(CoverageModelIntTestCase):
         got = cov.get_time_values(sl)
         np.testing.assert_array_equal(vals[sl], got)
 
-        # Now check that there are 2 entries and that the second is a match for vals
-        self.assertEqual(len(cov._value_cache), 2)
-        np.testing.assert_array_equal(cov._value_cache[cov._value_cache.keys()[1]], vals[sl])
+        # The slice is answered from the cached full range - nothing is added
+        self.assertEqual(len(cov._value_cache), 1)
+        stats = cov.get_value_cache_stats()
+        self.assertEqual((stats['hits'], stats['superset_hits'], stats['misses']), (0, 1, 1))
+        self.assertEqual(stats['bytes'], vals.nbytes)
 
-        # Call get 40 times - check that the _value_cache stops growing @ 30
+        # Repeat the full range request - an exact hit
+        cov.get_time_values()
+        self.assertEqual(cov.get_value_cache_stats()['hits'], 1)
+
+        # Limit the cache to less than the full range - the least recently used entries are evicted to make room
+        cov.value_cache_max_bytes = vals.nbytes - 1
+        self.assertEqual(len(cov._value_cache), 0)
         for x in xrange(40):
-            cov.get_time_values(x)
-        self.assertEqual(len(cov._value_cache), 30)
+            np.testing.assert_array_equal(cov.get_time_values(slice(x * 10, x * 10 + 100)), vals[x * 10:x * 10 + 100])
+        stats = cov.get_value_cache_stats()
+        fits = (vals.nbytes - 1) // vals[:100].nbytes
+        self.assertEqual((stats['entries'], stats['bytes']), (fits, fits * vals[:100].nbytes))
+        # The full range, then the oldest windows
+        self.assertEqual(stats['evictions'], 1 + 40 - fits)
+        self.assertIsNone(cov._value_cache.get('time', (slice(0, 100, 1), slice(0, 0, 1))))
 
     def test_value_caching_with_domain_expansion(self):
         cov = self._make_empty_oneparamcov()
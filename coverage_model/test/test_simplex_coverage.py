@@ -17,7 +17,7 @@ import random
 from copy import deepcopy
 import os
 
-from coverage_test_base import CoverageIntTestBase, get_props, get_parameter_dict, EXEMPLAR_CATEGORIES
+from coverage_test_base import CoverageIntTestBase, get_props, get_parameter_dict, EXEMPLAR_CATEGORIES, _make_tcrs, _make_scrs, _make_tdom, _make_sdom
 
 @attr('INT', group='cov')
 class TestSampleCovInt(CoverageModelIntTestCase, CoverageIntTestBase):
@@ -88,6 +88,51 @@ class TestSampleCovInt(CoverageModelIntTestCase, CoverageIntTestBase):
 
         return scov, 'TestSampleCovInt'
 
+    @classmethod
+    def get_function_cov(cls, name, parameter_list, functions=None, nt=None, values=None, **kwargs):
+        """
+        Construct a coverage of the sample parameters in parameter_list and the parameter functions in functions
+
+        @param functions    A list of AbstractFunctions, or of (AbstractFunction, dict of ParameterFunctionType kwargs)
+        tuples; each is added as a temporal parameter named after the function
+        @param nt   If given, insert nt timesteps and set the time values to their indices
+        @param values   A dict of {param_name: value} set after inserting the timesteps
+        @param **kwargs Passed to SimplexCoverage
+        """
+        pdict = get_parameter_dict(parameter_list=parameter_list)
+        for func in functions or []:
+            func, ptype_kwargs = func if isinstance(func, tuple) else (func, {})
+            pdict.add_context(ParameterContext(func.name, param_type=ParameterFunctionType(func, **ptype_kwargs), variability=VariabilityEnum.TEMPORAL))
+
+        tdom = _make_tdom(_make_tcrs())
+        sdom = _make_sdom(_make_scrs())
+        cov = SimplexCoverage(cls.working_dir, create_guid(), name, parameter_dictionary=pdict, temporal_domain=tdom, spatial_domain=sdom, **kwargs)
+
+        if nt:
+            cov.insert_timesteps(nt)
+            cov.set_time_values(np.arange(nt))
+            for param_name, value in (values or {}).iteritems():
+                cov.set_parameter_values(param_name, value=value)
+
+        return cov
+
+    @staticmethod
+    def count_calls(obj, attr, record=lambda *args, **kwargs: args[0]):
+        """
+        Replace the method attr of obj with one that records each call before making it
+
+        @param record   Returns what is recorded for the arguments of a call; defaults to the first argument
+        @return The list the calls are recorded in
+        """
+        calls = []
+        method = getattr(obj, attr)
+        def counting_method(*args, **kwargs):
+            calls.append(record(*args, **kwargs))
+            return method(*args, **kwargs)
+        setattr(obj, attr, counting_method)
+
+        return calls
+
     def _insert_set_get(self, scov=None, timesteps=None, data=None, _slice=None, param='all'):
         # Function to test variable occurances of getting and setting values across parameter(s)
         data = data[_slice]
@@ -114,6 +159,496 @@ class TestSampleCovInt(CoverageModelIntTestCase, CoverageIntTestBase):
         data_params = cov.list_parameters(data_only=True)
         self.assertEqual(data_params, ['conductivity', 'temp'])
 
+    def test_load_defers_parameter_loading(self):
+        cov, cov_name = self.get_cov(nt=10)
+        cov.close()
+
+        lcov = AbstractCoverage.load(cov.persistence_dir, mode='r')
+        pmd = lcov._persistence_layer.parameter_metadata
+        # Nothing parameter-specific is read when the coverage is opened
+        self.assertFalse(any(pm.is_loaded for pm in pmd.itervalues()))
+        self.assertEqual(lcov.temporal_parameter_name, 'time')
+        self.assertEqual(sorted(lcov._range_value), ['conductivity', 'lat', 'lon', 'temp', 'time'])
+
+        np.testing.assert_array_equal(lcov.get_time_values(), np.arange(10))
+        self.assertTrue(pmd['time'].is_loaded)
+        self.assertFalse(pmd['temp'].is_loaded)
+
+        # Listing coordinate parameters requires the contexts, which loads the rest
+        self.assertEqual(lcov.list_parameters(coords_only=True), ['lat', 'lon', 'time'])
+        self.assertTrue(all(pm.is_loaded for pm in pmd.itervalues()))
+        lcov.close()
+
+    def test_legacy_encoding_read_and_migrate(self):
+        import h5py
+        from coverage_model.persistence_helpers import escape, is_binary_vlen
+        from coverage_model.migration import migrate_coverage
+        cov, cov_name = self.get_cov(nt=10, brick_size=5)
+        tvals = cov.get_time_values()
+        cov.close()
+
+        def hdf_files():
+            for root, dirs, files in os.walk(cov.persistence_dir):
+                for f in files:
+                    if f.endswith('.hdf5'):
+                        yield os.path.join(root, f)
+
+        # Rewrite the coverage in the legacy (escaped vlen str) format
+        for fpath in hdf_files():
+            with h5py.File(fpath, 'a') as f:
+                for k, v in f.attrs.items():
+                    self.assertIsInstance(v, np.void)
+                    v = v.tostring()
+                    i = v.index('|', 9) + 1 if v.startswith('DICTABLE') else 0
+                    f.attrs[k] = v[:i] + escape(v[i:])
+                if 'rtree' in f.keys():
+                    self.assertTrue(is_binary_vlen(f['rtree'].dtype))
+                    entries = [escape(x.tostring()) for x in f['rtree'][:]]
+                    del f['rtree']
+                    f.create_dataset('rtree', data=entries, dtype=h5py.special_dtype(vlen=str), maxshape=(None,))
+
+        lcov = AbstractCoverage.load(cov.persistence_dir, mode='r')
+        np.testing.assert_array_equal(lcov.get_time_values(), tvals)
+        self.assertEqual(len(lcov._persistence_layer.master_manager.brick_tree._spans), 2)
+        lcov.close()
+
+        res = migrate_coverage(cov.persistence_dir)
+        self.assertTrue(len(res) > 0)
+        for fpath in hdf_files():
+            with h5py.File(fpath, 'r') as f:
+                self.assertTrue(all(isinstance(v, np.void) for v in f.attrs.values()))
+                if 'rtree' in f.keys():
+                    self.assertTrue(is_binary_vlen(f['rtree'].dtype))
+
+        lcov = AbstractCoverage.load(cov.persistence_dir, mode='r')
+        np.testing.assert_array_equal(lcov.get_time_values(), tvals)
+        self.assertEqual(len(lcov._persistence_layer.master_manager.brick_tree._spans), 2)
+        lcov.close()
+
+    def test_write_binary_values(self):
+        import h5py
+        from coverage_model.persistence_helpers import write_binary_values, BINARY_VLEN_DTYPE
+        with h5py.File(os.path.join(self.working_dir, 'binary.hdf5'), 'w') as f:
+            ds = f.create_dataset('vals', (10, 2), dtype=BINARY_VLEN_DTYPE)
+
+            # Values of one length, values of varied length, and one value written to the whole selection
+            write_binary_values(ds, (slice(0, 3), 0), ['aa', 'bb', 'cc'])
+            write_binary_values(ds, [slice(3, 5), 0], ['d', 'eee'])
+            write_binary_values(ds, (slice(None), 1), 'ff')
+            self.assertEqual([v.tostring() for v in ds[:5, 0]], ['aa', 'bb', 'cc', 'd', 'eee'])
+            self.assertEqual([v.tostring() for v in ds[:, 1]], ['ff'] * 10)
+
+            self.assertRaises(ValueError, write_binary_values, ds, (slice(0, 3), 0), ['aa'])
+
+    def test_load_from_metadata_snapshot(self):
+        from coverage_model.persistence_helpers import MetadataSnapshot
+        cov = self.get_function_cov('snapshot coverage', ['time', 'lat', 'lon', 'temp'], nt=10, values={'temp': np.arange(10) * 2}, metadata_snapshot=True)
+
+        # Flushing doesn't write the snapshot, closing does
+        snap = MetadataSnapshot(cov.persistence_dir, cov.persistence_guid)
+        cov.flush()
+        self.assertFalse(os.path.exists(snap.file_path))
+        self.assertTrue(cov._persistence_layer.write_metadata_snapshot())
+        self.assertTrue(os.path.exists(snap.file_path))
+        self.assertFalse(cov._persistence_layer.write_metadata_snapshot())
+        os.remove(snap.file_path)
+        cov.close()
+
+        self.assertTrue(os.path.exists(snap.file_path))
+        self.assertIsNotNone(snap.read())
+
+        lcov = AbstractCoverage.load(cov.persistence_dir, mode='r')
+        self.assertIsNotNone(lcov._persistence_layer.master_manager._snapshot_data)
+        self.assertEqual(lcov.num_timesteps, 10)
+        self.assertEqual(sorted(lcov.list_parameters()), ['lat', 'lon', 'temp', 'time'])
+        np.testing.assert_array_equal(lcov.get_parameter_values('temp'), np.arange(10) * 2)
+        lcov.close()
+
+        # A change to the master file makes the snapshot stale - the coverage loads from the HDF5 files instead
+        mfile = cov._persistence_layer.master_manager.file_path
+        st = os.stat(mfile)
+        os.utime(mfile, (st.st_atime, st.st_mtime + 10))
+        self.assertIsNone(snap.read())
+
+        lcov = AbstractCoverage.load(cov.persistence_dir, mode='r')
+        self.assertIsNone(lcov._persistence_layer.master_manager._snapshot_data)
+        np.testing.assert_array_equal(lcov.get_parameter_values('temp'), np.arange(10) * 2)
+        lcov.close()
+
+    def test_incremental_refresh(self):
+        write_cov = self.get_function_cov('refresh coverage', ['time', 'lat', 'lon', 'temp'], nt=10, values={'temp': np.arange(10)}, bricking_scheme={'brick_size': 10, 'chunk_size': 10})
+
+        read_cov = AbstractCoverage.load(write_cov.persistence_dir, mode='r')
+        mm = read_cov._persistence_layer.master_manager
+        brick_list, brick_tree, tdom = mm.brick_list, mm.brick_tree, read_cov.temporal_domain
+        np.testing.assert_array_equal(read_cov.get_time_values(), np.arange(10))
+        np.testing.assert_array_equal(read_cov.get_parameter_values('temp'), np.arange(10))
+
+        # Nothing has changed - nothing is reloaded and the cache is kept
+        self.assertEqual(mm.refresh(), set())
+        read_cov.refresh()
+        self.assertEqual(len(read_cov._value_cache), 2)
+
+        write_cov.insert_timesteps(15)
+        write_cov.set_time_values(np.arange(25))
+        write_cov.append_parameter(ParameterContext('new_param'))
+
+        read_cov.refresh()
+        self.assertEqual(read_cov.num_timesteps, 25)
+        self.assertIs(mm.brick_list, brick_list)
+        self.assertIs(mm.brick_tree, brick_tree)
+        self.assertIs(read_cov.temporal_domain, tdom)
+        self.assertEqual(len(brick_list), 3)
+        self.assertEqual(len(brick_tree._spans), 3)
+        self.assertIn('new_param', read_cov.list_parameters())
+
+        # The 'temp' bricks did not change, so its cached value is kept; 'time' was rewritten
+        self.assertEqual([k[0] for k in read_cov._value_cache], ['temp'])
+        np.testing.assert_array_equal(read_cov.get_time_values(), np.arange(25))
+        np.testing.assert_array_equal(read_cov.get_parameter_values('temp')[:10], np.arange(10))
+        self.assertEqual(read_cov.get_parameter_values('new_param').shape, (25,))
+
+        read_cov.close()
+        write_cov.close()
+
+    def test_shared_value_cache(self):
+        write_cov = self.get_function_cov('shared cache coverage', ['time', 'temp'], nt=10, values={'temp': np.arange(10)})
+        self.addCleanup(write_cov.close)
+        write_cov.get_parameter_values('temp')
+
+        # Every instance of the coverage shares the values cached by the others
+        read_cov = AbstractCoverage.load(write_cov.persistence_dir, mode='r')
+        self.addCleanup(read_cov.close)
+        np.testing.assert_array_equal(read_cov.get_parameter_values('temp'), np.arange(10))
+        self.assertEqual(read_cov.get_value_cache_stats()['hits'], 1)
+        np.testing.assert_array_equal(read_cov.get_time_values(), np.arange(10))
+        self.assertEqual(sorted(k[0] for k in write_cov._value_cache), ['temp', 'time'])
+
+        # A write through any instance invalidates the values of all of them
+        write_cov.set_parameter_values('temp', value=np.arange(10) * 2)
+        self.assertEqual([k[0] for k in read_cov._value_cache], ['time'])
+        read_cov.refresh()
+        np.testing.assert_array_equal(read_cov.get_parameter_values('temp'), np.arange(10) * 2)
+
+    def test_read_only_value_cache_hits(self):
+        cov = self.get_function_cov('read only cache coverage', ['time', 'lat', 'lon', 'temp'], nt=10, values={'temp': np.arange(10)})
+        cov.close()
+
+        # Reads don't grow the domain extents, so repeated reads hit the cache
+        lcov = AbstractCoverage.load(cov.persistence_dir, mode='r')
+        self.addCleanup(lcov.close)
+        self.assertIsNotNone(lcov.spatial_domain)
+        extents = list(lcov.temporal_domain.shape.extents)
+        for x in xrange(3):
+            np.testing.assert_array_equal(lcov.get_parameter_values('temp'), np.arange(10))
+        self.assertEqual(list(lcov.temporal_domain.shape.extents), extents)
+        self.assertEqual(lcov.get_value_cache_stats()['hits'], 2)
+        self.assertEqual([k[0] for k in lcov._value_cache], ['temp'])
+
+    def test_parameter_function_memo(self):
+        functions = [NumexprFunction('temp_x10', 't*10', ['t'], {'t': 'temp'})]
+        cov = self.get_function_cov('memo coverage', ['time', 'temp', 'conductivity'], functions, nt=10, values={'temp': np.arange(10)}, value_caching=False)
+        self.addCleanup(cov.close)
+
+        evaluated = self.count_calls(cov._range_value['temp_x10'], '_evaluate')
+
+        # Function values are memoized in the value cache even with value caching off; contained slices included
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10'), np.arange(10) * 10)
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10'), np.arange(10) * 10)
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10', tdoa=slice(2, 4)), [20, 30])
+        self.assertEqual(len(evaluated), 1)
+        self.assertEqual(cov._value_cache.parameters(), ['temp_x10'])
+
+        # Writes to parameters the function does not depend on keep the memoized values
+        cov.set_parameter_values('conductivity', value=np.arange(10))
+        cov.get_parameter_values('temp_x10', tdoa=slice(2, 4))
+        self.assertEqual(len(evaluated), 1)
+
+        # Writes to its inputs do not
+        cov.set_parameter_values('temp', value=[100], tdoa=slice(3, 4))
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10', tdoa=slice(2, 4)), [20, 1000])
+        self.assertEqual(len(evaluated), 2)
+
+        # The whole domain grows with the coverage
+        cov.insert_timesteps(2)
+        self.assertEqual(len(cov.get_parameter_values('temp_x10')), 12)
+        self.assertEqual(len(evaluated), 3)
+
+    def test_read_only_function_values_not_cached(self):
+        functions = [NumexprFunction('temp_x10', 't*10', ['t'], {'t': 'temp'})]
+        write_cov = self.get_function_cov('read only memo coverage', ['time', 'temp'], functions, nt=10, values={'temp': np.arange(10)}, value_caching=False)
+        self.addCleanup(write_cov.close)
+
+        # A read-only coverage only sees writes made elsewhere on refresh - it doesn't memoize unless value_caching is on
+        read_cov = AbstractCoverage.load(write_cov.persistence_dir, mode='r')
+        self.addCleanup(read_cov.close)
+        self.assertFalse(read_cov.value_caching)
+        np.testing.assert_array_equal(read_cov.get_parameter_values('temp_x10'), np.arange(10) * 10)
+        np.testing.assert_array_equal(read_cov.get_multi_parameter_values(['temp_x10'])['temp_x10'], np.arange(10) * 10)
+        self.assertEqual(len(read_cov._value_cache), 0)
+
+        write_cov.set_parameter_values('temp', value=np.arange(10) * 2)
+        np.testing.assert_array_equal(read_cov.get_parameter_values('temp_x10'), np.arange(10) * 20)
+
+    def test_chunked_function_evaluation(self):
+        functions = [NumexprFunction('temp_x10', 't*10', ['t'], {'t': 'temp'}),
+                     PythonFunction('temp_plus', 'numpy', 'add', ['a', 'b'], param_map={'a': 'temp', 'b': 'conductivity'}, elementwise=True),
+                     PythonFunction('temp_sum', 'numpy', 'cumsum', ['a'], param_map={'a': 'temp'}),
+                     NumexprFunction('temp_total', 'sum(t)', ['t'], {'t': 'temp'})]
+        cov = self.get_function_cov('chunked coverage', ['time', 'temp', 'conductivity'], functions, nt=45, values={'temp': np.arange(45), 'conductivity': np.arange(45)}, value_caching=False, bricking_scheme={'brick_size': 10, 'chunk_size': 5})
+        self.addCleanup(cov.close)
+
+        computed = dict((p, self.count_calls(cov._range_value[p], '_compute', lambda slice_, pval_callback=None: slice_[0])) for p in ('temp_x10', 'temp_plus', 'temp_sum'))
+
+        cov.function_chunk_size = 15
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10'), np.arange(45) * 10)
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_plus', tdoa=slice(5, 40, 2)), np.arange(5, 40, 2) * 2)
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_sum'), np.cumsum(np.arange(45)))
+
+        # Chunks are cut at brick boundaries
+        self.assertEqual(computed['temp_x10'], [slice(0, 10, 1), slice(10, 20, 1), slice(20, 30, 1), slice(30, 40, 1), slice(40, 45, 1)])
+        self.assertEqual(computed['temp_plus'], [slice(5, 10, 2), slice(11, 20, 2), slice(21, 30, 2), slice(31, 40, 2)])
+        # Functions that are not element-wise are evaluated in one shot
+        self.assertEqual(len(computed['temp_sum']), 1)
+        # Including NumExpr reductions
+        self.assertEqual(cov.get_parameter_values('temp_total').tolist(), np.sum(np.arange(45)))
+
+        cov.function_chunk_size = None
+        cov.clear_value_cache()
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10', tdoa=slice(1, None)), np.arange(1, 45) * 10)
+        self.assertEqual(len(computed['temp_x10']), 6)
+
+        # Values can be streamed a chunk at a time
+        chunks = list(cov.iter_parameter_values('temp', tdoa=slice(5, None), chunk_size=20))
+        self.assertEqual([c[0] for c in chunks], [slice(5, 20, 1), slice(20, 40, 1), slice(40, 45, 1)])
+        np.testing.assert_array_equal(np.concatenate([c[1] for c in chunks]), np.arange(5, 45))
+
+    def test_function_executor(self):
+        functions = [NumexprFunction('temp_x10', 't*10', ['t'], {'t': 'temp'}),
+                     PythonFunction('temp_plus', 'numpy', 'add', ['a', 'b'], param_map={'a': 'temp', 'b': 'conductivity'}, elementwise=True),
+                     NumexprFunction('temp_x10_plus', 'a+c', ['a', 'c'], {'a': 'temp_x10', 'c': 'conductivity'}),
+                     PythonFunction('temp_error', 'numpy', 'reshape', ['a', 'b'], param_map={'a': 'temp', 'b': 'conductivity'})]
+        cov = self.get_function_cov('executor coverage', ['time', 'temp', 'conductivity'], functions, nt=45, values={'temp': np.arange(45), 'conductivity': np.arange(45) * 2}, value_caching=False, bricking_scheme={'brick_size': 10, 'chunk_size': 5})
+        self.addCleanup(cov.close)
+
+        executor = FunctionExecutor(num_workers=2)
+        self.addCleanup(executor.shutdown)
+        evaluated = self.count_calls(executor, 'evaluate', lambda work: [w[2][0] for w in work])
+
+        cov.function_executor = executor
+        cov.function_chunk_size = 10
+        self.assertIs(cov._range_value['temp_x10'].executor, executor)
+
+        # Chunks of one function are evaluated num_workers at a time
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_plus'), np.arange(45) * 3)
+        self.assertEqual(evaluated, [[slice(0, 10, 1), slice(10, 20, 1)], [slice(20, 30, 1), slice(30, 40, 1)], [slice(40, 45, 1)]])
+
+        # Independent functions are evaluated together, then those reading them
+        del evaluated[:]
+        cov.function_chunk_size = None
+        cov.clear_value_cache()
+        ret = cov.get_multi_parameter_values(['temp_x10_plus', 'temp_plus', 'temp_x10', 'time'], tdoa=slice(5, 15))
+        np.testing.assert_array_equal(ret['temp_x10_plus'], np.arange(5, 15) * 12)
+        np.testing.assert_array_equal(ret['temp_plus'], np.arange(5, 15) * 3)
+        np.testing.assert_array_equal(ret['temp_x10'], np.arange(5, 15) * 10)
+        np.testing.assert_array_equal(ret['time'], np.arange(5, 15))
+        self.assertEqual(evaluated, [[slice(5, 15), slice(5, 15)], [slice(5, 15)]])
+
+        # Failures on the executor surface as ParameterFunctionExceptions
+        from coverage_model.parameter_functions import ParameterFunctionException
+        self.assertRaises(ParameterFunctionException, cov.get_parameter_values, 'temp_error')
+        self.assertRaises(ParameterFunctionException, cov.get_multi_parameter_values, ['temp_error', 'temp_x10'])
+
+    def test_materialized_function(self):
+        functions = [(PythonFunction('temp_x10', 'numpy', 'multiply', ['a', 'b'], param_map={'a': 'temp', 'b': 10}, elementwise=True), {'value_encoding': 'float64', 'materialized': True})]
+        cov = self.get_function_cov('materialized coverage', ['time', 'temp', 'conductivity'], functions, nt=30, values={'temp': np.arange(30)}, value_caching=False, bricking_scheme={'brick_size': 10, 'chunk_size': 5})
+
+        def count_computed(pv):
+            return self.count_calls(pv, '_compute', lambda slice_, pval_callback=None: utils.index_bounds(utils.express_slice(slice_, pv.shape)[0]))
+
+        computed = count_computed(cov._range_value['temp_x10'])
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10'), np.arange(30) * 10)
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10', tdoa=slice(2, 25, 3)), np.arange(2, 25, 3) * 10)
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10', tdoa=7), 70)
+        self.assertEqual(computed, [(0, 30)])
+
+        # Only appended timesteps are evaluated
+        cov.insert_timesteps(10)
+        cov.set_parameter_values('temp', value=np.arange(30, 40), tdoa=slice(30, 40))
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10'), np.arange(40) * 10)
+        self.assertEqual(computed, [(0, 30), (30, 40)])
+
+        # Overwriting an input only reevaluates the range written
+        cov.set_parameter_values('conductivity', value=np.arange(40))
+        cov.set_parameter_values('temp', value=[100, 101, 102], tdoa=slice(5, 8))
+        self.assertEqual(cov._persistence_layer.get_materialized_ranges('temp_x10'), [[0, 5], [8, 40]])
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10', tdoa=slice(0, 10)), [0, 10, 20, 30, 40, 1000, 1010, 1020, 80, 90])
+        self.assertEqual(computed, [(0, 30), (30, 40), (5, 8)])
+
+        cov.insert_timesteps(5)
+        self.assertEqual(cov.materialize(), {'temp_x10': [[40, 45]]})
+        self.assertEqual(cov.materialize(), {'temp_x10': []})
+        self.assertRaises(TypeError, cov.materialize, ['temp'])
+        cov.close()
+
+        # The stored values and the ranges they are valid over are persisted
+        cov = AbstractCoverage.load(cov.persistence_dir, mode='r')
+        self.addCleanup(cov.close)
+        computed = count_computed(cov._range_value['temp_x10'])
+        expected = np.arange(40) * 10
+        expected[5:8] = [1000, 1010, 1020]
+        np.testing.assert_array_equal(cov.get_parameter_values('temp_x10', tdoa=slice(0, 40)), expected)
+        self.assertEqual(computed, [])
+
+    def test_multi_parameter_values(self):
+        x10 = NumexprFunction('temp_x10', 't*10', ['t'], {'t': 'temp'})
+        functions = [x10,
+                     NumexprFunction('temp_x10_plus', 'a+c', ['a', 'c'], {'a': 'temp_x10', 'c': 'conductivity'}),
+                     NumexprFunction('temp_x100', 'a*10', ['a'], {'a': x10})]
+        cov = self.get_function_cov('multi coverage', ['time', 'temp', 'conductivity'], functions, nt=10, values={'temp': np.arange(10), 'conductivity': np.arange(10) + 0.5}, value_caching=False)
+        self.addCleanup(cov.close)
+
+        names = ['temp_x10', 'temp_x10_plus', 'temp_x100', 'time']
+        expected = dict((p, cov.get_parameter_values(p, tdoa=slice(2, 8))) for p in names)
+        cov.clear_value_cache()
+
+        fetched = self.count_calls(cov, 'get_parameter_values')
+
+        ret = cov.get_multi_parameter_values(names, tdoa=slice(2, 8))
+        self.assertEqual(sorted(ret), sorted(names))
+        for p in names:
+            np.testing.assert_array_equal(ret[p], expected[p])
+
+        # Each input is read once - the functions are evaluated from them, not read
+        self.assertEqual(sorted(fetched), ['conductivity', 'temp', 'time'])
+
+    def test_value_cache_range_invalidation(self):
+        owner = 'coverage_model.test.test_parameter_functions'
+        functions = [NumexprFunction('temp_x10', 't*10', ['t'], {'t': 'temp'}),
+                     PythonFunction('temp_sq', owner, 'pyfunc', ['temp', 'temp'])]
+        cov = self.get_function_cov('cache coverage', ['time', 'temp'], functions, nt=20, values={'temp': np.arange(20)})
+        self.addCleanup(cov.close)
+
+        for p in ('time', 'temp', 'temp_x10', 'temp_sq'):
+            cov.get_parameter_values(p, tdoa=slice(0, 10))
+
+        def cached():
+            return sorted(k[0] for k in cov._value_cache)
+
+        self.assertEqual(cached(), ['temp', 'temp_sq', 'temp_x10', 'time'])
+
+        # Appending beyond the cached range keeps the history hot, except for functions that are not element-wise
+        cov.insert_timesteps(5)
+        cov.set_parameter_values('temp', value=np.arange(5), tdoa=slice(20, 25))
+        self.assertEqual(cached(), ['temp', 'temp_x10', 'time'])
+
+        # Overwriting within the cached range invalidates the parameter and the functions that read it
+        cov.set_parameter_values('temp', value=[100], tdoa=slice(5, 6))
+        self.assertEqual(cached(), ['time'])
+        self.assertEqual(cov.get_parameter_values('temp_x10', tdoa=slice(0, 10))[5], 1000)
+
+    def _check_out_of_band_writes(self, backend, dispatcher_class):
+        cov = self.get_function_cov('{0} coverage'.format(backend), ['time', 'lat', 'lon', 'temp'], bricking_scheme={'brick_size': 10, 'chunk_size': 10}, inline_data_writes=False, writer_backend=backend)
+        self.assertFalse(cov._persistence_layer.inline_data_writes)
+        self.assertIsInstance(cov._persistence_layer.brick_dispatcher.dispatcher, dispatcher_class)
+
+        cov.insert_timesteps(25)
+        cov.set_time_values(np.arange(25))
+        for x in xrange(5):
+            cov.set_parameter_values('temp', value=np.arange(5) + x * 5, tdoa=slice(x * 5, (x + 1) * 5))
+        self.assertTrue(cov.get_dirty_values_async_result().get(timeout=30))
+        self.assertFalse(cov.has_dirty_values())
+
+        np.testing.assert_array_equal(cov.get_time_values(), np.arange(25))
+        np.testing.assert_array_equal(cov.get_parameter_values('temp'), np.arange(25))
+        cov.close()
+
+        lcov = AbstractCoverage.load(cov.persistence_dir, mode='r')
+        self.assertEqual(lcov._persistence_layer.writer_backend, backend)
+        np.testing.assert_array_equal(lcov.get_parameter_values('temp'), np.arange(25))
+        lcov.close()
+
+    def test_threaded_writer_backend(self):
+        from coverage_model.brick_dispatch import ThreadedBrickWriterDispatcher
+        self._check_out_of_band_writes('thread', ThreadedBrickWriterDispatcher)
+
+    def test_zmq_writer_backend(self):
+        from coverage_model.brick_dispatch import BrickWriterDispatcher
+        self._check_out_of_band_writes('zmq', BrickWriterDispatcher)
+
+    def test_deferred_flush_group_commit(self):
+        cov = self.get_function_cov('deferred coverage', ['time', 'temp', 'conductivity'], bricking_scheme={'brick_size': 10, 'chunk_size': 10}, inline_data_writes=False, auto_flush_values=False, writer_backend='thread')
+        ns = cov._persistence_layer.brick_dispatcher
+        puts = []
+        orig_put_work = ns.dispatcher.put_work
+        def put_work(work_key, work_metrics, work, namespace=None):
+            puts.append((work_key, len(work)))
+            orig_put_work(work_key, work_metrics, work, namespace=namespace)
+        ns.dispatcher.put_work = put_work
+
+        cov.insert_timesteps(20)
+        for x in xrange(4):
+            cov.set_parameter_values('temp', value=np.arange(5) + x * 5, tdoa=slice(x * 5, (x + 1) * 5))
+            cov.set_parameter_values('conductivity', value=np.arange(5) + x * 5 + 100, tdoa=slice(x * 5, (x + 1) * 5))
+        self.assertTrue(cov.has_dirty_values())
+        self.assertEqual(puts, [])
+
+        self.assertTrue(cov._persistence_layer.flush_values().get(timeout=30))
+        self.assertFalse(cov.has_dirty_values())
+        # One work item per brick (2 per parameter); the queued slices of each brick are merged into a single write
+        self.assertEqual(len(puts), 4)
+        self.assertEqual(sorted(p[1] for p in puts), [1, 1, 1, 1])
+
+        np.testing.assert_array_equal(cov.get_parameter_values('temp'), np.arange(20))
+        np.testing.assert_array_equal(cov.get_parameter_values('conductivity'), np.arange(20) + 100)
+        cov.close()
+
+    def test_write_telemetry(self):
+        from coverage_model.metrics import get_telemetry
+        tel = get_telemetry()
+        tel.reset()
+        tel.enable()
+        self.addCleanup(tel.reset)
+        self.addCleanup(tel.disable)
+
+        cov = self.get_function_cov('telemetry coverage', ['time', 'temp'], inline_data_writes=False, writer_backend='thread')
+        cov.insert_timesteps(10)
+        cov.set_parameter_values('temp', value=np.arange(10, dtype='float32'))
+        self.assertTrue(cov.get_dirty_values_async_result().get(timeout=30))
+        cov.close()
+
+        snap = tel.snapshot()
+        for k in ('coverage.insert_timesteps', 'coverage.set_parameter_values', 'storage.set_values_to_brick', 'dispatcher.queue_wait', 'worker.write'):
+            self.assertGreater(snap['latencies'][k]['count'], 0, k)
+        self.assertEqual(snap['counters']['bytes_written.temp'], 40)
+        self.assertGreater(snap['counters']['file_opens'], 0)
+        self.assertEqual(snap['counters']['dispatcher.items_completed'], snap['latencies']['worker.write']['count'])
+
+    def test_shared_writer_dispatcher(self):
+        from coverage_model.brick_dispatch import _shared_dispatchers
+        covs = [self.get_function_cov('shared {0}'.format(x), ['time', 'temp'], inline_data_writes=False, writer_backend='thread') for x in xrange(3)]
+
+        # All three coverages write through one dispatcher
+        disp = covs[0]._persistence_layer.brick_dispatcher.dispatcher
+        self.assertTrue(all(c._persistence_layer.brick_dispatcher.dispatcher is disp for c in covs))
+        # Coverages left open by other tests may hold dispatchers of their own
+        self.assertEqual(len([d for d, ns in _shared_dispatchers.itervalues() if d is disp]), 1)
+
+        for x, cov in enumerate(covs):
+            cov.insert_timesteps(10)
+            cov.set_parameter_values('temp', value=np.arange(10) + x)
+        for x, cov in enumerate(covs):
+            self.assertTrue(cov.get_dirty_values_async_result().get(timeout=30))
+            np.testing.assert_array_equal(cov.get_parameter_values('temp'), np.arange(10) + x)
+
+        covs[0].close()
+        self.assertFalse(disp._shutdown)
+        covs[1].close()
+        covs[2].close()
+        # Closing the last coverage shuts the dispatcher down
+        self.assertTrue(disp._shutdown)
+        self.assertEqual(len([d for d, ns in _shared_dispatchers.itervalues() if d is disp]), 0)
+
 @attr('INT', group='cov')
 class TestOneParamCovInt(CoverageModelIntTestCase, CoverageIntTestBase):
 
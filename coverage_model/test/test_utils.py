@@ -301,3 +301,37 @@ class TestUtilsUnit(CoverageModelUnitTestCase):
         self.assertEqual(sl, (slice(28, 47, 5),))
 
         
+
+    def test_chunk_slice(self):
+        # Chunks are cut at multiples of the alignment
+        self.assertEqual(utils.chunk_slice(slice(None), 45, 25, 10), [slice(0, 20, 1), slice(20, 40, 1), slice(40, 45, 1)])
+        self.assertEqual(utils.chunk_slice(slice(5, 37, 3), 45, 10, 10), [slice(5, 10, 3), slice(11, 20, 3), slice(20, 30, 3), slice(32, 37, 3)])
+
+        # Chunks smaller than the alignment are cut from the start of each brick, and never span two
+        self.assertEqual(utils.chunk_slice(slice(3, 12), 45, 4, 10), [slice(3, 4, 1), slice(4, 8, 1), slice(8, 10, 1), slice(10, 12, 1)])
+        self.assertEqual(utils.chunk_slice(slice(None), 14, 3, 7), [slice(0, 3, 1), slice(3, 6, 1), slice(6, 7, 1), slice(7, 10, 1), slice(10, 13, 1), slice(13, 14, 1)])
+        self.assertEqual(utils.chunk_slice(slice(1, 14, 4), 14, 3, 7), [slice(1, 3, 4), slice(5, 6, 4), slice(9, 10, 4), slice(13, 14, 4)])
+
+        self.assertEqual(utils.chunk_slice(slice(2, 5), 45, 10), [slice(2, 5, 1)])
+        self.assertRaises(IndexError, utils.chunk_slice, slice(5, 5), 45, 10)
+
+    def test_ranges(self):
+        ranges = utils.add_range([], 0, 10)
+        ranges = utils.add_range(ranges, 20, 30)
+        self.assertEqual(ranges, [[0, 10], [20, 30]])
+        # Adjacent and overlapping ranges are merged
+        self.assertEqual(utils.add_range(ranges, 10, 20), [[0, 30]])
+        self.assertEqual(utils.add_range(ranges, 5, 25), [[0, 30]])
+
+        self.assertEqual(utils.remove_range([[0, 30]], 10, 20), [[0, 10], [20, 30]])
+        self.assertEqual(utils.remove_range(ranges, 5, 25), [[0, 5], [25, 30]])
+        self.assertEqual(utils.remove_range(ranges, 0, 100), [])
+
+        self.assertEqual(utils.missing_ranges(ranges, 5, 40), [[10, 20], [30, 40]])
+        self.assertEqual(utils.missing_ranges(ranges, 2, 8), [])
+        self.assertEqual(utils.missing_ranges([], 3, 4), [[3, 4]])
+
+        self.assertEqual(utils.index_bounds(slice(2, 8, 3)), (2, 8))
+        self.assertEqual(utils.index_bounds(4), (4, 5))
+        self.assertEqual(utils.index_bounds([7, 3, 5]), (3, 8))
+        self.assertIsNone(utils.index_bounds(slice(None)))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+@package coverage_model.test.test_value_cache
+@file coverage_model/test/test_value_cache.py
+@brief Tests for coverage_model.value_cache
+"""
+
+from coverage_model.value_cache import ValueCache, SharedValueCache, CoverageValueCache, sub_slice, overlaps
+from coverage_model.base_test_cases import CoverageModelUnitTestCase
+from nose.plugins.attrib import attr
+import numpy as np
+
+@attr('UNIT', group='cov')
+class TestValueCacheUnit(CoverageModelUnitTestCase):
+
+    def test_sub_slice(self):
+        vals = np.arange(100)
+        cached = vals[10:60:2]
+        csl = (slice(10, 60, 2),)
+
+        for sl in [slice(10, 60, 2), slice(20, 40, 2), slice(20, 41, 4), slice(58, 59, 1)]:
+            sub = sub_slice(csl, cached, (sl,))
+            if sl.step % 2 == 0:
+                np.testing.assert_array_equal(cached[sub], vals[sl])
+            else:
+                self.assertIsNone(sub)
+
+        # Not contained: starts before, ends after, or falls between the cached indices
+        for sl in [slice(0, 20, 2), slice(50, 70, 2), slice(11, 20, 2), slice(20, 40, 3)]:
+            self.assertIsNone(sub_slice(csl, cached, (sl,)))
+
+        # Only plain slices over values laid out as the slice describes
+        self.assertIsNone(sub_slice(csl, cached, (12,)))
+        self.assertIsNone(sub_slice((slice(0, 200, 1),), vals, (slice(0, 10, 1),)))
+        self.assertIsNone(sub_slice(csl, 5, (slice(10, 12, 2),)))
+
+    def test_sub_slice_nd(self):
+        vals = np.arange(100).reshape(10, 10)
+        csl = (slice(2, 8, 1), slice(0, 10, 1))
+        sub = sub_slice(csl, vals[2:8, :], (slice(3, 5, 1), slice(4, 10, 3)))
+        np.testing.assert_array_equal(vals[2:8, :][sub], vals[3:5, 4:10:3])
+        self.assertIsNone(sub_slice(csl, vals[2:8, :], (slice(0, 5, 1), slice(0, 10, 1))))
+
+    def test_get_put(self):
+        cache = ValueCache()
+        self.assertIsNone(cache.get('a', (slice(0, 10, 1),)))
+
+        vals = np.arange(10)
+        cache.put('a', (slice(0, 10, 1),), vals)
+        self.assertIs(cache.get('a', (slice(0, 10, 1),)), vals)
+        np.testing.assert_array_equal(cache.get('a', (slice(2, 5, 1),)), vals[2:5])
+        self.assertIsNone(cache.get('b', (slice(0, 10, 1),)))
+
+        self.assertEqual(cache.get_stats(), {'entries': 1, 'bytes': vals.nbytes, 'max_bytes': cache.max_bytes,
+                                             'hits': 1, 'superset_hits': 1, 'misses': 2, 'evictions': 0})
+
+        cache.put('b', (slice(0, 10, 1),), vals)
+        self.assertEqual(sorted(cache.parameters()), ['a', 'b'])
+        cache.invalidate('a')
+        self.assertEqual(cache.parameters(), ['b'])
+        self.assertEqual((len(cache), cache.nbytes), (1, vals.nbytes))
+
+    def test_lru_eviction(self):
+        vals = np.arange(10, dtype='int64')
+        cache = ValueCache(max_bytes=vals.nbytes * 2)
+        cache.put('a', (slice(0, 10, 1),), vals)
+        cache.put('b', (slice(0, 10, 1),), vals)
+        # Using 'a' makes 'b' the least recently used
+        cache.get('a', (slice(0, 10, 1),))
+        cache.put('c', (slice(0, 10, 1),), vals)
+
+        self.assertEqual(sorted(cache.parameters()), ['a', 'c'])
+        self.assertEqual((cache.nbytes, cache.evictions), (vals.nbytes * 2, 1))
+
+        # Values larger than the budget are not cached at all
+        cache.put('d', (slice(0, 30, 1),), np.arange(30, dtype='int64'))
+        self.assertNotIn('d', cache.parameters())
+        self.assertEqual(cache.evictions, 1)
+
+        cache.resize(vals.nbytes)
+        self.assertEqual(cache.parameters(), ['c'])
+
+    def test_overlaps(self):
+        self.assertTrue(overlaps((slice(0, 10, 1),), (slice(9, 20, 1),)))
+        self.assertFalse(overlaps((slice(0, 10, 1),), (slice(10, 20, 1),)))
+        self.assertFalse(overlaps((slice(0, 10, 1), slice(0, 5, 1)), (slice(0, 10, 1), slice(5, 6, 1))))
+        self.assertTrue(overlaps((slice(0, 10, 2),), (3,)))
+        self.assertFalse(overlaps((slice(0, 10, 1),), ([10, 12],)))
+        # Anything that cannot be bounded is assumed to overlap
+        self.assertTrue(overlaps((slice(0, 10, 1),), (object(),)))
+        self.assertTrue(overlaps((slice(0, 10, 1), slice(0, 0, 1)), (slice(5, 6, 1), slice(0, 0, 1))))
+
+    def test_invalidate_range(self):
+        cache = ValueCache()
+        vals = np.arange(10)
+        cache.put('a', (slice(0, 10, 1),), vals)
+        cache.put('a', (slice(10, 20, 1),), vals)
+        cache.put('b', (slice(0, 10, 1),), vals)
+
+        # Writes beyond the cached ranges leave them be
+        cache.invalidate('a', (slice(20, 25, 1),))
+        self.assertEqual(len(cache), 3)
+
+        cache.invalidate('a', (slice(12, 13, 1),))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNotNone(cache.get('a', (slice(0, 10, 1),)))
+        self.assertIsNone(cache.get('a', (slice(10, 20, 1),)))
+        self.assertIsNotNone(cache.get('b', (slice(0, 10, 1),)))
+
+    def test_generation(self):
+        cache = ValueCache()
+        vals = np.arange(10)
+        gen = cache.generation('a')
+        cache.invalidate('a', (slice(0, 5, 1),))
+        # Read before the write - not cached
+        cache.put('a', (slice(0, 10, 1),), vals, gen)
+        self.assertEqual(len(cache), 0)
+
+        cache.put('a', (slice(0, 10, 1),), vals, cache.generation('a'))
+        self.assertEqual(len(cache), 1)
+
+    def test_shared_cache(self):
+        vals = np.arange(10, dtype='int64')
+        shared = SharedValueCache(max_bytes=vals.nbytes * 3)
+        sl = (slice(0, 10, 1),)
+        a1 = CoverageValueCache('/cov_a', shared=shared)
+        a2 = CoverageValueCache('/cov_a', shared=shared)
+        b = CoverageValueCache('/cov_b', max_bytes=vals.nbytes, shared=shared)
+
+        # Instances of the same coverage share values
+        a1.put('time', sl, vals)
+        self.assertIs(a2.get('time', sl), vals)
+        self.assertEqual(len(a2), 1)
+        self.assertEqual(b.get('time', sl), None)
+        self.assertEqual((a1.hits, a2.hits, b.misses), (0, 1, 1))
+
+        # A coverage is held to its own budget...
+        b.put('time', sl, vals)
+        b.put('temp', sl, vals)
+        self.assertEqual(b.parameters(), ['temp'])
+        self.assertEqual(b.get_stats()['evictions'], 1)
+
+        # ...and all coverages to the shared budget
+        a2.put('temp', sl, vals)
+        a2.put('cond', sl, vals)
+        self.assertEqual(sorted(a1.parameters()), ['cond', 'temp'])
+        self.assertEqual(shared.nbytes, vals.nbytes * 3)
+
+        # Invalidation by any instance applies to all
+        a1.invalidate('temp')
+        self.assertEqual(a2.parameters(), ['cond'])
+        a2.clear()
+        self.assertEqual((len(a1), len(b)), (0, 1))
+
+    def test_shared_cache_dirty_writer(self):
+        vals = np.arange(10)
+        sl = (slice(0, 10, 1),)
+        shared = SharedValueCache()
+        dirty = [True]
+        writer = CoverageValueCache('/cov', dirty_check=lambda: dirty[0], shared=shared)
+        reader = CoverageValueCache('/cov', shared=shared)
+
+        # What the reader reads may be stale while the writer has values to persist
+        reader.put('time', sl, vals)
+        self.assertEqual(len(reader), 0)
+        writer.put('time', sl, vals)
+        self.assertIs(reader.get('time', sl), vals)
+
+        dirty[0] = False
+        reader.put('temp', sl, vals)
+        self.assertEqual(len(reader), 2)
+
+        dirty[0] = True
+        writer.release()
+        reader.put('cond', sl, vals)
+        self.assertEqual(len(reader), 3)
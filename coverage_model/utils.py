@@ -27,6 +27,26 @@ def is_guid(str_val):
     return re.match(guid_match, str_val) is not None
 
 
+_class_cache = {}
+
+
+def get_class(module_name, class_name):
+    """
+    Retrieve a class by module and class name; lookups are cached
+
+    @param module_name  The fully qualified name of the module containing the class
+    @param class_name   The name of the class
+    @return The class object
+    """
+    key = (module_name, class_name)
+    try:
+        return _class_cache[key]
+    except KeyError:
+        module = __import__(module_name, fromlist=[class_name])
+        classobj = _class_cache[key] = getattr(module, class_name)
+        return classobj
+
+
 def prod(lst):
     import operator
     return reduce(operator.mul, lst, 1)
@@ -281,5 +301,113 @@ def express_slice(slice_, total_shape):
     return tuple(ret)
 
 
+def index_bounds(s):
+    """
+    Returns the [start, stop) range of indices selected along a dimension of a fully expressed slice, or None if unknown
+
+    @param s    A slice, integer or list/tuple of indices
+    """
+    if isinstance(s, slice):
+        if isinstance(s.start, (int, long)) and isinstance(s.stop, (int, long)):
+            return s.start, s.stop
+    elif isinstance(s, (int, long, np.integer)):
+        return s, s + 1
+    elif isinstance(s, (list, tuple, np.ndarray)) and len(s) > 0:
+        try:
+            return min(s), max(s) + 1
+        except TypeError:
+            pass
+
+    return None
+
+
+def add_range(ranges, start, stop):
+    """
+    Returns ranges with the indices [start, stop) added
+
+    @param ranges   A sorted list of disjoint, half-open index ranges, each a [start, stop] list
+    """
+    ret = []
+    for a, b in ranges:
+        if b < start or a > stop:
+            ret.append([a, b])
+        else:
+            # Overlapping or adjacent - merge
+            start, stop = min(a, start), max(b, stop)
+    ret.append([start, stop])
+
+    return sorted(ret)
+
+
+def remove_range(ranges, start, stop):
+    """
+    Returns ranges with the indices [start, stop) removed
+
+    @param ranges   A sorted list of disjoint, half-open index ranges, each a [start, stop] list
+    """
+    ret = []
+    for a, b in ranges:
+        if a < start:
+            ret.append([a, min(b, start)])
+        if b > stop:
+            ret.append([max(a, stop), b])
+
+    return ret
+
+
+def missing_ranges(ranges, start, stop):
+    """
+    Returns the ranges of the indices [start, stop) not covered by ranges
+
+    @param ranges   A sorted list of disjoint, half-open index ranges, each a [start, stop] list
+    """
+    ret = []
+    for a, b in ranges:
+        if b <= start:
+            continue
+        if a >= stop:
+            break
+        if a > start:
+            ret.append([start, a])
+        start = max(start, b)
+    if start < stop:
+        ret.append([start, stop])
+
+    return ret
+
+
+def chunk_slice(slice_, length, chunk_size, alignment=None):
+    """
+    Splits a slice into consecutive slices selecting at most chunk_size indices each
+
+    @param slice_       A slice
+    @param length       The length of the dimension being sliced
+    @param chunk_size   The maximum number of indices spanned by each chunk
+    @param alignment    If supplied (i.e. the brick size), chunks are cut at multiples of alignment so no chunk spans
+    more bricks than necessary; chunks smaller than alignment are cut from the start of each brick and never span two
+    @return A list of slices
+    @throws IndexError  slice_ is not a valid slice of the dimension
+    """
+    start, stop, step = express_slice(slice_, (length,))[0].indices(length)
+    if alignment and chunk_size >= alignment:
+        span = (chunk_size // alignment) * alignment
+    else:
+        span = max(1, chunk_size)
+
+    ret = []
+    i = start
+    while i < stop:
+        if alignment and span < alignment:
+            origin = (i // alignment) * alignment
+            boundary = min(origin + ((i - origin) // span + 1) * span, origin + alignment, stop)
+        else:
+            boundary = min((i // span + 1) * span, stop)
+        ret.append(slice(i, boundary, step))
+        # The first index of the next chunk, keeping to the step
+        i += ((boundary - i + step - 1) // step) * step
+
+    return ret
+
+
 def get_random_sample(length, min, max):
     return np.random.random_sample(length) * (max - min) + min
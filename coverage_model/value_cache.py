@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+
+"""
+@package coverage_model.value_cache
+@file coverage_model/value_cache.py
+@brief Cache of parameter values retrieved from coverages
+"""
+
+from coverage_model import utils
+import collections
+import numpy as np
+import weakref
+import sys
+
+# Default number of bytes of values a ValueCache holds
+DEFAULT_MAX_BYTES = 128 * 1024 ** 2
+
+# Default number of bytes of values the process-wide SharedValueCache holds, across all coverages
+DEFAULT_SHARED_MAX_BYTES = 512 * 1024 ** 2
+
+
+def _value_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+
+    return sys.getsizeof(value)
+
+def _indices(s):
+    # The indices selected along a dimension, or None if they cannot be determined from the slice alone
+    if not isinstance(s, slice):
+        return None
+    try:
+        return xrange(s.start, s.stop, s.step)
+    except TypeError:
+        return None
+
+def overlaps(slice_a, slice_b):
+    """
+    Returns False if the fully expressed slices certainly select no common index, otherwise True
+
+    Empty dimensions (e.g. an empty spatial domain) are not indexed by the values and are ignored
+    """
+    for a, b in zip(slice_a, slice_b):
+        ba, bb = utils.index_bounds(a), utils.index_bounds(b)
+        if ba is None or bb is None or ba[0] >= ba[1] or bb[0] >= bb[1]:
+            continue
+        if ba[1] <= bb[0] or bb[1] <= ba[0]:
+            return False
+
+    return True
+
+def sub_slice(cached_slice, cached_value, slice_):
+    """
+    Returns the slice of cached_value that holds the values for slice_, or None if cached_value does not hold all of them
+
+    Only plain slices are considered, and only when cached_value is laid out as cached_slice describes.  Values can
+    have fewer dimensions than their slice (e.g. an empty spatial domain) - the trailing dimensions must then match.
+
+    @param cached_slice The fully expressed slice cached_value was retrieved with
+    @param cached_value The cached value
+    @param slice_   The fully expressed slice requested
+    """
+    if not isinstance(cached_value, np.ndarray) or len(cached_slice) != len(slice_):
+        return None
+
+    nd = cached_value.ndim
+    if nd > len(slice_) or tuple(cached_slice[nd:]) != tuple(slice_[nd:]):
+        return None
+
+    ret = []
+    for c, r, n in zip(cached_slice, slice_, cached_value.shape):
+        cidx, ridx = _indices(c), _indices(r)
+        if cidx is None or ridx is None or len(cidx) != n or len(ridx) == 0:
+            return None
+
+        offset = r.start - c.start
+        last = offset + r.step * (len(ridx) - 1)
+        if offset < 0 or offset % c.step or r.step % c.step or last // c.step >= n:
+            return None
+        ret.append(slice(offset // c.step, last // c.step + 1, r.step // c.step))
+
+    return tuple(ret)
+
+
+class ValueCache(object):
+    """
+    Least-recently-used cache of parameter values, bounded by the number of bytes held
+
+    Entries are keyed by parameter name and fully expressed slice (see utils.express_slice).  A slice that is not
+    cached itself is answered from a cached slice that contains it.
+
+    Each parameter has a write generation, advanced whenever its values are invalidated.  Readers note the generation
+    before reading values and pass it to put, so values read while a write was in progress are not cached.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict() # {(param_name, slice hash): (slice_, value, nbytes)}, oldest first
+        self._param_keys = {} # {param_name: set of keys}
+        self._generations = {} # {param_name: write generation}
+        self.nbytes = 0
+        self.hits = 0
+        self.superset_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        return self._entries[key][1]
+
+    def keys(self):
+        return self._entries.keys()
+
+    def parameters(self):
+        """
+        Returns the names of the parameters with cached values
+        """
+        return self._param_keys.keys()
+
+    def get(self, param_name, slice_):
+        """
+        Returns the cached value of param_name for slice_, or None if it is not cached
+
+        @param param_name   The name of the parameter
+        @param slice_   A fully expressed slice
+        """
+        return self._lookup(param_name, slice_)[0]
+
+    def _lookup(self, param_name, slice_):
+        # Returns (value or None, the name of the statistic counting the outcome)
+        key = (param_name, utils.hash_any(slice_))
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1], 'hits'
+
+        for k in self._param_keys.get(param_name, ()):
+            cached_slice, value, nbytes = self._entries[k]
+            sl = sub_slice(cached_slice, value, slice_)
+            if sl is not None:
+                self._entries[k] = self._entries.pop(k)
+                self.superset_hits += 1
+                return value[sl], 'superset_hits'
+
+        self.misses += 1
+        return None, 'misses'
+
+    def generation(self, param_name):
+        """
+        Returns the write generation of param_name
+        """
+        return self._generations.get(param_name, 0)
+
+    def put(self, param_name, slice_, value, generation=None):
+        """
+        Cache the value of param_name for slice_, evicting the least recently used values as needed
+
+        Values larger than max_bytes are not cached
+
+        @param generation   The write generation of param_name when value was read; if given and param_name has been
+        invalidated since, value is not cached
+        """
+        if generation is not None and generation != self.generation(param_name):
+            return
+
+        nbytes = _value_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+
+        key = (param_name, utils.hash_any(slice_))
+        self._remove(key)
+        self._add(key, (slice_, value, nbytes))
+        self._evict()
+
+    def invalidate(self, param_name, slice_=None):
+        """
+        Remove the cached values of param_name that overlap slice_ and advance its write generation
+
+        @param param_name   The name of the parameter
+        @param slice_   A fully expressed slice; if None, all cached values of param_name are removed
+        """
+        self._generations[param_name] = self.generation(param_name) + 1
+        for key in list(self._param_keys.get(param_name, ())):
+            if slice_ is None or overlaps(self._entries[key][0], slice_):
+                self._remove(key)
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        for param_name in self._param_keys.keys():
+            self._generations[param_name] = self.generation(param_name) + 1
+        self._entries.clear()
+        self._param_keys.clear()
+        self.nbytes = 0
+
+    def get_stats(self):
+        """
+        Returns a dict of the number of entries, bytes held, hits (exact and from a containing slice), misses and evictions
+        """
+        return {'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'superset_hits': self.superset_hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def _add(self, key, entry):
+        self._entries[key] = entry
+        self._param_keys.setdefault(key[0], set()).add(key)
+        self.nbytes += entry[2]
+
+    def _remove(self, key, evicted=False):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+            keys = self._param_keys[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self._param_keys[key[0]]
+            if evicted:
+                self.evictions += 1
+        return entry
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)), evicted=True)
+
+
+class SharedValueCache(ValueCache):
+    """
+    ValueCache shared by all coverages in the process, bounded by one byte budget
+
+    Values are cached under (namespace, param_name) - the namespace identifies the coverage (its persistence_dir), so
+    every instance of the same coverage shares warm values.  Coverages use it through a CoverageValueCache.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_SHARED_MAX_BYTES):
+        ValueCache.__init__(self, max_bytes)
+        self._namespaces = {} # {namespace: {'entries': n, 'bytes': n, 'evictions': n}}
+        self._signatures = {} # {namespace: {param_name: brick signatures}}
+        self._writers = {} # {namespace: WeakSet of writable CoverageValueCache}
+
+    def namespace_stats(self, namespace):
+        return self._namespaces.setdefault(namespace, {'entries': 0, 'bytes': 0, 'evictions': 0})
+
+    def namespace_parameters(self, namespace):
+        return [k[1] for k in self._param_keys if k[0] == namespace]
+
+    def signatures(self, namespace):
+        """
+        Returns the dict of {param_name: brick signatures} the cached values of namespace were read under
+        """
+        return self._signatures.setdefault(namespace, {})
+
+    def add_writer(self, namespace, cache):
+        self._writers.setdefault(namespace, weakref.WeakSet()).add(cache)
+
+    def remove_writer(self, namespace, cache):
+        self._writers.get(namespace, set()).discard(cache)
+
+    def has_dirty_writer(self, namespace):
+        """
+        Returns True if a writable instance of the coverage has values that are not yet persisted
+        """
+        return any(w.has_dirty_values() for w in list(self._writers.get(namespace, ())))
+
+    def evict_namespace(self, namespace, max_bytes):
+        """
+        Evict the least recently used values of namespace until it holds at most max_bytes
+        """
+        stats = self.namespace_stats(namespace)
+        if stats['bytes'] <= max_bytes:
+            return
+        for key in list(self._entries):
+            if key[0][0] == namespace:
+                self._remove(key, evicted=True)
+                if stats['bytes'] <= max_bytes:
+                    break
+
+    def clear(self):
+        ValueCache.clear(self)
+        for stats in self._namespaces.itervalues():
+            stats['entries'] = stats['bytes'] = 0
+
+    def _add(self, key, entry):
+        ValueCache._add(self, key, entry)
+        stats = self.namespace_stats(key[0][0])
+        stats['entries'] += 1
+        stats['bytes'] += entry[2]
+
+    def _remove(self, key, evicted=False):
+        entry = ValueCache._remove(self, key, evicted)
+        if entry is not None:
+            stats = self.namespace_stats(key[0][0])
+            stats['entries'] -= 1
+            stats['bytes'] -= entry[2]
+            if evicted:
+                stats['evictions'] += 1
+        return entry
+
+
+_shared_cache = None
+
+def get_shared_value_cache():
+    """
+    Returns the process-wide SharedValueCache
+    """
+    global _shared_cache
+    if _shared_cache is None:
+        _shared_cache = SharedValueCache()
+
+    return _shared_cache
+
+
+class CoverageValueCache(object):
+    """
+    The values of one coverage in the process-wide SharedValueCache, with the interface of a ValueCache
+
+    Statistics are those of this instance, except entries, bytes and evictions which cover all instances of the
+    coverage.  Values read by a read-only instance are not cached while a writable instance has values that are not
+    yet persisted.
+    """
+
+    def __init__(self, namespace, max_bytes=DEFAULT_MAX_BYTES, dirty_check=None, shared=None):
+        """
+        @param namespace    The persistence_dir of the coverage
+        @param max_bytes    The number of bytes of values of the coverage held before evicting its least recently used
+        @param dirty_check  For writable instances, a callable returning True if there are values not yet persisted
+        @param shared   The SharedValueCache; defaults to the process-wide one
+        """
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.shared = shared if shared is not None else get_shared_value_cache()
+        self._dirty_check = dirty_check
+        self.hits = 0
+        self.superset_hits = 0
+        self.misses = 0
+        if dirty_check is not None:
+            self.shared.add_writer(namespace, self)
+
+    def __len__(self):
+        return self.shared.namespace_stats(self.namespace)['entries']
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return ((self.namespace, key[0]), key[1]) in self.shared
+
+    def __getitem__(self, key):
+        return self.shared[((self.namespace, key[0]), key[1])]
+
+    def keys(self):
+        return [(k[0][1], k[1]) for k in self.shared.keys() if k[0][0] == self.namespace]
+
+    def parameters(self):
+        return self.shared.namespace_parameters(self.namespace)
+
+    @property
+    def signatures(self):
+        return self.shared.signatures(self.namespace)
+
+    @property
+    def nbytes(self):
+        return self.shared.namespace_stats(self.namespace)['bytes']
+
+    def has_dirty_values(self):
+        return self._dirty_check is not None and self._dirty_check()
+
+    def get(self, param_name, slice_):
+        value, stat = self.shared._lookup((self.namespace, param_name), slice_)
+        setattr(self, stat, getattr(self, stat) + 1)
+        return value
+
+    def generation(self, param_name):
+        return self.shared.generation((self.namespace, param_name))
+
+    def put(self, param_name, slice_, value, generation=None):
+        if value is not None and _value_nbytes(value) > self.max_bytes:
+            return
+        if self._dirty_check is None and self.shared.has_dirty_writer(self.namespace):
+            return
+
+        self.shared.put((self.namespace, param_name), slice_, value, generation)
+        self.shared.evict_namespace(self.namespace, self.max_bytes)
+
+    def invalidate(self, param_name, slice_=None):
+        self.shared.invalidate((self.namespace, param_name), slice_)
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.shared.evict_namespace(self.namespace, max_bytes)
+
+    def clear(self):
+        for param_name in self.parameters():
+            self.invalidate(param_name)
+
+    def release(self):
+        """
+        Stop treating this instance as a writer of the coverage - called when the coverage is closed
+        """
+        self.shared.remove_writer(self.namespace, self)
+        self._dirty_check = None
+
+    def get_stats(self):
+        stats = self.shared.namespace_stats(self.namespace)
+        return {'entries': stats['entries'],
+                'bytes': stats['bytes'],
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'superset_hits': self.superset_hits,
+                'misses': self.misses,
+                'evictions': stats['evictions']}
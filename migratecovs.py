@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+if __name__ == "__main__":
+    import os
+    import re
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Convert coverages in the default or specified directory to binary attribute/object storage')
+    parser.add_argument('-v', '--verbose', help='Verbose output', action='store_true')
+    parser.add_argument('-c', '--count', help='Report the number of coverages, but do not migrate', action='store_true')
+    parser.add_argument('loc', help='Location of the coverages to migrate', nargs='?', default=os.path.dirname(os.path.realpath(__file__)))
+
+    guid_match = r'^\w{8}-\w{4}-\w{4}-\w{4}-\w{12}'
+
+    args = parser.parse_args()
+    loc = os.path.realpath(args.loc)
+
+    pths=[]
+    for x in [x for x in os.listdir(loc) if re.match(guid_match, x) is not None]:
+        pt=os.path.join(loc,x)
+        if os.path.isdir(pt) and '{0}_master.hdf5'.format(x) in os.listdir(pt):
+            pths.append(pt)
+
+    nc = len(pths)
+    if nc==0:
+        print 'No coverages found in \'{0}\''.format(loc)
+    else:
+        if args.count:
+            print '{0} coverages in directory \'{1}\''.format(nc, loc)
+        else:
+            from coverage_model.migration import migrate_coverage
+            print 'Migrating {0} coverages in \'{1}\'...'.format(nc, loc)
+            for p in pths:
+                if args.verbose:
+                    print "Migrating: %s" % p
+                res = migrate_coverage(p)
+                if args.verbose:
+                    for fpath, (acount, dcount) in sorted(res.iteritems()):
+                        print "  %s: %d attributes, %d datasets" % (os.path.relpath(fpath, p), acount, dcount)
+            print 'Finished!'